@@ -1,55 +1,145 @@
+import hashlib
+import logging
 import os
 import random
-from math import tanh
-from flask import jsonify
+import time
+from datetime import datetime, timedelta
 
-import bcrypt
-from flask import Flask, render_template, redirect, url_for, request, flash, session
+import click
+from flask import (Blueprint, Flask, Response, render_template, redirect, url_for, request, flash, session,
+                   stream_with_context, g, has_request_context, make_response, current_app, jsonify)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import make_transient_to_detached
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, UserMixin, login_required, logout_user, login_user, current_user
-from flask_dance.contrib.discord import make_discord_blueprint, discord
-from flask_dance.consumer import oauth_authorized
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import generate_csrf
 from wtforms import StringField, SubmitField, SelectField
 from wtforms.validators import DataRequired, Length
 
-os.environ["OAUTHLIB_RELAX_TOKEN_SCOPE"] = "0"
-os.environ["OAUTHLIB_IGNORE_SCOPE_CHANGE"] = "0"
+import database
+import listing
+import migrations
+import simulator
+from cache import TTLCache
+from catalog import Catalog, CatalogCache, Skill
+from combat_state import COMBATANT_FIELDS, CombatState
+from discord_api import DiscordClient, DiscordError
+from fragments import FragmentCacheExtension
+from content import FIELDS, KINDS, ContentError, read_rows, validate_row, write_rows
+from hub import GameHub, InProcessBackend, RedisBackend
+from listing import ListingError
+from metrics import Metrics, SamplingFilter
+from stats import (DEFEAT_EXPERIENCE_PER_LEVEL, LEVEL_EXPERIENCE, LEVEL_STAT_POINTS, MAX_EXPERIENCE_AWARD, STATS,
+                   attack_damage, derive_stats, effective_stat, hit_chance, skill_totals)
+
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
 
-app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY')
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get('DATABASE_URL', 'sqlite:///project.db')
+# Every page, API route and CLI command of the site; create_app registers it
+# on the application after the Discord login blueprint
+site = Blueprint('site', __name__, cli_group=None)
 
-# Replace CLIENT_ID and CLIENT_SECRET with your Discord app's values
-CLIENT_ID = os.environ.get('DISCORD_CLIENT_ID')
-CLIENT_SECRET = os.environ.get('DISCORD_CLIENT_SECRET')
-DISCORD_REDIRECT_URI = DISCORD_REDIRECT_URI = os.environ.get('DISCORD_REDIRECT_URI')
+# Both the OAuth flow and the REST calls go here; point it at a local stub for load tests
+DISCORD_API_URL = os.environ.get('DISCORD_API_URL', 'https://discord.com').rstrip('/')
 
-# Set up Discord OAuth2 with Flask-Dance
-discord_blueprint = make_discord_blueprint(
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    scope=["identify", "guilds"],
-    redirect_url=DISCORD_REDIRECT_URI,  # Update with your app's URL
-)
-app.register_blueprint(discord_blueprint, url_prefix="/login")
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-login_manager = LoginManager()
-login_manager.init_app(app)
+# Combat updates are pushed to every open game page; with several gunicorn
+# workers the events have to travel through Redis to reach all of them.
+# create_app starts both backends, so importing this module connects nothing.
+REDIS_URL = os.environ.get('REDIS_URL')
+combat_hub = GameHub(RedisBackend(REDIS_URL, 'combat-events') if REDIS_URL else InProcessBackend())
+
+# Each worker caches the logged-in users it has seen. Invalidations go through
+# the same backend as combat events so every worker drops the stale entry.
+user_cache = TTLCache(ttl=int(os.environ.get('USER_CACHE_TTL', 60)))
+user_cache_invalidation = RedisBackend(REDIS_URL, 'user-cache-invalidation') if REDIS_URL else InProcessBackend()
+
+request_metrics = Metrics()
+
+# Guild membership is fetched from Discord at most once per GUILD_CACHE_TTL
+# seconds per user and kept in user_guilds; /refresh-guilds forces a fetch.
+GUILD_CACHE_TTL = int(os.environ.get('GUILD_CACHE_TTL', 3600))
+discord_api = DiscordClient(DISCORD_API_URL)
+
+# Each game keeps only its most recent combat log entries
+COMBAT_LOG_RETENTION = int(os.environ.get('COMBAT_LOG_RETENTION', 500))
+COMBAT_LOG_COMPACT_EVERY = 100
+COMBAT_LOG_PAGE_SIZE = 20
+
+# Rows per page of the admin catalog tables and of /admin/catalog/<kind>
+ADMIN_PAGE_SIZE = 50
+ADMIN_PAGE_SIZE_MAX = 500
+
+# Attempts per write before a database conflict is reported
+COMMIT_ATTEMPTS = 3
+
+# Bulk content files are imported and exported this many rows at a time
+CONTENT_CHUNK_SIZE = 500
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return UserModel.query.get(int(user_id))
+    info = cached_user_info(int(user_id))
+    if info is None:
+        return None
+    # Attach a clean copy of the cached row to the session without querying it;
+    # relationships still lazy-load as usual if a view needs them.
+    user = UserModel(**info['user'])
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def cached_user_info(user_id):
+    """Return the cached row, player entity id, game ids and guild ids of ``user_id``."""
+    info = user_cache.get(user_id)
+    if info is None:
+        user = db.session.get(UserModel, user_id)
+        if user is None:
+            return None
+        player_entity_id = db.session.query(EntityModel.id).filter_by(user_id=user_id).limit(1).scalar()
+        game_ids = [game_id for (game_id,) in
+                    db.session.query(players_games.c.game_id).filter(players_games.c.user_id == user_id)]
+        guild_ids = [guild_id for (guild_id,) in
+                     db.session.query(user_guilds.c.guild_id).filter(user_guilds.c.user_id == user_id)]
+        info = {
+            'user': {column.name: getattr(user, column.name) for column in UserModel.__table__.columns},
+            'player_entity_id': player_entity_id,
+            'game_ids': game_ids,
+            'guild_ids': guild_ids
+        }
+        user_cache.set(user_id, info)
+    return info
+
+
+def invalidate_user(user_id):
+    """Drop ``user_id`` from the user cache of every worker.
+
+    This worker drops it at once, so its next request sees the change even
+    while the message to the others is still on its way.
+    """
+    user_cache.invalidate(user_id)
+    user_cache_invalidation.publish(user_id, None)
+
+
+def visible_games(user_id):
+    """Query the games ``user_id`` plays in or that belong to one of their Discord servers.
+
+    Both id sets come from the user cache, so this is a single query served by
+    the primary key and the discord_guild_id index however many guilds the
+    user is in.
+    """
+    info = cached_user_info(user_id)
+    return GameModel.query.filter(db.or_(GameModel.id.in_(info['game_ids']),
+                                         GameModel.discord_guild_id.in_(info['guild_ids'])))
 
 
 # Models
 
 class AttackModel(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Set default value to 1
-    name = db.Column(db.Text)
+    name = db.Column(db.Text, index=True)
     description = db.Column(db.Text)
     damage_modifier_stat = db.Column(db.String)
     damage_modifier_multiplier = db.Column(db.Float)
@@ -57,12 +147,12 @@ class AttackModel(db.Model):
     damage = db.Column(db.Float)
     number_of_targets = db.Column(db.Integer)
 
-    skill_id = db.Column(db.Integer, db.ForeignKey('skill_model.id'))
+    skill_id = db.Column(db.Integer, db.ForeignKey('skill_model.id'), index=True)
 
 
 class SkillModel(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Set default value to 1
-    name = db.Column(db.Text)
+    name = db.Column(db.Text, index=True)
     description = db.Column(db.Text)
 
     bonus_strength = db.Column(db.Float)
@@ -86,10 +176,10 @@ class SkillModel(db.Model):
 
 class EntityModel(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Set default value to 1
-    name = db.Column(db.Text)
+    name = db.Column(db.Text, index=True)
     description = db.Column(db.Text)
 
-    level = db.Column(db.Integer)
+    level = db.Column(db.Integer, index=True)
     experience = db.Column(db.Integer)
     unassigned_stat_points = db.Column(db.Integer)
 
@@ -114,6 +204,14 @@ class EntityModel(db.Model):
     multiplier_wisdom = db.Column(db.Float)
     multiplier_charisma = db.Column(db.Float)
 
+    # base * multiplier + bonus, written by derive_stats whenever the others change
+    effective_strength = db.Column(db.Float)
+    effective_dexterity = db.Column(db.Float)
+    effective_constitution = db.Column(db.Float)
+    effective_intelligence = db.Column(db.Float)
+    effective_wisdom = db.Column(db.Float)
+    effective_charisma = db.Column(db.Float)
+
     health = db.Column(db.Float)
     max_health = db.Column(db.Float)
 
@@ -129,32 +227,53 @@ class EntityModel(db.Model):
     psi_regen = db.Column(db.Float)
     max_psi_regen = db.Column(db.Float)
 
+    # Bumped from a database-wide counter every time health changes, so clients
+    # can ask for "everything that changed since version N".
+    health_version = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+
     skills = db.relationship('SkillModel', secondary='entity_skill',
                              backref=db.backref('entities', lazy='dynamic'))
 
-    user_id = db.Column(db.Integer, db.ForeignKey('user_model.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user_model.id'), nullable=True, index=True)
 
 
+# Keep these tables in step with migrations.py
 entity_skill = db.Table('entity_skill',
-                        db.Column('entity_id', db.Integer, db.ForeignKey('entity_model.id')),
-                        db.Column('skill_id', db.Integer, db.ForeignKey('skill_model.id')))
+                        db.Column('entity_id', db.Integer, db.ForeignKey('entity_model.id'), primary_key=True),
+                        db.Column('skill_id', db.Integer, db.ForeignKey('skill_model.id'), primary_key=True),
+                        db.Index('ix_entity_skill_skill_id', 'skill_id'))
+
+# Every attack an entity gets from its skills, kept in step by refresh_entity_attacks
+entity_attack = db.Table('entity_attack',
+                         db.Column('entity_id', db.Integer, db.ForeignKey('entity_model.id'), primary_key=True),
+                         db.Column('attack_id', db.Integer, db.ForeignKey('attack_model.id'), primary_key=True),
+                         db.Index('ix_entity_attack_attack_id', 'attack_id'))
 
 players_games = db.Table('players_games',
-                         db.Column('user_id', db.Integer, db.ForeignKey('user_model.id')),
-                         db.Column('game_id', db.Integer, db.ForeignKey('game_model.id')))
+                         db.Column('user_id', db.Integer, db.ForeignKey('user_model.id'), primary_key=True),
+                         db.Column('game_id', db.Integer, db.ForeignKey('game_model.id'), primary_key=True),
+                         db.Index('ix_players_games_game_id', 'game_id'))
+
+user_guilds = db.Table('user_guilds',
+                       db.Column('user_id', db.Integer, db.ForeignKey('user_model.id'), primary_key=True),
+                       db.Column('guild_id', db.String, primary_key=True),
+                       db.Index('ix_user_guilds_guild_id', 'guild_id'))
 
 games_entities = db.Table(
     'games_entities',
     db.Column('game_id', db.Integer, db.ForeignKey('game_model.id'), primary_key=True),
-    db.Column('entity_id', db.Integer, db.ForeignKey('entity_model.id'), primary_key=True)
+    db.Column('entity_id', db.Integer, db.ForeignKey('entity_model.id'), primary_key=True),
+    db.Index('ix_games_entities_entity_id', 'entity_id')
 )
 
 
 class GameModel(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     game_name = db.Column(db.String, unique=True, nullable=False)
-    discord_guild_id = db.Column(db.String, nullable=True)
+    discord_guild_id = db.Column(db.String, nullable=True, index=True)
     creator_id = db.Column(db.Integer)
+    # Bumped whenever a player joins or an entity is added or removed
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     players = db.relationship('UserModel', secondary=players_games,
                               backref=db.backref('games', lazy='dynamic'))
@@ -163,54 +282,901 @@ class GameModel(db.Model, UserMixin):
                                backref=db.backref('games', lazy='dynamic'))
 
     def get_players(self):
-        print(self.players[0])
+        current_app.logger.debug('Game %s has %d players', self.id, len(self.players))
         return self.players
 
 
+class CatalogVersionModel(db.Model):
+    # A single row, bumped whenever a skill or attack is written
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class HealthVersionModel(db.Model):
+    # A single row holding the last health version handed out (see next_health_version)
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Migration 13 seeds the row in migrated databases; this covers create_all()
+db.event.listen(HealthVersionModel.__table__, 'after_create',
+                db.DDL('INSERT INTO health_version_model (id, version) VALUES (1, 0)'))
+
+
+class EntityVersionModel(db.Model):
+    # A single row, bumped whenever existing entities change in a way the admin entity table shows
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Migration 14 seeds the row in migrated databases; this covers create_all()
+db.event.listen(EntityVersionModel.__table__, 'after_create',
+                db.DDL('INSERT INTO entity_version_model (id, version) VALUES (1, 0)'))
+
+
+class CombatLogModel(db.Model):
+    # sqlite_autoincrement keeps ids increasing even after old rows are compacted away
+    __table_args__ = (db.Index('ix_combat_log_model_game_id_id', 'game_id', 'id'), {'sqlite_autoincrement': True})
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    game_id = db.Column(db.Integer, db.ForeignKey('game_model.id'), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class CombatJournalModel(db.Model):
+    # The last batch of each write-behind combat journal that has been stored (see combat_state.py)
+    name = db.Column(db.String, primary_key=True)
+    batch = db.Column(db.Integer, nullable=False)
+
+
+class EncounterModel(db.Model):
+    # One running encounter per game. initiative holds [entity_id, score] pairs,
+    # highest score first, and turn indexes into it.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    game_id = db.Column(db.Integer, db.ForeignKey('game_model.id'), unique=True, nullable=False)
+    round = db.Column(db.Integer, nullable=False, default=1)
+    turn = db.Column(db.Integer, nullable=False, default=0)
+    initiative = db.Column(db.JSON, nullable=False)
+
+
 class UserModel(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     discord_id = db.Column(db.String, unique=True, nullable=False)
     username = db.Column(db.String, nullable=False)
     discriminator = db.Column(db.String, nullable=False)
     avatar_url = db.Column(db.String, nullable=True)
+    guilds_refreshed_at = db.Column(db.DateTime, nullable=True)
     player_entity = db.relationship('EntityModel', backref='owner', lazy=True, uselist=False)
 
     def __repr__(self):
         return f'<User {self.username}>'
 
 
+def check_database():
+    """Return the database settings in effect and warnings about ones that will not hold up under load."""
+    report = database.settings(db.engine)
+    with db.engine.connect() as conn:
+        report['schema_version'] = migrations.current_version(conn)
+    latest = migrations.MIGRATIONS[-1][0]
+
+    warnings = database.problems(report)
+    if report['schema_version'] < latest:
+        warnings.append(f"schema is at version {report['schema_version']} of {latest}; run flask upgrade-db")
+    return report, warnings
+
+
+# Request instrumentation
+@db.event.listens_for(db.Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    context.statement_started = time.perf_counter()
+
+
+@db.event.listens_for(db.Engine, 'after_cursor_execute')
+def record_statement_time(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'request_started' in g:
+        g.sql_statements += 1
+        g.sql_seconds += time.perf_counter() - context.statement_started
+
+
+@site.before_app_request
+def start_request_timer():
+    if current_app.config['METRICS_ENABLED']:
+        g.request_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+
+@site.after_app_request
+def record_request_metrics(response):
+    # Streamed responses are timed up to their first byte
+    started = g.pop('request_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        request_metrics.record(endpoint, response.status_code, elapsed, g.sql_statements, g.sql_seconds)
+        level = logging.WARNING if elapsed >= current_app.config['SLOW_REQUEST_SECONDS'] else logging.DEBUG
+        current_app.logger.log(level, '%s %s -> %s in %.3fs, %d SQL statements in %.3fs', request.method,
+                               endpoint, response.status_code, elapsed, g.sql_statements, g.sql_seconds)
+    return response
+
+
 # DND stuff
-def attack(attacker: EntityModel, defender: EntityModel, attack_type: AttackModel):
-    # Calculate the attacker's stat value based on the attack's damage modifier stat
-    if attack_type.damage_modifier_stat == "strength":
-        stat_value = attacker.base_strength * attacker.multiplier_strength + attacker.bonus_strength
-    elif attack_type.damage_modifier_stat == "dexterity":
-        stat_value = attacker.base_dexterity * attacker.multiplier_dexterity + attacker.bonus_dexterity
-    elif attack_type.damage_modifier_stat == "constitution":
-        stat_value = attacker.base_constitution * attacker.multiplier_constitution + attacker.bonus_constitution
-    elif attack_type.damage_modifier_stat == "intelligence":
-        stat_value = attacker.base_intelligence * attacker.multiplier_intelligence + attacker.bonus_intelligence
-    elif attack_type.damage_modifier_stat == "wisdom":
-        stat_value = attacker.base_wisdom * attacker.multiplier_wisdom + attacker.bonus_wisdom
-    elif attack_type.damage_modifier_stat == "charisma":
-        stat_value = attacker.base_charisma * attacker.multiplier_charisma + attacker.bonus_charisma
+def roll_attack(attacker: EntityModel, defender: EntityModel, attack_type: AttackModel, rng=random):
+    """Roll one attack and return ``(hit, damage)`` without touching the defender."""
+    return rng.random() < hit_chance(attack_type, defender), attack_damage(attacker, attack_type)
+
+
+def attack_message(attacker, defender, attack_type, hit, damage):
+    if hit:
+        return f"{attacker.name} attacked {defender.name} with {attack_type.name}, dealing {damage} damage!"
     else:
-        raise ValueError("Invalid damage_modifier_stat value.")
+        return f"{attacker.name} missed {defender.name} with {attack_type.name}!"
 
-    # Calculate the attack's damage
-    attack_damage = attack_type.damage + stat_value * attack_type.damage_modifier_multiplier
 
-    # Calculate the chance of the attack hitting the target
-    hit_chance = attack_type.accuracy * defender.evasion
+def attack(attacker: EntityModel, defender: EntityModel, attack_type: AttackModel):
+    hit, damage = roll_attack(attacker, defender, attack_type)
 
     # Check if the attack hits
-    if random.random() < hit_chance:
-        defender.health -= attack_damage
+    if hit:
+        defender.health -= damage
         if defender.health < 0:
             defender.health = 0
-        return f"{attacker.name} attacked {defender.name} with {attack_type.name}, dealing {attack_damage} damage!"
-    else:
-        return f"{attacker.name} missed {defender.name} with {attack_type.name}!"
+    return attack_message(attacker, defender, attack_type, hit, damage)
+
+
+def next_health_version():
+    """Allocate a new health version in the caller's transaction and return it.
+
+    The counter row stays locked until the transaction ends, so versions
+    commit in the order they are handed out: a client that has seen version
+    N can never miss a row committed later with a lower one.
+    """
+    return db.session.execute(
+        db.update(HealthVersionModel).values(version=HealthVersionModel.version + 1)
+        .returning(HealthVersionModel.version)
+    ).scalar_one()
+
+
+def apply_damage(damage_by_entity):
+    """Subtract damage from health in the database and return the health update to publish.
+
+    The subtraction and the clamp at zero happen inside the UPDATE, so attacks
+    on the same entity from different workers all land instead of overwriting
+    each other. Entities already at zero are left alone. Returns ``None`` when
+    no health changed. The caller commits.
+    """
+    damage_by_entity = {entity_id: damage for entity_id, damage in damage_by_entity.items() if damage > 0}
+    if not damage_by_entity:
+        return None
+
+    table = EntityModel.__table__
+    damage = db.bindparam('damage', type_=db.Float)
+    version = next_health_version()
+    db.session.execute(
+        db.update(table)
+        .where(table.c.id == db.bindparam('entity_id'), table.c.health > 0)
+        .values(health=db.case((table.c.health > damage, table.c.health - damage), else_=0),
+                health_version=version),
+        [{'entity_id': entity_id, 'damage': value} for entity_id, value in damage_by_entity.items()]
+    )
+    # The UPDATE bypasses the identity map, so read the results back from the database
+    for entity in list(db.session.identity_map.values()):
+        if isinstance(entity, EntityModel) and entity.id in damage_by_entity:
+            db.session.expire(entity)
+
+    rows = db.session.query(EntityModel.id, EntityModel.name, EntityModel.health, EntityModel.max_health,
+                            EntityModel.health_version) \
+        .filter(EntityModel.id.in_(damage_by_entity)).all()
+    return {
+        'version': max(row.health_version for row in rows),
+        'entities': [
+            {
+                'id': row.id,
+                'name': row.name,
+                'health': row.health,
+                'max_health': row.max_health
+            }
+            for row in rows
+        ]
+    }
+
+
+def load_combatants(game_id, entity_ids):
+    """The ``COMBATANT_FIELDS`` of every entity of ``game_id`` (unless None) and of ``entity_ids``."""
+    columns = [db.func.coalesce(EntityModel.health, 0).label('health') if field == 'health'
+               else getattr(EntityModel, field) for field in COMBATANT_FIELDS]
+    criteria = [EntityModel.id.in_(entity_ids)]
+    if game_id is not None:
+        criteria.append(EntityModel.id.in_(db.select(games_entities.c.entity_id)
+                                           .where(games_entities.c.game_id == game_id)))
+    rows = [row._asdict() for row in db.session.query(*columns).filter(db.or_(*criteria))]
+    attack_ids = {}
+    for entity_id, attack_id in db.session.query(entity_attack.c.entity_id, entity_attack.c.attack_id) \
+            .filter(entity_attack.c.entity_id.in_([row['id'] for row in rows])):
+        attack_ids.setdefault(entity_id, []).append(attack_id)
+    for row in rows:
+        row['attack_ids'] = attack_ids.get(row['id'], [])
+    return rows
+
+
+def store_combat(journal, batch, damage_by_entity, messages_by_game):
+    """Store one batch of write-behind combat and publish the health it changed.
+
+    The journal's batch number is recorded in the same transaction, so a
+    batch that was already stored is skipped when it is replayed.
+    """
+    def work():
+        stored = db.session.get(CombatJournalModel, journal)
+        if stored is not None and stored.batch >= batch:
+            return None
+        if stored is None:
+            db.session.add(CombatJournalModel(name=journal, batch=batch))
+        else:
+            stored.batch = batch
+        update = apply_damage(damage_by_entity)
+        for game_id, messages in messages_by_game.items():
+            append_combat_log(game_id, messages)
+        return update
+
+    update = commit_with_retry(work)
+    if update:
+        # The batch is stored whatever happens here; a failure must not make the
+        # caller store it again, which the batch marker would turn into a skip
+        try:
+            publish_health_update(update)
+        except Exception:
+            current_app.logger.exception('Publishing stored combat failed; pages catch up through /game-updates')
+
+
+def forget_combat_journal(journal):
+    db.session.query(CombatJournalModel).filter_by(name=journal).delete()
+    db.session.commit()
+
+
+def commit_with_retry(work, attempts=COMMIT_ATTEMPTS):
+    """Run ``work()`` and commit, retrying both when the database reports a conflict.
+
+    Lock timeouts, deadlocks and serialization failures all surface as
+    OperationalError; the transaction is rolled back and ``work`` runs again
+    after a short backoff. Returns whatever ``work`` returned.
+    """
+    for attempt in range(attempts):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except OperationalError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+
+def recompute_entities(*criteria):
+    """Recompute the skill totals and derived stats of every entity matching ``criteria``.
+
+    The skill bonuses and multipliers are summed in one grouped query and the
+    results are written back with a single bulk UPDATE, however many entities
+    match. Current health and psi are kept, clamped to the new maximums.
+    """
+    bonus_columns = [db.func.coalesce(db.func.sum(getattr(SkillModel, f'bonus_{stat}')), 0) for stat in STATS]
+    multiplier_columns = [1 + db.func.coalesce(db.func.sum(getattr(SkillModel, f'multiplier_{stat}')), 0)
+                          for stat in STATS]
+    base_columns = [getattr(EntityModel, f'base_{stat}') for stat in STATS]
+
+    rows = db.session.query(EntityModel.id, EntityModel.health, EntityModel.psi,
+                            *base_columns, *bonus_columns, *multiplier_columns, EntityModel.max_health) \
+        .outerjoin(entity_skill, entity_skill.c.entity_id == EntityModel.id) \
+        .outerjoin(SkillModel, SkillModel.id == entity_skill.c.skill_id) \
+        .filter(*criteria) \
+        .group_by(EntityModel.id) \
+        .all()
+    if not rows:
+        return 0
+
+    stat_count = len(STATS)
+    bases = [dict(zip(STATS, row[3:3 + stat_count])) for row in rows]
+    bonuses = [dict(zip(STATS, row[3 + stat_count:3 + 2 * stat_count])) for row in rows]
+    multipliers = [dict(zip(STATS, row[3 + 2 * stat_count:3 + 3 * stat_count])) for row in rows]
+
+    health_version = None
+    updates = []
+    for row, derived in zip(rows, derive_stats(bases, bonuses, multipliers)):
+        derived['id'] = row.id
+        derived['health'] = min(row.health, derived['max_health'])
+        derived['psi'] = min(row.psi, derived['max_psi'])
+        # Open pages show health out of max health, so a change to either has to reach the delta feed
+        if derived['health'] != row.health or derived['max_health'] != row.max_health:
+            if health_version is None:
+                health_version = next_health_version()
+            derived['health_version'] = health_version
+        updates.append(derived)
+
+    db.session.execute(db.update(EntityModel), updates)
+    return len(updates)
+
+
+def refresh_entity_attacks(*criteria):
+    """Rebuild the entity_attack rows of every entity matching ``criteria`` from their skills.
+
+    Two set-based statements, however many entities match. The caller commits.
+    """
+    entity_ids = db.select(EntityModel.id).where(*criteria)
+    db.session.execute(entity_attack.delete().where(entity_attack.c.entity_id.in_(entity_ids)))
+    db.session.execute(entity_attack.insert().from_select(
+        ['entity_id', 'attack_id'],
+        db.select(entity_skill.c.entity_id, AttackModel.id)
+        .join(AttackModel, AttackModel.skill_id == entity_skill.c.skill_id)
+        .where(entity_skill.c.entity_id.in_(entity_ids))
+    ))
+
+
+def skill_holders(skill_ids):
+    """A criterion matching the entities that hold any of ``skill_ids``."""
+    return EntityModel.id.in_(db.select(entity_skill.c.entity_id).where(entity_skill.c.skill_id.in_(skill_ids)))
+
+
+def recompute_skill_holders(skill_id):
+    """Recompute every entity that has the skill ``skill_id``."""
+    holders = db.select(entity_skill.c.entity_id).where(entity_skill.c.skill_id == skill_id)
+    return recompute_entities(EntityModel.id.in_(holders))
+
+
+def load_catalog_version():
+    return db.session.query(CatalogVersionModel.version).scalar() or 0
+
+
+def load_catalog(version):
+    attacks = db.session.execute(db.select(AttackModel.__table__)).mappings().all()
+    skills = db.session.execute(db.select(SkillModel.__table__)).mappings().all()
+    return Catalog(version, attacks, skills)
+
+
+catalog = CatalogCache(load_catalog_version, load_catalog,
+                       check_interval=int(os.environ.get('CATALOG_CHECK_INTERVAL', 5)))
+
+
+def bump_catalog_version():
+    """Mark the skill and attack catalog as changed, in the caller's transaction.
+
+    Call ``catalog.reset()`` once the transaction has committed so this worker
+    picks the change up straight away; other workers notice on their next check.
+    """
+    bumped = db.session.execute(db.update(CatalogVersionModel).values(version=CatalogVersionModel.version + 1))
+    if not bumped.rowcount:
+        db.session.add(CatalogVersionModel(id=1, version=1))
+
+
+def bump_entity_version():
+    """Mark existing entities as changed for the admin entity table, in the caller's transaction."""
+    db.session.execute(db.update(EntityVersionModel).values(version=EntityVersionModel.version + 1))
+
+
+def bump_game_version(game):
+    """Mark the players or entity list of ``game`` as changed, in the caller's transaction."""
+    game.version = GameModel.version + 1
+
+
+def append_combat_log(game_id, messages):
+    """Append ``messages`` to the combat log of ``game_id``.
+
+    Every ``COMBAT_LOG_COMPACT_EVERY`` entries the log is compacted, so the cost
+    of trimming old entries is spread over many attacks.
+    """
+    entries = [CombatLogModel(game_id=game_id, message=message) for message in messages]
+    if not entries:
+        return
+    db.session.add_all(entries)
+    db.session.flush()
+
+    if entries[-1].id // COMBAT_LOG_COMPACT_EVERY > (entries[0].id - 1) // COMBAT_LOG_COMPACT_EVERY:
+        compact_combat_log()
+
+
+def compact_combat_log():
+    """Drop everything but the newest ``COMBAT_LOG_RETENTION`` entries of every game."""
+    ranked = db.select(CombatLogModel.id,
+                       db.func.row_number().over(partition_by=CombatLogModel.game_id,
+                                                 order_by=CombatLogModel.id.desc()).label('position')) \
+        .subquery()
+    expired = db.select(ranked.c.id).where(ranked.c.position > COMBAT_LOG_RETENTION)
+    db.session.execute(db.delete(CombatLogModel).where(CombatLogModel.id.in_(expired)))
+
+
+def combat_log_page(game_id, before=None, limit=COMBAT_LOG_PAGE_SIZE):
+    """Return up to ``limit`` log entries of ``game_id`` older than ``before``, newest first."""
+    query = CombatLogModel.query.filter_by(game_id=game_id)
+    if before is not None:
+        query = query.filter(CombatLogModel.id < before)
+    return query.order_by(CombatLogModel.id.desc()).limit(limit).all()
+
+
+def game_health_version(game_id):
+    """A scalar subquery for the highest health version among the entities of ``game_id``."""
+    return db.select(db.func.max(EntityModel.health_version)) \
+        .join(games_entities, games_entities.c.entity_id == EntityModel.id) \
+        .where(games_entities.c.game_id == game_id).scalar_subquery()
+
+
+def combat_log_version(game_id):
+    """A scalar subquery for the id of the newest combat log entry of ``game_id``."""
+    return db.select(db.func.max(CombatLogModel.id)).where(CombatLogModel.game_id == game_id).scalar_subquery()
+
+
+def page_etag(*versions):
+    """An ETag for a page that only changes when one of ``versions`` does."""
+    return hashlib.sha1(repr(versions).encode()).hexdigest()
+
+
+def csrf_version():
+    """Identify the CSRF tokens a page would render, for its ETag.
+
+    The session's secret is created first if needed, so the first render and
+    its revalidation agree. The period moves twice per token lifetime, so a
+    revalidated page never carries an expired token.
+    """
+    generate_csrf()
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')), \
+        int(time.time() * 2 // limit) if limit else 0
+
+
+def revalidated(response, etag):
+    """Tag ``response`` with ``etag`` and make browsers check it with If-None-Match before reuse."""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag):
+    return revalidated(current_app.response_class(status=304), etag)
+
+
+def import_content(rows):
+    """Import streamed content rows into the caller's transaction and return counts per kind.
+
+    ``rows`` yields ``(line, kind, raw)`` as produced by ``content.read_rows``.
+    Rows are validated and inserted ``CONTENT_CHUNK_SIZE`` at a time. Names
+    resolve against the catalog and against rows earlier in the stream. A
+    ContentError is raised on the first bad row; the caller should roll back.
+    """
+    current = catalog.get()
+    attack_ids = {attack.name: attack.id for attack in current.attacks.values()}
+    skills = {skill.name: skill for skill in current.skills.values()}
+    created = dict.fromkeys(KINDS, 0)
+
+    chunk = []
+    for item in rows:
+        chunk.append(item)
+        if len(chunk) == CONTENT_CHUNK_SIZE:
+            _import_chunk(chunk, attack_ids, skills, created)
+            chunk = []
+    if chunk:
+        _import_chunk(chunk, attack_ids, skills, created)
+
+    if created['attack'] or created['skill']:
+        bump_catalog_version()
+    return created
+
+
+def _import_chunk(chunk, attack_ids, skills, created):
+    validated = {kind: [] for kind in KINDS}
+    for line, kind, raw in chunk:
+        row, references = validate_row(line, kind, raw)
+        validated[kind].append((line, row, references))
+
+    # Attacks first, so skills later in the same chunk can name them
+    attacks = [AttackModel(**row) for _, row, _ in validated['attack']]
+    db.session.add_all(attacks)
+    db.session.flush()
+    attack_ids.update((attack.name, attack.id) for attack in attacks)
+
+    new_skills = [SkillModel(**row) for _, row, _ in validated['skill']]
+    db.session.add_all(new_skills)
+    db.session.flush()
+    assignments = []
+    for (line, row, references), skill in zip(validated['skill'], new_skills):
+        skills[skill.name] = Skill(id=skill.id, **row)
+        for name in references:
+            if name not in attack_ids:
+                raise ContentError(line, f'unknown attack {name!r}')
+            assignments.append({'id': attack_ids[name], 'skill_id': skill.id})
+    if assignments:
+        previous_skill_ids = {skill_id for (skill_id,) in
+                              db.session.query(AttackModel.skill_id)
+                              .filter(AttackModel.id.in_([assignment['id'] for assignment in assignments]),
+                                      AttackModel.skill_id.isnot(None))}
+        db.session.execute(db.update(AttackModel), assignments)
+        if previous_skill_ids:
+            refresh_entity_attacks(skill_holders(previous_skill_ids))
+
+    entity_rows = validated['entity']
+    entity_skills = []
+    for line, row, references in entity_rows:
+        missing = [name for name in references if name not in skills]
+        if missing:
+            raise ContentError(line, f'unknown skill {missing[0]!r}')
+        entity_skills.append([skills[name] for name in dict.fromkeys(references)])
+
+    totals = [skill_totals(held) for held in entity_skills]
+    derived = derive_stats([{stat: row[f'base_{stat}'] for stat in STATS} for _, row, _ in entity_rows],
+                           [bonus for bonus, _ in totals], [multiplier for _, multiplier in totals])
+    entities = [EntityModel(**row, **stats) for (_, row, _), stats in zip(entity_rows, derived)]
+    db.session.add_all(entities)
+    db.session.flush()
+    links = [{'entity_id': entity.id, 'skill_id': skill.id}
+             for entity, held in zip(entities, entity_skills) for skill in held]
+    if links:
+        db.session.execute(entity_skill.insert(), links)
+        refresh_entity_attacks(EntityModel.id.in_([entity.id for entity in entities]))
+
+    created['attack'] += len(attacks)
+    created['skill'] += len(new_skills)
+    created['entity'] += len(entities)
+
+
+def export_content(kinds=KINDS):
+    """Yield ``(kind, row, references)`` for every attack, skill and non-player entity.
+
+    Skills and attacks come from the catalog snapshot; entities are streamed
+    from the database ``CONTENT_CHUNK_SIZE`` rows at a time.
+    """
+    current = catalog.get()
+    if 'attack' in kinds:
+        for attack in current.attacks.values():
+            yield 'attack', {field: getattr(attack, field) for field in FIELDS['attack']}, []
+    if 'skill' in kinds:
+        for skill in current.skills.values():
+            yield 'skill', {field: getattr(skill, field) for field in FIELDS['skill']}, \
+                [attack.name for attack in current.skill_actions.get(skill.id, ())]
+    if 'entity' in kinds:
+        columns = [getattr(EntityModel, field) for field in FIELDS['entity']]
+        result = db.session.execute(db.select(EntityModel.id, *columns)
+                                    .where(EntityModel.user_id.is_(None))
+                                    .order_by(EntityModel.id)
+                                    .execution_options(yield_per=CONTENT_CHUNK_SIZE))
+        for partition in result.partitions():
+            skill_names = {}
+            links = db.session.query(entity_skill.c.entity_id, entity_skill.c.skill_id) \
+                .filter(entity_skill.c.entity_id.in_([row.id for row in partition])) \
+                .order_by(entity_skill.c.skill_id)
+            for entity_id, skill_id in links:
+                if skill_id in current.skills:
+                    skill_names.setdefault(entity_id, []).append(current.skills[skill_id].name)
+            for row in partition:
+                yield 'entity', {field: row._mapping[field] for field in FIELDS['entity']}, \
+                    skill_names.get(row.id, [])
+
+
+# The columns /admin/catalog/<kind> returns for each kind, and those it can sort on; every sort column is indexed
+CATALOG_LISTINGS = {
+    'attack': (AttackModel, ('id', 'name', 'description', 'damage_modifier_stat', 'damage_modifier_multiplier',
+                             'accuracy', 'damage', 'number_of_targets', 'skill_id'), ('id', 'name')),
+    'skill': (SkillModel, ('id', 'name', 'description', 'skill_cost'), ('id', 'name')),
+    'entity': (EntityModel, ('id', 'name', 'description', 'level', 'user_id'), ('id', 'name', 'level')),
+}
+
+
+def catalog_listing(kind, args, limit=ADMIN_PAGE_SIZE):
+    """Return one page of the ``kind`` catalog as dicts, and the cursor of the page after it.
+
+    ``args`` holds the listing arguments: ``sort`` (a sortable column),
+    ``order`` (asc or desc), ``after`` (the cursor of the previous page),
+    ``q`` (part of the name) and ``skill_id``, plus ``stat`` for attacks and
+    ``type`` (player or npc) for entities. Entities also list the names of
+    their skills and attacks, from the catalog snapshot. Raises ListingError
+    for bad arguments.
+    """
+    model, columns, sorts = CATALOG_LISTINGS[kind]
+    sort = args.get('sort') or 'id'
+    if sort not in sorts:
+        raise ListingError(f"{kind} listings sort by {', '.join(sorts)}")
+    order = args.get('order') or 'asc'
+    if order not in ('asc', 'desc'):
+        raise ListingError('order must be asc or desc')
+
+    query = db.session.query(*[getattr(model, column) for column in columns])
+    if args.get('q'):
+        query = query.filter(model.name.contains(args['q'], autoescape=True))
+    if args.get('skill_id'):
+        try:
+            skill_id = int(args['skill_id'])
+        except ValueError:
+            raise ListingError('skill_id must be a number')
+        if kind == 'attack':
+            query = query.filter(AttackModel.skill_id == skill_id)
+        elif kind == 'skill':
+            query = query.filter(SkillModel.id == skill_id)
+        else:
+            query = query.filter(EntityModel.id.in_(db.select(entity_skill.c.entity_id)
+                                                    .where(entity_skill.c.skill_id == skill_id)))
+    if kind == 'attack' and args.get('stat'):
+        query = query.filter(AttackModel.damage_modifier_stat == args['stat'])
+    if kind == 'entity' and args.get('type'):
+        if args['type'] not in ('player', 'npc'):
+            raise ListingError('type must be player or npc')
+        query = query.filter(EntityModel.user_id.is_not(None) if args['type'] == 'player'
+                             else EntityModel.user_id.is_(None))
+
+    rows, after = listing.page(query, sort, getattr(model, sort), model.id, descending=order == 'desc',
+                               cursor=args.get('after'), limit=limit)
+    items = [dict(row._mapping) for row in rows]
+    if kind == 'entity' and items:
+        current = catalog.get()
+        skill_ids = {}
+        links = db.session.query(entity_skill.c.entity_id, entity_skill.c.skill_id) \
+            .filter(entity_skill.c.entity_id.in_([item['id'] for item in items])) \
+            .order_by(entity_skill.c.skill_id)
+        for entity_id, skill_id in links:
+            if skill_id in current.skills:
+                skill_ids.setdefault(entity_id, []).append(skill_id)
+        for item in items:
+            item['skills'] = [current.skills[skill_id].name for skill_id in skill_ids.get(item['id'], ())]
+            item['attacks'] = [attack.name for attack in current.actions_for(skill_ids.get(item['id'], ()))]
+    return items, after
+
+
+def resolve_round(actions, game_id, user_id, commands_npcs=False, rng=random):
+    """Resolve a whole round of attacks and apply the damage in one bulk UPDATE statement.
+
+    ``actions`` is a list of ``(attacker_id, defender_ids, attack_id)`` tuples.
+    Each attack hits at most ``number_of_targets`` of its defenders, in the
+    order given. Only entities of ``game_id`` take part; attackers must
+    belong to ``user_id``, or be NPCs when ``commands_npcs`` is set. All
+    entities are loaded with one query; attacks come from the catalog
+    snapshot.
+
+    Returns the per-target results, whose ``health`` is this round's view of
+    the defender, and the health update to publish, or ``None`` when nobody's
+    health changed. The caller commits.
+    """
+    entity_ids = {attacker_id for attacker_id, _, _ in actions}
+    entity_ids.update(defender_id for _, defender_ids, _ in actions for defender_id in defender_ids)
+
+    entities = {entity.id: entity for entity in EntityModel.query
+                .join(games_entities, games_entities.c.entity_id == EntityModel.id)
+                .filter(games_entities.c.game_id == game_id, EntityModel.id.in_(entity_ids))}
+    attacks = catalog.get().attacks
+    known_attacks = set(db.session.query(entity_attack.c.entity_id, entity_attack.c.attack_id)
+                        .filter(entity_attack.c.entity_id.in_({attacker_id for attacker_id, _, _ in actions})))
+    health = {entity_id: entity.health or 0 for entity_id, entity in entities.items()}
+    damage_taken = {}
+
+    results = []
+    for attacker_id, defender_ids, attack_id in actions:
+        attacker = entities.get(attacker_id)
+        attack_type = attacks.get(attack_id)
+        if attacker is None or attack_type is None:
+            results.append({'attacker_id': attacker_id, 'attack_id': attack_id,
+                            'error': 'attacker or attack not found'})
+            continue
+        if attacker.user_id != user_id and not (commands_npcs and attacker.user_id is None):
+            results.append({'attacker_id': attacker_id, 'attack_id': attack_id,
+                            'error': 'attacker is not yours to command'})
+            continue
+        if (attacker_id, attack_id) not in known_attacks:
+            results.append({'attacker_id': attacker_id, 'attack_id': attack_id,
+                            'error': 'attacker does not know this attack'})
+            continue
+        if attack_type.damage_modifier_stat not in STATS:
+            results.append({'attacker_id': attacker_id, 'attack_id': attack_id,
+                            'error': 'Invalid damage_modifier_stat value.'})
+            continue
+
+        # The admin form takes any number, so anything below one still hits one target
+        for defender_id in defender_ids[:max(attack_type.number_of_targets or 1, 1)]:
+            defender = entities.get(defender_id)
+            if defender is None:
+                results.append({'attacker_id': attacker_id, 'attack_id': attack_id, 'defender_id': defender_id,
+                                'error': 'defender not found'})
+                continue
+            if health[defender_id] <= 0:
+                results.append({'attacker_id': attacker_id, 'attack_id': attack_id, 'defender_id': defender_id,
+                                'error': 'defender is already down'})
+                continue
+            hit, damage = roll_attack(attacker, defender, attack_type, rng)
+            if hit:
+                health[defender_id] = max(health[defender_id] - damage, 0)
+                damage_taken[defender_id] = damage_taken.get(defender_id, 0) + damage
+            results.append({'attacker_id': attacker_id, 'attack_id': attack_id, 'defender_id': defender_id,
+                            'hit': hit, 'damage': damage if hit else 0, 'health': health[defender_id],
+                            'message': attack_message(attacker, defender, attack_type, hit, damage)})
+
+    # Clamping the summed damage once gives the same result as clamping after every hit
+    return results, apply_damage(damage_taken)
+
+
+def start_encounter(game_id, rng=random):
+    """Roll initiative for every living entity of ``game_id`` and start round one. The caller commits."""
+    entities = EntityModel.query.join(games_entities, games_entities.c.entity_id == EntityModel.id) \
+        .filter(games_entities.c.game_id == game_id, EntityModel.health > 0).all()
+    # A d20 plus a tenth of the entity's dexterity, ties going to the lower id
+    scores = [(entity.id, rng.randint(1, 20) + effective_stat(entity, 'dexterity') / 10) for entity in entities]
+    scores.sort(key=lambda score: (-score[1], score[0]))
+
+    encounter = EncounterModel.query.filter_by(game_id=game_id).first()
+    if encounter is None:
+        encounter = EncounterModel(game_id=game_id)
+        db.session.add(encounter)
+    encounter.round = 1
+    encounter.turn = 0
+    encounter.initiative = [list(score) for score in scores]
+    db.session.flush()
+    return encounter
+
+
+def apply_regen(game_id):
+    """Apply one tick of health and psi regen to the living entities of ``game_id``.
+
+    A single UPDATE raises both values by their regen, clamped to their
+    maximums, however many entities the game holds. Returns the health update
+    to publish, or ``None`` when nobody's health changed. The caller commits.
+    """
+    table = EntityModel.__table__
+    version = next_health_version()
+    heals = db.and_(table.c.health < table.c.max_health, table.c.health_regen > 0)
+    regenerated_health = table.c.health + table.c.health_regen
+    regenerated_psi = table.c.psi + table.c.psi_regen
+    rows = db.session.execute(
+        db.update(table)
+        .where(table.c.id.in_(db.select(games_entities.c.entity_id).where(games_entities.c.game_id == game_id)),
+               table.c.health > 0,
+               db.or_(heals, db.and_(table.c.psi < table.c.max_psi, table.c.psi_regen > 0)))
+        .values(health=db.case((regenerated_health > table.c.max_health, table.c.max_health),
+                               else_=regenerated_health),
+                psi=db.case((regenerated_psi > table.c.max_psi, table.c.max_psi), else_=regenerated_psi),
+                health_version=db.case((heals, version), else_=table.c.health_version))
+        .returning(table.c.id, table.c.name, table.c.health, table.c.max_health, table.c.health_version)
+    ).all()
+    # The UPDATE bypasses the identity map
+    changed = {row.id for row in rows}
+    for entity in list(db.session.identity_map.values()):
+        if isinstance(entity, EntityModel) and entity.id in changed:
+            db.session.expire(entity)
+
+    healed = [row for row in rows if row.health_version == version]
+    if not healed:
+        return None
+    return {
+        'version': version,
+        'entities': [
+            {
+                'id': row.id,
+                'name': row.name,
+                'health': row.health,
+                'max_health': row.max_health
+            }
+            for row in healed
+        ]
+    }
+
+
+class TurnConflict(Exception):
+    """Raised when an encounter was advanced by another request in the meantime."""
+
+
+def advance_turn(encounter):
+    """Move ``encounter`` to the next living entity, ticking regen whenever a new round starts.
+
+    The encounter row is only written if nobody advanced it first; returns
+    the health update to publish, or ``None``. Raises ``TurnConflict`` when
+    another request won the race. The caller commits.
+    """
+    order = [entity_id for entity_id, _ in encounter.initiative]
+    living = {entity_id for (entity_id,) in
+              db.session.query(EntityModel.id).filter(EntityModel.id.in_(order), EntityModel.health > 0)}
+    round_number, turn = encounter.round, encounter.turn
+
+    update = None
+    for _ in range(len(order)):
+        turn += 1
+        if turn >= len(order):
+            turn = 0
+            round_number += 1
+            if update is None:
+                update = apply_regen(encounter.game_id)
+        if order[turn] in living:
+            break
+
+    advanced = db.session.query(EncounterModel) \
+        .filter_by(id=encounter.id, round=encounter.round, turn=encounter.turn) \
+        .update({'round': round_number, 'turn': turn}, synchronize_session=False)
+    if not advanced:
+        raise TurnConflict()
+    db.session.expire(encounter)
+    return update
+
+
+def level_reached(experience):
+    """SQL for ``stats.level_for_experience`` of the ``experience`` expression."""
+    return db.case(*[(experience >= threshold, level)
+                     for level, threshold in reversed(list(enumerate(LEVEL_EXPERIENCE, 1))) if level > 1],
+                   else_=1)
+
+
+def stat_points_through(level):
+    """SQL for ``stats.stat_points_through`` of the ``level`` expression."""
+    totals = [(granted_at, sum(points for at, points in LEVEL_STAT_POINTS.items() if at <= granted_at))
+              for granted_at in sorted(LEVEL_STAT_POINTS, reverse=True)]
+    return db.case(*[(level >= granted_at, total) for granted_at, total in totals], else_=0)
+
+
+def award_experience(experience, *criteria):
+    """Give ``experience`` to every entity matching ``criteria`` and level up those that reach a new level.
+
+    One UPDATE adds the experience, looks up the level each entity now
+    reaches and grants the stat points of every level gained, however many
+    entities match; levels are never lost. Returns the id, name, level,
+    experience and unassigned stat points of every entity. The caller commits.
+    """
+    table = EntityModel.__table__
+    total = db.func.coalesce(table.c.experience, 0) + experience
+    level = db.func.coalesce(table.c.level, 1)
+    reached = level_reached(total)
+    # Each entity's new level is worked out once, so the stat points can refer to it
+    progress = db.select(table.c.id, total.label('experience'),
+                         db.case((reached > level, reached), else_=level).label('level')) \
+        .where(*criteria).subquery()
+    rows = db.session.execute(
+        db.update(table)
+        .where(table.c.id == progress.c.id)
+        .values(experience=progress.c.experience, level=progress.c.level,
+                unassigned_stat_points=db.func.coalesce(table.c.unassigned_stat_points, 0)
+                + stat_points_through(progress.c.level) - stat_points_through(level))
+        .returning(table.c.id, table.c.name, table.c.level, table.c.experience, table.c.unassigned_stat_points)
+    ).all()
+    # The UPDATE bypasses the identity map
+    awarded = {row.id for row in rows}
+    for entity in list(db.session.identity_map.values()):
+        if isinstance(entity, EntityModel) and entity.id in awarded:
+            db.session.expire(entity)
+    return rows
+
+
+def end_encounter(encounter, experience=None):
+    """Finish ``encounter`` and award experience to its participants still standing.
+
+    Unless ``experience`` is given, each defeated participant is worth
+    ``DEFEAT_EXPERIENCE_PER_LEVEL`` per level, split evenly between the
+    survivors. Returns the experience each survivor got and their rows from
+    ``award_experience``, or ``None`` when another request ended the
+    encounter first. The caller commits.
+    """
+    if not db.session.query(EncounterModel).filter_by(id=encounter.id).delete(synchronize_session=False):
+        return None
+    participants = EntityModel.id.in_([entity_id for entity_id, _ in encounter.initiative])
+    if experience is None:
+        defeated_levels, survivors = db.session.query(
+            db.func.coalesce(db.func.sum(db.case((EntityModel.health > 0, 0),
+                                                 else_=db.func.coalesce(EntityModel.level, 1))), 0),
+            db.func.count().filter(EntityModel.health > 0)
+        ).filter(participants).one()
+        experience = defeated_levels * DEFEAT_EXPERIENCE_PER_LEVEL // survivors if survivors else 0
+    rows = award_experience(experience, participants, EntityModel.health > 0) if experience else []
+    if rows:
+        # Levels show in the admin entity table
+        bump_entity_version()
+    return experience, rows
+
+
+def encounter_state(encounter):
+    names = dict(db.session.query(EntityModel.id, EntityModel.name)
+                 .filter(EntityModel.id.in_([entity_id for entity_id, _ in encounter.initiative])))
+    order = [{'id': entity_id, 'name': names.get(entity_id), 'initiative': score}
+             for entity_id, score in encounter.initiative]
+    return {
+        'round': encounter.round,
+        'turn': encounter.turn,
+        'current_entity_id': order[encounter.turn]['id'] if order else None,
+        'order': order
+    }
+
+
+def runs_game(game_id, user_id):
+    """Whether ``user_id`` created ``game_id``, which makes them the one who runs its encounters."""
+    return db.session.query(db.exists().where(GameModel.id == game_id, GameModel.creator_id == user_id)).scalar()
 
 
 # Forms
@@ -222,7 +1188,7 @@ class CreateGameForm(FlaskForm):
 
 # Website
 
-@app.route('/admin', methods=["GET", "POST"])
+@site.route('/admin', methods=["GET", "POST"])
 def admin():
     if request.method == "POST":
         name = request.form['name']
@@ -239,18 +1205,81 @@ def admin():
                                   accuracy=accuracy, damage=damage,
                                   number_of_targets=number_of_targets)
         db.session.add(new_ability)
+        bump_catalog_version()
         db.session.commit()
+        catalog.reset()
+
+    current_catalog = catalog.get()
+    # Entities are never deleted, so the newest id versions the entity table's rows, and the entity
+    # version their levels; the skill and attack names it shows follow the catalog version
+    roster_version = tuple(db.session.query(db.select(db.func.max(EntityModel.id)).scalar_subquery(),
+                                            db.select(EntityVersionModel.version).scalar_subquery()).one())
+    etag = page_etag(current_catalog.version, roster_version)
+    if request.method == 'GET' and request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    # The tables and the attack and skill pickers show their first page; the rest is fetched
+    # from /admin/catalog/<kind>. Only called when the fragment is not cached.
+    def first_page(kind, **args):
+        return catalog_listing(kind, args)
+
+    response = make_response(render_template("admin.html", first_page=first_page,
+                                             catalog_version=current_catalog.version, roster_version=roster_version))
+    return revalidated(response, etag)
+
+
+@site.route('/admin/catalog/<kind>')
+def catalog_listing_page(kind):
+    if kind not in CATALOG_LISTINGS:
+        return jsonify({'success': False, 'message': f"kind must be one of {', '.join(CATALOG_LISTINGS)}"}), 404
+
+    limit = max(1, min(request.args.get('limit', ADMIN_PAGE_SIZE, type=int), ADMIN_PAGE_SIZE_MAX))
+    try:
+        items, after = catalog_listing(kind, request.args, limit)
+    except ListingError as error:
+        return jsonify({'success': False, 'message': str(error)}), 400
+
+    return jsonify({
+        'items': items,
+        # Cursor for the next page, None once the end of the listing is reached
+        'after': after
+    })
+
+
+@site.route('/admin/import', methods=["POST"])
+def import_content_file():
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'success': False, 'message': 'No file uploaded'}), 400
+
+    fmt = request.form.get('format') or ('csv' if upload.filename.endswith('.csv') else 'jsonl')
+    try:
+        created = import_content(read_rows(upload.stream, fmt, request.form.get('kind')))
+    except ContentError as error:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(error), 'line': error.line}), 400
 
-    attacks = AttackModel.query.all()
+    db.session.commit()
+    catalog.reset()
+    return jsonify({'success': True, 'created': created})
 
-    skills = SkillModel.query.all()
 
-    entities = EntityModel.query.all()
+@site.route('/admin/export')
+def export_content_file():
+    fmt = request.args.get('format', 'jsonl')
+    kind = request.args.get('kind')
+    if fmt not in ('jsonl', 'csv') or (kind is not None and kind not in KINDS) or (fmt == 'csv' and kind is None):
+        return jsonify({'success': False,
+                        'message': 'format must be jsonl or csv; csv exports need a kind'}), 400
 
-    return render_template("admin.html", attacks=attacks, skills=skills, entities=entities)
+    rows = export_content([kind] if kind else KINDS)
+    response = Response(stream_with_context(write_rows(rows, fmt, kind)),
+                        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename={kind or "content"}.{fmt}'
+    return response
 
 
-@app.route('/add_skill', methods=["POST"])
+@site.route('/add_skill', methods=["POST"])
 def add_skill():
     name = request.form['name']
     description = request.form['description']
@@ -269,6 +1298,8 @@ def add_skill():
     skill_cost = request.form['skill_cost']
     attack_ids = request.form.getlist('attacks[]')
     attacks = AttackModel.query.filter(AttackModel.id.in_(attack_ids)).all()
+    # Attacks move to the new skill, so whoever held them through their old skill loses them
+    previous_skill_ids = {attack.skill_id for attack in attacks if attack.skill_id is not None}
 
     new_skill = SkillModel(name=name, description=description, bonus_strength=bonus_strength,
                            bonus_dexterity=bonus_dexterity, bonus_constitution=bonus_constitution,
@@ -279,12 +1310,42 @@ def add_skill():
                            multiplier_charisma=multiplier_charisma, skill_cost=skill_cost, actions=attacks)
 
     db.session.add(new_skill)
+    db.session.flush()
+    if previous_skill_ids:
+        refresh_entity_attacks(skill_holders(previous_skill_ids))
+    bump_catalog_version()
     db.session.commit()
+    catalog.reset()
 
-    return redirect(url_for('admin'))
+    return redirect(url_for('site.admin'))
 
 
-@app.route('/add_entity', methods=["POST"])
+@site.route('/edit_skill', methods=["POST"])
+def edit_skill():
+    skill = db.session.get(SkillModel, request.form.get('skill_id', type=int))
+    if skill is None:
+        flash('Skill not found')
+        return redirect(url_for('site.admin'))
+
+    skill.name = request.form['name']
+    skill.description = request.form['description']
+    for stat in STATS:
+        setattr(skill, f'bonus_{stat}', float(request.form[f'bonus_{stat}']))
+        setattr(skill, f'multiplier_{stat}', float(request.form[f'multiplier_{stat}']))
+    skill.skill_cost = int(request.form['skill_cost'])
+    db.session.flush()
+
+    # Everyone holding the skill picks up the new numbers in one pass
+    updated = recompute_skill_holders(skill.id)
+    bump_catalog_version()
+    db.session.commit()
+    catalog.reset()
+
+    flash(f'Skill updated, {updated} entities recomputed')
+    return redirect(url_for('site.admin'))
+
+
+@site.route('/add_entity', methods=["POST"])
 def add_entity():
     name = request.form['name']
     description = request.form['description']
@@ -301,80 +1362,27 @@ def add_entity():
     skill_ids = request.form.getlist('skills[]')
     skills = SkillModel.query.filter(SkillModel.id.in_(skill_ids)).all()
 
-    # Calculate the total bonuses and multipliers from skills
-    total_bonus_strength = 0
-    total_bonus_dexterity = 0
-    total_bonus_constitution = 0
-    total_bonus_intelligence = 0
-    total_bonus_wisdom = 0
-    total_bonus_charisma = 0
-
-    total_multiplier_strength = 1
-    total_multiplier_dexterity = 1
-    total_multiplier_constitution = 1
-    total_multiplier_intelligence = 1
-    total_multiplier_wisdom = 1
-    total_multiplier_charisma = 1
-
-    for skill in skills:
-        total_bonus_strength += skill.bonus_strength
-        total_bonus_dexterity += skill.bonus_dexterity
-        total_bonus_constitution += skill.bonus_constitution
-        total_bonus_intelligence += skill.bonus_intelligence
-        total_bonus_wisdom += skill.bonus_wisdom
-        total_bonus_charisma += skill.bonus_charisma
-
-        total_multiplier_strength += skill.multiplier_strength
-        total_multiplier_dexterity += skill.multiplier_dexterity
-        total_multiplier_constitution += skill.multiplier_constitution
-        total_multiplier_intelligence += skill.multiplier_intelligence
-        total_multiplier_wisdom += skill.multiplier_wisdom
-        total_multiplier_charisma += skill.multiplier_charisma
-
-    health = base_constitution * total_multiplier_constitution + total_bonus_constitution
-    max_health = base_constitution * total_multiplier_constitution + total_bonus_constitution
-
-    health_regen = (tanh(((base_constitution * total_multiplier_constitution +
-                           total_bonus_constitution - 100) / 50)) + 1) / 2
-    max_health_regen = (tanh(((base_constitution * total_multiplier_constitution +
-                               total_bonus_constitution - 100) / 50)) + 1) / 2
-
-    evasion = 1 - (tanh(((base_dexterity * total_multiplier_dexterity + total_bonus_dexterity) * 0.01) - 2) + 1) / 2
-    max_evasion = 1 - (tanh(((base_dexterity * total_multiplier_dexterity + total_bonus_dexterity) * 0.01) - 2) + 1) / 2
-
-    psi = base_intelligence * total_multiplier_intelligence + total_bonus_intelligence
-    max_psi = base_intelligence * total_multiplier_intelligence + total_bonus_intelligence
-
-    psi_regen = (tanh(((base_intelligence * total_multiplier_intelligence +
-                        total_bonus_intelligence - 100) / 50)) + 1) / 2
-    max_psi_regen = (tanh(((base_intelligence * total_multiplier_intelligence +
-                            total_bonus_intelligence - 100) / 50)) + 1) / 2
+    base = {'strength': base_strength, 'dexterity': base_dexterity, 'constitution': base_constitution,
+            'intelligence': base_intelligence, 'wisdom': base_wisdom, 'charisma': base_charisma}
+    bonus, multiplier = skill_totals(skills)
+    derived = derive_stats([base], [bonus], [multiplier])[0]
 
     new_entity = EntityModel(name=name, description=description, level=level,
                              experience=experience, unassigned_stat_points=unassigned_stat_points,
                              base_strength=base_strength, base_dexterity=base_dexterity,
                              base_constitution=base_constitution, base_intelligence=base_intelligence,
                              base_wisdom=base_wisdom, base_charisma=base_charisma, skills=skills,
-                             bonus_strength=total_bonus_strength, bonus_dexterity=total_bonus_dexterity,
-                             bonus_constitution=total_bonus_constitution, bonus_intelligence=total_bonus_intelligence,
-                             bonus_wisdom=total_bonus_wisdom, bonus_charisma=total_bonus_charisma,
-                             multiplier_strength=total_multiplier_strength,
-                             multiplier_dexterity=total_multiplier_dexterity,
-                             multiplier_constitution=total_multiplier_constitution,
-                             multiplier_intelligence=total_multiplier_intelligence,
-                             multiplier_wisdom=total_multiplier_wisdom, multiplier_charisma=total_multiplier_charisma,
-                             health=health, max_health=max_health, health_regen=health_regen,
-                             max_health_regen=max_health_regen, evasion=evasion, max_evasion=max_evasion,
-                             psi=psi, max_psi=max_psi, psi_regen=psi_regen, max_psi_regen=max_psi_regen
-                             )
+                             **derived)
 
     db.session.add(new_entity)
+    db.session.flush()
+    refresh_entity_attacks(EntityModel.id == new_entity.id)
     db.session.commit()
 
-    return redirect(url_for('admin'))
+    return redirect(url_for('site.admin'))
 
 
-@app.route('/create-entity', methods=['GET', 'POST'])
+@site.route('/create-entity', methods=['GET', 'POST'])
 @login_required
 def create_entity():
     if request.method == 'POST':
@@ -393,83 +1401,27 @@ def create_entity():
         skill_ids = request.form.getlist('skills[]')
         skills = SkillModel.query.filter(SkillModel.id.in_(skill_ids)).all()
 
-        # Calculate the total bonuses and multipliers from skills
-        total_bonus_strength = 0
-        total_bonus_dexterity = 0
-        total_bonus_constitution = 0
-        total_bonus_intelligence = 0
-        total_bonus_wisdom = 0
-        total_bonus_charisma = 0
-
-        total_multiplier_strength = 1
-        total_multiplier_dexterity = 1
-        total_multiplier_constitution = 1
-        total_multiplier_intelligence = 1
-        total_multiplier_wisdom = 1
-        total_multiplier_charisma = 1
-
-        for skill in skills:
-            total_bonus_strength += skill.bonus_strength
-            total_bonus_dexterity += skill.bonus_dexterity
-            total_bonus_constitution += skill.bonus_constitution
-            total_bonus_intelligence += skill.bonus_intelligence
-            total_bonus_wisdom += skill.bonus_wisdom
-            total_bonus_charisma += skill.bonus_charisma
-
-            total_multiplier_strength += skill.multiplier_strength
-            total_multiplier_dexterity += skill.multiplier_dexterity
-            total_multiplier_constitution += skill.multiplier_constitution
-            total_multiplier_intelligence += skill.multiplier_intelligence
-            total_multiplier_wisdom += skill.multiplier_wisdom
-            total_multiplier_charisma += skill.multiplier_charisma
-
-        health = base_constitution * total_multiplier_constitution + total_bonus_constitution
-        max_health = base_constitution * total_multiplier_constitution + total_bonus_constitution
-
-        health_regen = (tanh(((base_constitution * total_multiplier_constitution +
-                               total_bonus_constitution - 100) / 50)) + 1) / 2
-        max_health_regen = (tanh(((base_constitution * total_multiplier_constitution +
-                                   total_bonus_constitution - 100) / 50)) + 1) / 2
-
-        evasion = 1 - (tanh(((base_dexterity * total_multiplier_dexterity + total_bonus_dexterity) * 0.01) - 2) + 1) / 2
-        max_evasion = 1 - (
-                tanh(((base_dexterity * total_multiplier_dexterity + total_bonus_dexterity) * 0.01) - 2) + 1) / 2
-
-        psi = base_intelligence * total_multiplier_intelligence + total_bonus_intelligence
-        max_psi = base_intelligence * total_multiplier_intelligence + total_bonus_intelligence
-
-        psi_regen = (tanh(((base_intelligence * total_multiplier_intelligence +
-                            total_bonus_intelligence - 100) / 50)) + 1) / 2
-        max_psi_regen = (tanh(((base_intelligence * total_multiplier_intelligence +
-                                total_bonus_intelligence - 100) / 50)) + 1) / 2
+        base = {'strength': base_strength, 'dexterity': base_dexterity, 'constitution': base_constitution,
+                'intelligence': base_intelligence, 'wisdom': base_wisdom, 'charisma': base_charisma}
+        bonus, multiplier = skill_totals(skills)
+        derived = derive_stats([base], [bonus], [multiplier])[0]
 
         new_entity = EntityModel(name=name, description=description, level=level,
                                  experience=experience, unassigned_stat_points=unassigned_stat_points,
                                  base_strength=base_strength, base_dexterity=base_dexterity,
                                  base_constitution=base_constitution, base_intelligence=base_intelligence,
                                  base_wisdom=base_wisdom, base_charisma=base_charisma, skills=skills,
-                                 bonus_strength=total_bonus_strength, bonus_dexterity=total_bonus_dexterity,
-                                 bonus_constitution=total_bonus_constitution,
-                                 bonus_intelligence=total_bonus_intelligence,
-                                 bonus_wisdom=total_bonus_wisdom, bonus_charisma=total_bonus_charisma,
-                                 multiplier_strength=total_multiplier_strength,
-                                 multiplier_dexterity=total_multiplier_dexterity,
-                                 multiplier_constitution=total_multiplier_constitution,
-                                 multiplier_intelligence=total_multiplier_intelligence,
-                                 multiplier_wisdom=total_multiplier_wisdom,
-                                 multiplier_charisma=total_multiplier_charisma,
-                                 health=health, max_health=max_health, health_regen=health_regen,
-                                 max_health_regen=max_health_regen, evasion=evasion, max_evasion=max_evasion,
-                                 psi=psi, max_psi=max_psi, psi_regen=psi_regen, max_psi_regen=max_psi_regen,
-                                 user_id=current_user.id
-                                 )
+                                 user_id=current_user.id, **derived)
 
         db.session.add(new_entity)
+        db.session.flush()
+        refresh_entity_attacks(EntityModel.id == new_entity.id)
         db.session.commit()
+        invalidate_user(current_user.id)
         flash('Entity created successfully')
-        return redirect(url_for('index'))
+        return redirect(url_for('site.index'))
 
-    skills = SkillModel.query.all()
+    skills = catalog.get().skills.values()
 
     return render_template('create_entity.html', skills=skills)
 
@@ -484,79 +1436,302 @@ class RemoveEntityForm(FlaskForm):
     submit = SubmitField('Remove Entity')
 
 
-@app.route('/attack', methods=['POST'])
+def publish_health_update(update):
+    """Send a health update to every game that holds one of its entities."""
+    entities = {entity['id']: entity for entity in update['entities']}
+    memberships = db.session.query(games_entities.c.game_id, games_entities.c.entity_id) \
+        .filter(games_entities.c.entity_id.in_(entities))
+
+    events = {}
+    for game_id, entity_id in memberships:
+        events.setdefault(game_id, []).append(entities[entity_id])
+    for game_id, game_entities in events.items():
+        combat_hub.publish(game_id, {'version': update['version'], 'entities': game_entities})
+
+
+def resolve_attack(game_id, defender_id, attack_type):
+    """Roll one attack of the current user's player entity, store it and publish the damage.
+
+    Returns the outcome reported to the attacker: whether it hit, the damage
+    dealt (0 on a miss), the log message and the defender's health after it.
+    Returns ``None`` when the attacker, defender or attack does not exist, or
+    when the attacker does not know the attack.
+    """
+    # Games are attacked in memory when write-behind combat state is on (see combat_state.py)
+    combat_state = current_app.extensions.get('combat_state') if game_id else None
+
+    if combat_state is not None:
+        attacker_id = cached_user_info(current_user.id)['player_entity_id']
+        combatants = combat_state.combatants(game_id, *[entity_id for entity_id in (attacker_id, defender_id)
+                                                         if entity_id is not None])
+        attacker, defender = combatants.get(attacker_id), combatants.get(defender_id)
+    else:
+        attacker = current_user.player_entity
+        defender = db.session.get(EntityModel, defender_id) if defender_id is not None else None
+
+    if not (attacker and defender and attack_type):
+        return None
+    if combat_state is not None:
+        knows_attack = attack_type.id in attacker.attack_ids
+    else:
+        knows_attack = db.session.query(db.exists().where(entity_attack.c.entity_id == attacker.id,
+                                                          entity_attack.c.attack_id == attack_type.id)).scalar()
+    if not knows_attack:
+        return None
+
+    hit, damage = roll_attack(attacker, defender, attack_type)
+    result = attack_message(attacker, defender, attack_type, hit, damage)
+    health = {'id': defender.id, 'health': defender.health, 'max_health': defender.max_health}
+
+    if combat_state is not None:
+        changed = combat_state.record(game_id, {defender.id: damage} if hit else {}, [result])
+        if changed:
+            # Not stored yet, so it carries no version and leaves the clients' delta cursor alone;
+            # the flush publishes the stored health with its version
+            combat_hub.publish(game_id, {'version': 0, 'entities': changed})
+    else:
+        def record():
+            update = apply_damage({defender.id: damage}) if hit else None
+            if game_id:
+                append_combat_log(game_id, [result])
+            return update
+
+        changed = commit_with_retry(record)
+        if changed:
+            publish_health_update(changed)
+            changed = changed['entities']
+
+    # The commit expired the defender, so its new health comes from what the write returned
+    for entity in changed or []:
+        if entity['id'] == health['id']:
+            health = {'id': entity['id'], 'health': entity['health'], 'max_health': entity['max_health']}
+
+    return {'hit': hit, 'damage': damage if hit else 0, 'message': result, 'defender': health}
+
+
+@site.route('/attack', methods=['POST'])
 @login_required
 def perform_attack():
-    attacker = current_user.player_entity
-    defender_id = request.form.get('defender_id')
-    attack_id = request.form.get('attack_id')
+    # The game page posts JSON and patches the defender's row from the reply;
+    # a plain form post is redirected back to the page
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        try:
+            defender_id, attack_id = int(payload['defender_id']), int(payload['attack_id'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'defender_id and attack_id are required'}), 400
+    else:
+        defender_id = request.form.get('defender_id', type=int)
+        attack_id = request.form.get('attack_id', type=int)
 
-    defender = EntityModel.query.get(defender_id)
-    attack_type = AttackModel.query.get(attack_id)
+    attack_type = catalog.get().attacks.get(attack_id)
+    # The admin form takes any text for the stat, and rolling the attack needs a real one
+    if attack_type is not None and attack_type.damage_modifier_stat not in STATS:
+        message = f'{attack_type.name} has an invalid damage_modifier_stat'
+        if request.is_json:
+            return jsonify({'success': False, 'message': message}), 422
+        flash(f'Error: {message}')
+        return redirect(url_for('site.game_players'))
 
-    if attacker and defender and attack:
-        result = attack(attacker, defender, attack_type)
-        db.session.commit()
-        flash(result)
+    outcome = resolve_attack(session.get('selected_game_id'), defender_id, attack_type)
 
-        if 'attack_logs' not in session:
-            session['attack_logs'] = []
+    if request.is_json:
+        if outcome is None:
+            return jsonify({'success': False,
+                            'message': 'Attacker, defender or attack not found, or the attack is not yours'}), 404
+        return jsonify({'success': True, **outcome})
 
-        session['attack_logs'].append(result)
-        session.modified = True
+    flash(outcome['message'] if outcome
+          else "Error: attacker, defender, or attack not found, or the attack is not yours")
+    return redirect(url_for('site.game_players'))
 
-        return redirect(url_for('game_players'))
-    else:
-        flash("Error: attacker, defender, or attack not found")
 
+@site.route('/attack-round', methods=['POST'])
+@login_required
+def attack_round():
+    payload = request.get_json(silent=True) or {}
+    try:
+        actions = [(int(action['attacker_id']), [int(defender_id) for defender_id in action['defender_ids']],
+                    int(action['attack_id']))
+                   for action in payload.get('actions', [])]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Each action needs attacker_id, defender_ids and attack_id'}), 400
+
+    game_id = session.get('selected_game_id')
+    if not game_id:
+        return jsonify({'success': False, 'message': 'Please select a game first'}), 400
+    # The game's creator runs its NPCs; everyone else only commands their own entity
+    creator_id = db.session.query(GameModel.creator_id).filter(GameModel.id == game_id).scalar()
+
+    def resolve():
+        results, update = resolve_round(actions, game_id, current_user.id, creator_id == current_user.id)
+        append_combat_log(game_id, [result['message'] for result in results if 'message' in result])
+        return results, update
+
+    results, update = commit_with_retry(resolve)
 
-@app.route('/login')
+    if update:
+        publish_health_update(update)
+
+    return jsonify({'success': True, 'results': results})
+
+
+@site.route('/encounter', methods=['GET'])
+@login_required
+def encounter():
+    game_id = session.get('selected_game_id')
+    current = EncounterModel.query.filter_by(game_id=game_id).first() if game_id else None
+    if current is None:
+        return jsonify({'success': False, 'message': 'No encounter is running in this game'}), 404
+    return jsonify({'success': True, 'encounter': encounter_state(current)})
+
+
+@site.route('/encounter/start', methods=['POST'])
+@login_required
+def encounter_start():
+    game_id = session.get('selected_game_id')
+    if not game_id:
+        return jsonify({'success': False, 'message': 'Please select a game first'}), 400
+    if not runs_game(game_id, current_user.id):
+        return jsonify({'success': False, 'message': "Only the game's creator can start an encounter"}), 403
+
+    started = commit_with_retry(lambda: start_encounter(game_id))
+    return jsonify({'success': True, 'encounter': encounter_state(started)})
+
+
+@site.route('/encounter/next-turn', methods=['POST'])
+@login_required
+def encounter_next_turn():
+    game_id = session.get('selected_game_id')
+    current = EncounterModel.query.filter_by(game_id=game_id).first() if game_id else None
+    if current is None:
+        return jsonify({'success': False, 'message': 'No encounter is running in this game'}), 404
+    # Players may end their own entity's turn; every other turn is the creator's to move on
+    acting_id = current.initiative[current.turn][0] if current.initiative else None
+    allowed = db.session.query(db.or_(
+        db.exists().where(EntityModel.id == acting_id, EntityModel.user_id == current_user.id),
+        db.exists().where(GameModel.id == game_id, GameModel.creator_id == current_user.id)
+    )).scalar()
+    if not allowed:
+        return jsonify({'success': False,
+                        'message': "Only the game's creator or the player whose turn it is can end the turn"}), 403
+
+    try:
+        update = commit_with_retry(lambda: advance_turn(current))
+    except TurnConflict:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'The turn already moved on',
+                        'encounter': encounter_state(current)}), 409
+
+    if update:
+        publish_health_update(update)
+    return jsonify({'success': True, 'encounter': encounter_state(current)})
+
+
+@site.route('/encounter/end', methods=['POST'])
+@login_required
+def encounter_end():
+    game_id = session.get('selected_game_id')
+    current = EncounterModel.query.filter_by(game_id=game_id).first() if game_id else None
+    if current is None:
+        return jsonify({'success': False, 'message': 'No encounter is running in this game'}), 404
+    if not runs_game(game_id, current_user.id):
+        return jsonify({'success': False, 'message': "Only the game's creator can end an encounter"}), 403
+
+    experience = (request.get_json(silent=True) or {}).get('experience')
+    if experience is not None and (not isinstance(experience, int) or isinstance(experience, bool)
+                                   or not 0 <= experience <= MAX_EXPERIENCE_AWARD):
+        return jsonify({'success': False,
+                        'message': f'experience must be a whole number from 0 to {MAX_EXPERIENCE_AWARD}'}), 400
+
+    combat_state = current_app.extensions.get('combat_state')
+    if combat_state is not None:
+        # Who is still standing depends on damage that may not be stored yet
+        combat_state.flush()
+    ended = commit_with_retry(lambda: end_encounter(current, experience))
+    if ended is None:
+        return jsonify({'success': False, 'message': 'The encounter already ended'}), 409
+
+    experience, rows = ended
+    return jsonify({
+        'success': True,
+        'experience': experience,
+        'entities': [
+            {
+                'id': row.id,
+                'name': row.name,
+                'level': row.level,
+                'experience': row.experience,
+                'unassigned_stat_points': row.unassigned_stat_points
+            }
+            for row in rows
+        ]
+    })
+
+
+@site.route('/login')
 def login():
+    from flask_dance.contrib.discord import discord
+
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('site.index'))
 
     if not discord.authorized:
-        print(1)
+        current_app.logger.debug('Not authorized with Discord, redirecting to the Discord login')
         return redirect(url_for('discord.login'))
     else:
         account_info = discord.get('/api/users/@me')
-        print("account_info:", account_info.json())  # Debugging line
+        current_app.logger.debug('Discord account lookup returned %s', account_info.status_code)
         if account_info.ok:
             user_data = account_info.json()
-            print("user_data:", user_data)  # Debugging line
             user_id = user_data['id']
             user = UserModel.query.filter_by(discord_id=user_id).first()
 
             if user is not None:
                 login_user(user)
                 flash("Logged in successfully.", category="success")
-                return redirect(url_for('index'))
+                return redirect(url_for('site.index'))
             else:
                 flash("Error: user not found in the database.", category="error")
                 return redirect(url_for('discord.login'))
         else:
             flash("Error: could not fetch user information from Discord.", category="error")
-            return redirect(url_for('login'))
+            return redirect(url_for('site.login'))
 
     return render_template('login.html')
 
 
-@oauth_authorized.connect_via(discord_blueprint)
+def guilds_fresh(user):
+    return user.guilds_refreshed_at is not None and \
+        user.guilds_refreshed_at > datetime.utcnow() - timedelta(seconds=GUILD_CACHE_TTL)
+
+
+def store_guilds(user, guilds_data):
+    """Replace the stored guild membership of ``user`` with ``guilds_data`` from Discord. The caller commits."""
+    db.session.execute(user_guilds.delete().where(user_guilds.c.user_id == user.id))
+    guild_ids = {guild['id'] for guild in guilds_data}
+    if guild_ids:
+        db.session.execute(user_guilds.insert(), [{'user_id': user.id, 'guild_id': guild_id} for guild_id in guild_ids])
+    user.guilds_refreshed_at = datetime.utcnow()
+    current_app.logger.debug('Discord user %s is in %d guilds', user.discord_id, len(guild_ids))
+
+
 def discord_logged_in(blueprint, token):
-    resp = blueprint.session.get('/api/users/@me')
-    print(resp)
-    if not resp.ok:
+    # The cookie only names the user who last logged in here. When their stored
+    # guilds are still fresh only the profile is fetched; otherwise the profile
+    # and the guilds are fetched at the same time.
+    known = db.session.get(UserModel, session['user_id']) if 'user_id' in session else None
+    paths = ['/api/users/@me']
+    if known is None or not guilds_fresh(known):
+        paths.append('/api/users/@me/guilds')
+    try:
+        user_data, *guilds_data = discord_api.get_many(token, *paths)
+        guilds_data = guilds_data[0] if guilds_data else None
+    except DiscordError as error:
+        current_app.logger.warning('%s', error)
         flash('Failed to fetch user information from Discord')
         return False
-    user_data = resp.json()
-    print("user_data:", user_data)  # Debugging line
-
-    # Fetch the user's guilds
-    guilds_resp = blueprint.session.get('/api/users/@me/guilds')
-    if not guilds_resp.ok:
-        flash('Failed to fetch user guilds from Discord')
-        return False
-    guilds_data = guilds_resp.json()
+    current_app.logger.debug('Discord user %s authorized', user_data['id'])
 
     # Check if the user already exists in the database
     user = UserModel.query.filter_by(discord_id=user_data['id']).first()
@@ -570,39 +1745,71 @@ def discord_logged_in(blueprint, token):
             avatar_url=f"https://cdn.discordapp.com/avatars/{user_data['id']}/{user_data['avatar']}.png"
         )
         db.session.add(user)
-        db.session.commit()
+        db.session.flush()
+
+    if guilds_data is None and not guilds_fresh(user):
+        # The cookie named someone else, so this user's guilds were not fetched yet
+        try:
+            guilds_data = discord_api.get('/api/users/@me/guilds', token)
+        except DiscordError as error:
+            current_app.logger.warning('%s', error)
+    if guilds_data is not None:
+        store_guilds(user, guilds_data)
+    db.session.commit()
+    invalidate_user(user.id)
 
     # You can store the user's ID in the session to keep them logged in
     session['user_id'] = user.id
+    session.pop('guild_id', None)
+    login_user(user)
 
-    if guilds_data:
-        # Store the first guild's ID in the session
-        print(guilds_data)
-        session['guild_id'] = [guild['id'] for guild in guilds_data]
 
+@site.route('/refresh-guilds', methods=['POST'])
+@login_required
+def refresh_guilds():
+    token = current_app.blueprints['discord'].token
+    if not token:
+        flash('Log in with Discord again to refresh your servers.')
+        return redirect(url_for('site.index'))
+    try:
+        guilds_data = discord_api.get('/api/users/@me/guilds', token)
+    except DiscordError as error:
+        current_app.logger.warning('%s', error)
+        flash('Failed to fetch user guilds from Discord')
+        return redirect(url_for('site.index'))
+
+    user = db.session.get(UserModel, current_user.id)
+    store_guilds(user, guilds_data)
+    db.session.commit()
+    invalidate_user(user.id)
+    flash('Your Discord servers were refreshed.')
+    return redirect(url_for('site.index'))
 
-@app.route('/login/discord/authorized')
+
+@site.route('/login/discord/authorized')
 def authorized():
+    from flask_dance.contrib.discord import discord
+
     resp = discord.authorized_response()
-    print(resp)
+    current_app.logger.debug('Discord authorization %s', 'failed' if resp is None else 'succeeded')
     if resp is None or resp.get('access_token') is None:
         flash('Access denied: reason=%s error=%s' % (
             request.args['error'],
             request.args['error_description']
         ))
-        return redirect(url_for('login'))
+        return redirect(url_for('site.login'))
 
     session['discord_token'] = (resp['access_token'], '')
     user_data = discord.get('/users/@me').data
-    print(user_data)
+    current_app.logger.debug('Discord user %s authorized', user_data.get('id') if user_data else None)
 
     # Add your logic for handling user_data here
     # (e.g., storing it in the database, creating a session, etc.)
 
-    return redirect(url_for('index'))  # Replace 'dashboard' with the desired route after successful login
+    return redirect(url_for('site.index'))  # Replace 'dashboard' with the desired route after successful login
 
 
-@app.route('/create-game', methods=['GET', 'POST'])
+@site.route('/create-game', methods=['GET', 'POST'])
 @login_required
 def create_game():
     form = CreateGameForm()
@@ -616,41 +1823,60 @@ def create_game():
 
         if existing_game:
             flash('A game with that name already exists')
-            return redirect(url_for('create_game'))
+            return redirect(url_for('site.create_game'))
 
         # Create the new game and add the creator as a player
         game = GameModel(game_name=game_name, creator_id=current_user.id, discord_guild_id=guild_id)
         game.players.append(current_user)
         db.session.add(game)
         db.session.commit()
+        invalidate_user(current_user.id)
 
         flash('Game created successfully')
-        return redirect(url_for('index'))
+        return redirect(url_for('site.index'))
 
     return render_template('create_game.html', form=form)
 
 
-@app.route('/logout')
+@site.route('/logout')
 def logout():
     if 'user_id' in session:
         session.pop('user_id', None)
     logout_user()
-    return redirect(url_for('admin'))
+    return redirect(url_for('site.admin'))
 
 
-@app.route('/select-game', methods=['POST'])
+@site.route('/select-game', methods=['POST'])
 @login_required
 def select_game():
-    game_id = request.form.get('game_id')
+    game_id = request.form.get('game_id', type=int)
     if game_id:
-        session['selected_game_id'] = int(game_id)
-        return redirect(url_for('game_players'))
+        game = visible_games(current_user.id).filter(GameModel.id == game_id).first()
+        if game is None:
+            flash("That game is not in one of your Discord servers")
+            return redirect(url_for('site.index'))
+        # Opening a game of one of your servers joins it. The cached game ids can
+        # be stale, so the insert itself skips a membership that already exists.
+        if game_id not in cached_user_info(current_user.id)['game_ids']:
+            membership = db.select(db.literal(current_user.id), db.literal(game_id)).where(~db.exists().where(
+                players_games.c.user_id == current_user.id, players_games.c.game_id == game_id))
+            try:
+                joined = db.session.execute(players_games.insert().from_select(['user_id', 'game_id'], membership))
+                if joined.rowcount:
+                    bump_game_version(game)
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent request joined first
+                db.session.rollback()
+            invalidate_user(current_user.id)
+        session['selected_game_id'] = game_id
+        return redirect(url_for('site.game_players'))
     else:
         flash('Please select a game')
-        return redirect(url_for('index'))
+        return redirect(url_for('site.index'))
 
 
-@app.route('/add_entity_by_id', methods=['POST'])
+@site.route('/add_entity_by_id', methods=['POST'])
 @login_required
 def add_entity_by_id():
     game_id = session.get('selected_game_id')
@@ -661,9 +1887,10 @@ def add_entity_by_id():
             entity = EntityModel.query.get(entity_id)
             if entity:
                 game.entities.append(entity)
+                bump_game_version(game)
                 db.session.commit()
                 flash('Entity added successfully')
-                return redirect(url_for('game_players'))
+                return redirect(url_for('site.game_players'))
             else:
                 flash('Entity not found')
                 return jsonify({'success': False, 'message': 'Entity not found'})
@@ -675,7 +1902,7 @@ def add_entity_by_id():
         return jsonify({'success': False, 'message': 'Please select a game first'})
 
 
-@app.route('/remove_entity_by_id', methods=['POST'])
+@site.route('/remove_entity_by_id', methods=['POST'])
 @login_required
 def remove_entity_by_id():
     game_id = session.get('selected_game_id')
@@ -686,6 +1913,7 @@ def remove_entity_by_id():
             entity = EntityModel.query.get(entity_id)
             if entity:
                 game.entities.remove(entity)
+                bump_game_version(game)
                 db.session.commit()
                 flash('Entity removed successfully')
                 return jsonify({'success': True, 'message': 'Entity removed'})
@@ -700,31 +1928,53 @@ def remove_entity_by_id():
         return jsonify({'success': False, 'message': 'Please select a game first'})
 
 
-@app.route('/game-players')
+@site.route('/game-players')
 @login_required
 def game_players():
     game_id = session.get('selected_game_id')
     if game_id:
-        game = GameModel.query.get(game_id)
-        if game:
-            players = game.get_players()
-            entities = game.entities
-            player_entity = EntityModel.query.filter_by(user_id=current_user.id).first()
-            attack_logs = session.get('attack_logs', [])
+        # One query reads the game and the versions of everything the page shows
+        row = db.session.query(GameModel, game_health_version(game_id), combat_log_version(game_id),
+                               db.select(db.func.max(EntityModel.id)).scalar_subquery()) \
+            .filter(GameModel.id == game_id).first()
+        if row:
+            game, entities_version, log_version, roster_version = row
+            entities_version = entities_version or 0
+            catalog_version = catalog.get().version
+            player_entity_id = cached_user_info(current_user.id)['player_entity_id']
+            etag = page_etag(current_user.id, game.id, game.version, entities_version, log_version, roster_version,
+                             catalog_version, player_entity_id, csrf_version())
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+
+            # Every row offers the same attacks; the template renders them once per
+            # catalog version and only calls this when that fragment is not cached
+            def player_attacks():
+                if player_entity_id is None:
+                    return []
+                attack_ids = db.session.query(entity_attack.c.attack_id) \
+                    .filter(entity_attack.c.entity_id == player_entity_id).order_by(entity_attack.c.attack_id)
+                attacks = catalog.get().attacks
+                return [attacks[attack_id] for (attack_id,) in attack_ids if attack_id in attacks]
+
+            # Only the newest page is rendered; older entries are fetched from /game-log
+            attack_logs = list(reversed(combat_log_page(game.id)))
 
             form = AddEntityForm()
-            form.entity.choices = [(entity.id, entity.name) for entity in EntityModel.query.all() if
-                                   entity.user_id is None]
+            form.entity.choices = db.session.query(EntityModel.id, EntityModel.name) \
+                .filter(EntityModel.user_id.is_(None)).all()
 
             remove_form = RemoveEntityForm()
-            remove_form.entity.choices = [(entity.id, entity.name) for entity in game.entities if
-                                          entity.user_id is None]
+            remove_form.entity.choices = db.session.query(EntityModel.id, EntityModel.name) \
+                .join(games_entities, games_entities.c.entity_id == EntityModel.id) \
+                .filter(games_entities.c.game_id == game.id, EntityModel.user_id.is_(None)).all()
 
             if form.validate_on_submit():
                 entity_id = form.entity.data
                 entity = EntityModel.query.get(entity_id)
                 if entity:
                     game.entities.append(entity)
+                    bump_game_version(game)
                     db.session.commit()
                     flash('Entity added successfully')
                 else:
@@ -735,51 +1985,323 @@ def game_players():
                 entity = EntityModel.query.get(entity_id)
                 if entity:
                     game.entities.remove(entity)
+                    bump_game_version(game)
                     db.session.commit()
                     flash('Entity removed successfully')
                 else:
                     flash('Entity not found')
 
-            return render_template('game_players.html', players=players, attack_logs=attack_logs,
-                                   player_entity=player_entity, entities=entities, form=form, remove_form=remove_form)
+            response = make_response(render_template(
+                'game_players.html', game=game, attack_logs=attack_logs, player_entity_id=player_entity_id,
+                player_attacks=player_attacks, catalog_version=catalog_version, roster_version=roster_version,
+                form=form, remove_form=remove_form, entities_version=entities_version))
+            return revalidated(response, etag)
         else:
             flash('Game not found')
-            return redirect(url_for('index'))
+            return redirect(url_for('site.index'))
     else:
         flash('Please select a game first')
-        return redirect(url_for('index'))
-
-
-@app.route('/get_updated_data')
-def get_updated_data():
-    # Query the updated data from your database (e.g., entities with their health)
-    entities = [
-        {
-            'id': entity.id,
-            'name': entity.name,
-            'health': entity.health,
-            'max_health': entity.max_health
-        }
-        for entity in EntityModel.query.all()
-    ]
+        return redirect(url_for('site.index'))
 
-    # Return the data as JSON
-    return jsonify({'entities': entities})
 
+@site.route('/game-updates')
+@login_required
+def game_updates():
+    game_id = session.get('selected_game_id')
+    if not game_id:
+        return jsonify({'success': False, 'message': 'Please select a game first'}), 400
+
+    # The client sends back the highest version it has seen; only rows of the
+    # selected game that changed after that are returned.
+    since = request.args.get('since', 0, type=int)
+    changed = db.session.query(EntityModel.id, EntityModel.name, EntityModel.health,
+                               EntityModel.max_health, EntityModel.health_version) \
+        .join(games_entities, games_entities.c.entity_id == EntityModel.id) \
+        .filter(games_entities.c.game_id == game_id, EntityModel.health_version > since) \
+        .all()
+
+    if not changed:
+        response = current_app.response_class(status=304)
+    else:
+        entities = [
+            {
+                'id': entity.id,
+                'name': entity.name,
+                'health': entity.health,
+                'max_health': entity.max_health
+            }
+            for entity in changed
+        ]
+        version = max(entity.health_version for entity in changed)
+        response = jsonify({'version': version, 'entities': entities})
+
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@site.route('/game-log')
+@login_required
+def game_log():
+    game_id = session.get('selected_game_id')
+    if not game_id:
+        return jsonify({'success': False, 'message': 'Please select a game first'}), 400
+
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', COMBAT_LOG_PAGE_SIZE, type=int), 100))
+    entries = combat_log_page(game_id, before=before, limit=limit)
+
+    return jsonify({
+        'entries': [
+            {
+                'id': entry.id,
+                'message': entry.message,
+                'created_at': entry.created_at.isoformat()
+            }
+            for entry in entries
+        ],
+        # Cursor for the next (older) page, None once the start of the log is reached
+        'before': entries[-1].id if len(entries) == limit else None
+    })
+
+
+@site.route('/game-events')
+@login_required
+def game_events():
+    game_id = session.get('selected_game_id')
+    if not game_id:
+        return jsonify({'success': False, 'message': 'Please select a game first'}), 400
 
-@app.route('/')
+    response = Response(combat_hub.stream(game_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@site.route('/metrics')
+@login_required
+def metrics_report():
+    """Cache hit ratios, plus per-route latency and SQL usage when METRICS_ENABLED is set."""
+    return jsonify({
+        'enabled': current_app.config['METRICS_ENABLED'],
+        'routes': request_metrics.snapshot() if current_app.config['METRICS_ENABLED'] else None,
+        'caches': {
+            'user_cache': user_cache.stats(),
+            'catalog': catalog.stats(),
+            'fragments': current_app.jinja_env.fragment_cache.stats()
+        },
+        'combat_state': current_app.extensions['combat_state'].stats()
+        if 'combat_state' in current_app.extensions else None
+    })
+
+
+@site.route('/')
 def index():
     if current_user.is_authenticated:
-        games = current_user.games.all()
-        entities = EntityModel.query.filter(EntityModel.user_id.is_(None)).all()
-        player_entity = current_user.player_entity
-        return render_template('index.html', games=games, entities=entities, player_entity=player_entity)
+        games = visible_games(current_user.id).order_by(GameModel.id).all()
+        return render_template('index.html', games=games)
     else:
-        return redirect(url_for('login'))
-
+        return redirect(url_for('site.login'))
+
+
+@site.cli.command('upgrade-db')
+def upgrade_db():
+    """Apply pending schema migrations."""
+    version = migrations.upgrade(db.engine)
+    print(f'Database is at schema version {version}')
+
+
+@site.cli.command('check-db')
+def check_db():
+    """Print the active database settings; exit non-zero if any need attention."""
+    report, warnings = check_database()
+    for name, value in report.items():
+        print(f'{name}: {value}')
+    for warning in warnings:
+        print(f'warning: {warning}')
+    if warnings:
+        raise SystemExit(1)
+
+
+@site.cli.command('import-content')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--kind', type=click.Choice(KINDS), help='Kind of content in a CSV file.')
+def import_content_command(path, kind):
+    """Import attacks, skills and entities from a .jsonl or .csv file."""
+    fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+    with open(path, 'rb') as stream:
+        try:
+            created = import_content(read_rows(stream, fmt, kind))
+        except ContentError as error:
+            db.session.rollback()
+            raise click.ClickException(str(error))
+    db.session.commit()
+    print(', '.join(f'{count} {kind}' for kind, count in created.items()) + ' imported')
+
+
+@site.cli.command('export-content')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default='jsonl')
+@click.option('--kind', type=click.Choice(KINDS), help='Only export this kind; required for CSV.')
+def export_content_command(fmt, kind):
+    """Write attacks, skills and non-player entities to stdout."""
+    if fmt == 'csv' and kind is None:
+        raise click.UsageError('CSV exports need --kind')
+    for text in write_rows(export_content([kind] if kind else KINDS), fmt, kind):
+        click.echo(text, nl=False)
+
+
+@site.cli.command('simulate')
+@click.option('--side-a', 'side_a_ids', type=int, multiple=True, required=True, help='Entity id; repeat for more.')
+@click.option('--side-b', 'side_b_ids', type=int, multiple=True, required=True, help='Entity id; repeat for more.')
+@click.option('--trials', type=int, default=100000, show_default=True)
+@click.option('--max-rounds', type=int, default=100, show_default=True)
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--processes', type=int, default=os.cpu_count(), show_default=True)
+@click.option('--damage-scale', type=float, multiple=True, help="Scale side A's damage; repeat to sweep.")
+@click.option('--accuracy-scale', type=float, multiple=True, help="Scale side A's accuracy; repeat to sweep.")
+def simulate_command(side_a_ids, side_b_ids, trials, max_rounds, seed, processes, damage_scale, accuracy_scale):
+    """Simulate encounters between two sides and print win rates and time to kill."""
+    snapshot = catalog.get()
+    entities = {entity.id: entity for entity in EntityModel.query.filter(EntityModel.id.in_(side_a_ids + side_b_ids))}
+    attacks = {}
+    for entity_id, attack_id in db.session.query(entity_attack.c.entity_id, entity_attack.c.attack_id) \
+            .filter(entity_attack.c.entity_id.in_(entities)).order_by(entity_attack.c.attack_id):
+        if attack_id in snapshot.attacks:
+            attacks.setdefault(entity_id, []).append(snapshot.attacks[attack_id])
+    missing = [str(entity_id) for entity_id in side_a_ids + side_b_ids if entity_id not in entities]
+    if missing:
+        raise click.ClickException(f"No entity with id {', '.join(missing)}")
+
+    def side(entity_ids, damage=1.0, accuracy=1.0):
+        try:
+            return [simulator.combatant(entities[entity_id], attacks.get(entity_id, []), damage, accuracy)
+                    for entity_id in entity_ids]
+        except ValueError as error:
+            raise click.ClickException(str(error))
+
+    def rounds(value):
+        return '-' if value is None else f'{value:.1f}'
+
+    side_b = side(side_b_ids)
+    print(f"{'damage':>7} {'accuracy':>8} {'A wins':>7} {'B wins':>7} {'draws':>6} "
+          f"{'A ttk':>6} {'A p95':>6} {'B ttk':>6} {'B p95':>6} {'rounds/s':>10}")
+    for damage in damage_scale or (1.0,):
+        for accuracy in accuracy_scale or (1.0,):
+            start = time.perf_counter()
+            result = simulator.simulate(side(side_a_ids, damage, accuracy), side_b, trials,
+                                        max_rounds=max_rounds, seed=seed, processes=processes)
+            elapsed = time.perf_counter() - start
+            print(f"{damage:>7g} {accuracy:>8g} {result.win_rate('a'):>7.1%} {result.win_rate('b'):>7.1%} "
+                  f"{result.draw_rate:>6.1%} {rounds(result.mean_time_to_kill('a')):>6} "
+                  f"{rounds(result.time_to_kill_percentile('a', 95)):>6} "
+                  f"{rounds(result.mean_time_to_kill('b')):>6} "
+                  f"{rounds(result.time_to_kill_percentile('b', 95)):>6} {result.rounds / elapsed:>10.0f}")
+
+
+def log_database_check(app):
+    with app.app_context():
+        report, warnings = check_database()
+    app.logger.info('Database settings: %s', ', '.join(f'{name}={value}' for name, value in report.items()))
+    for warning in warnings:
+        app.logger.warning('Database check: %s', warning)
+
+
+def create_app(config=None):
+    """Build the site's Flask application, with ``config`` overriding the settings read from the environment.
+
+    Importing this module only defines the models and views; the extensions,
+    the Discord login blueprint and the database engine are set up here.
+    ``gunicorn --preload 'app:create_app()'`` therefore builds the app once
+    in the master and its workers share that memory copy-on-write, while
+    each worker still opens database connections of its own (see
+    ``database.dispose_after_fork``).
+    """
+    from flask_dance.consumer import oauth_authorized
+    from flask_dance.contrib.discord import make_discord_blueprint
+
+    os.environ.setdefault("OAUTHLIB_RELAX_TOKEN_SCOPE", "0")
+    os.environ.setdefault("OAUTHLIB_IGNORE_SCOPE_CHANGE", "0")
+
+    app = Flask(__name__)
+    app.secret_key = os.environ.get('SECRET_KEY')
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get('DATABASE_URL', 'sqlite:///project.db')
+
+    # Per-route latency and SQL metrics, reported on /metrics, cost a little on
+    # every request and are off unless METRICS_ENABLED is set
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+    app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))
+
+    # Write-behind combat state for busy games (see combat_state.py), off unless HOT_COMBAT_STATE is set
+    app.config['HOT_COMBAT_STATE'] = os.environ.get('HOT_COMBAT_STATE', '').lower() in ('1', 'true', 'yes')
+    app.config['HOT_COMBAT_FLUSH_SECONDS'] = float(os.environ.get('HOT_COMBAT_FLUSH_SECONDS', 1.0))
+    app.config['HOT_COMBAT_JOURNAL'] = os.environ.get('HOT_COMBAT_JOURNAL',
+                                                      os.path.join(app.instance_path, 'combat-journal'))
+    # Also survive the machine going down, at the cost of an fsync per attack
+    app.config['HOT_COMBAT_FSYNC'] = os.environ.get('HOT_COMBAT_FSYNC', '').lower() in ('1', 'true', 'yes')
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          database.engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    # Debug records are sampled so a busy worker does not drown in them
+    app.logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    app.logger.addFilter(SamplingFilter(float(os.environ.get('LOG_SAMPLE_RATE', 1.0)), logging.DEBUG))
+
+    # Rendered template fragments, keyed by the versions of what they show (see fragments.py)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache = TTLCache(ttl=int(os.environ.get('FRAGMENT_CACHE_TTL', 600)),
+                                            max_size=int(os.environ.get('FRAGMENT_CACHE_SIZE', 1000)))
+
+    # Set up Discord OAuth2 with Flask-Dance, using your Discord app's client id and secret
+    discord_blueprint = make_discord_blueprint(
+        client_id=os.environ.get('DISCORD_CLIENT_ID'),
+        client_secret=os.environ.get('DISCORD_CLIENT_SECRET'),
+        scope=["identify", "guilds"],
+        redirect_url=os.environ.get('DISCORD_REDIRECT_URI'),  # Update with your app's URL
+    )
+    discord_blueprint.base_url = DISCORD_API_URL + '/'
+    discord_blueprint.authorization_url = DISCORD_API_URL + '/api/oauth2/authorize'
+    discord_blueprint.token_url = DISCORD_API_URL + '/api/oauth2/token'
+    oauth_authorized.connect(discord_logged_in, sender=discord_blueprint)
+    app.register_blueprint(discord_blueprint, url_prefix="/login")
+    app.register_blueprint(site)
+
+    db.init_app(app)
+    with app.app_context():
+        database.install(db.engine)
+        database.dispose_after_fork(db.engine)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+
+    combat_hub.start()
+    user_cache_invalidation.start(lambda user_id, _: user_cache.invalidate(user_id))
+
+    if app.config['HOT_COMBAT_STATE']:
+        combat_state = CombatState(load_combatants, store_combat, forget_combat_journal,
+                                   app.config['HOT_COMBAT_JOURNAL'], interval=app.config['HOT_COMBAT_FLUSH_SECONDS'],
+                                   fsync=app.config['HOT_COMBAT_FSYNC'], context=app.app_context)
+        # Attacks a crashed process acknowledged but never stored go in before anything is served
+        recovered = combat_state.recover()
+        if recovered:
+            app.logger.warning('Replayed %d combat journal batches left behind by stopped processes', recovered)
+        app.extensions['combat_state'] = combat_state
+
+    # Report the database settings once at startup, so a misconfigured deployment shows up in the logs
+    if os.environ.get('DB_SELF_CHECK', '1') != '0':
+        log_database_check(app)
+
+    if app.debug:
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '0'
+    return app
+
+
+def __getattr__(name):
+    # `gunicorn app:app`, `flask --app app` and `from app import app` get a
+    # default application, built the first time it is asked for
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-if app.debug:
-    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '0'
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=True)
+    create_app().run(host='0.0.0.0', debug=True)
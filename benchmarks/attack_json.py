@@ -0,0 +1,146 @@
+"""Compare an attack posted as a form, then the page re-rendered, with the JSON attack the game page sends.
+
+Seeds one game into a scratch SQLite database. A form attack is what the
+page cost before it patched rows itself: POST /attack, then the GET of
+/game-players the redirect leads to, which has to render every entity row
+again because a health changed. A JSON attack is the POST alone. For both,
+the median time, SQL statements and response bytes per attack are printed.
+
+Every JSON reply is checked against the database: the defender's health it
+reports must be the stored one, and a hit must report the damage the
+defender lost. Unknown ids and missing fields must get a JSON 404 or 400,
+an attack the attacker does not know a JSON 404, an attack whose
+damage_modifier_stat is not a stat a JSON 422, and the same mistakes
+posted as a form a redirect. Exits non-zero otherwise.
+
+    python benchmarks/attack_json.py --players 20 --npcs 500 --skills 50 --attacks 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--npcs', type=int, default=500)
+    parser.add_argument('--skills', type=int, default=50)
+    parser.add_argument('--attacks', type=int, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'attacks.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DB_SELF_CHECK'] = '0'
+
+    from app import (AttackModel, EntityModel, UserModel, app, bump_catalog_version, catalog, db, entity_attack,
+                     games_entities)
+    from seed import seed
+
+    statements = []
+    with app.app_context():
+        db.create_all()
+        (game_id,), user_ids = seed(players=args.players, npcs=args.npcs, skills=args.skills)
+        player_entity_id = db.session.get(UserModel, user_ids[0]).player_entity.id
+        attack_ids = [attack_id for (attack_id,) in db.session.query(entity_attack.c.attack_id)
+                      .filter(entity_attack.c.entity_id == player_entity_id)]
+        npc_ids = [entity_id for (entity_id,) in db.session.query(EntityModel.id)
+                   .join(games_entities, games_entities.c.entity_id == EntityModel.id)
+                   .filter(games_entities.c.game_id == game_id, EntityModel.user_id.is_(None))]
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *rest: statements.append(statement))
+    if not attack_ids:
+        print('The seeded player has no attacks; raise --skills')
+        return 1
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_ids[0])
+        session['_fresh'] = True
+        session['selected_game_id'] = game_id
+    # Warm the user and catalog caches
+    client.get('/game-players')
+
+    def form_attack(defender_id, attack_id):
+        response = client.post('/attack', data={'defender_id': defender_id, 'attack_id': attack_id})
+        page = client.get(response.headers['Location'])
+        return response.status_code == 302 and page.status_code == 200, len(response.data) + len(page.data)
+
+    def json_attack(defender_id, attack_id):
+        response = client.post('/attack', json={'defender_id': defender_id, 'attack_id': attack_id})
+        return response.status_code == 200, len(response.data)
+
+    status = 0
+    print(f"{'attack':>7} {'ms':>8} {'queries':>8} {'bytes':>8}")
+    for label, send in (('form', form_attack), ('json', json_attack)):
+        samples, counts, sizes = [], [], []
+        for number in range(args.attacks):
+            statements.clear()
+            start = time.perf_counter()
+            ok, size = send(npc_ids[number % len(npc_ids)], attack_ids[number % len(attack_ids)])
+            samples.append(time.perf_counter() - start)
+            counts.append(len(statements))
+            sizes.append(size)
+            if not ok:
+                print(f'FAIL: a {label} attack was not accepted')
+                return 1
+        print(f'{label:>7} {statistics.median(samples) * 1000:>8.2f} {statistics.mean(counts):>8.2f} '
+              f'{statistics.median(sizes):>8.0f}')
+
+    wrong = 0
+    for number in range(args.attacks):
+        defender_id = npc_ids[number % len(npc_ids)]
+        with app.app_context():
+            before = db.session.get(EntityModel, defender_id).health
+        reply = client.post('/attack', json={'defender_id': defender_id,
+                                             'attack_id': attack_ids[number % len(attack_ids)]}).get_json()
+        with app.app_context():
+            after = db.session.get(EntityModel, defender_id).health
+        expected_loss = min(reply['damage'], before) if reply['hit'] and before > 0 else 0
+        wrong += (reply['defender']['id'] != defender_id or reply['defender']['health'] != after
+                  or abs(before - after - expected_loss) > 1e-9)
+    if wrong:
+        print(f'FAIL: {wrong} JSON replies did not match the stored health')
+        status = 1
+
+    with app.app_context():
+        # The admin form accepts any text for the stat
+        broken = AttackModel(name='Broken', description='Bad stat', damage_modifier_stat='Strength',
+                             damage_modifier_multiplier=1.0, accuracy=1.0, damage=1.0, number_of_targets=1)
+        db.session.add(broken)
+        bump_catalog_version()
+        db.session.commit()
+        catalog.reset()
+        broken_id = broken.id
+        unknown_id = db.session.query(AttackModel.id).filter(AttackModel.id.notin_(attack_ids),
+                                                             AttackModel.id != broken_id).limit(1).scalar()
+        # Only a known attack reaches the stat check
+        db.session.execute(entity_attack.insert().values(entity_id=player_entity_id, attack_id=broken_id))
+        db.session.commit()
+
+    errors = [
+        ('JSON invalid stat', client.post('/attack', json={'defender_id': npc_ids[0], 'attack_id': broken_id}), 422),
+        ('form invalid stat', client.post('/attack', data={'defender_id': npc_ids[0], 'attack_id': broken_id}), 302),
+        ('JSON unknown defender', client.post('/attack', json={'defender_id': -1, 'attack_id': attack_ids[0]}), 404),
+        ('JSON unknown attack', client.post('/attack', json={'defender_id': npc_ids[0], 'attack_id': -1}), 404),
+        ('JSON attack not known', client.post('/attack', json={'defender_id': npc_ids[0], 'attack_id': unknown_id}),
+         404),
+        ('JSON missing fields', client.post('/attack', json={'defender_id': npc_ids[0]}), 400),
+        ('form unknown ids', client.post('/attack', data={'defender_id': -1, 'attack_id': -1}), 302),
+    ]
+    print(f"\n{'request':>22} {'status':>7}")
+    for label, response, expected in errors:
+        print(f'{label:>22} {response.status_code:>7}')
+        if response.status_code != expected or (expected != 302 and response.get_json()['success'] is not False):
+            print(f'FAIL: {label} should get {expected}')
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
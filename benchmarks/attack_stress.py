@@ -0,0 +1,136 @@
+"""Fire thousands of simultaneous attacks at one entity and check no damage is lost.
+
+Creates a scratch SQLite database holding one defender that cannot dodge
+and one player per worker armed with an attack that always hits for a fixed
+amount. Every worker process runs several threads that POST /attack as fast
+as they can, then the defender's health is compared with its starting
+health minus the damage of every successful attack. Exits non-zero when
+they differ.
+
+    python benchmarks/attack_stress.py --processes 4 --threads 8 --attacks 4000
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def prepare(health, damage, players):
+    from app import AttackModel, EntityModel, GameModel, UserModel, db, entity_attack
+    from stats import STATS
+
+    def entity(name, user_id=None):
+        return EntityModel(name=name, description='Stress', level=1, experience=0, unassigned_stat_points=0,
+                           user_id=user_id, health=health, max_health=health, evasion=1.0, max_evasion=1.0,
+                           **{f'{kind}_{stat}': value for stat in STATS
+                              for kind, value in (('base', 10.0), ('bonus', 0.0), ('multiplier', 1.0),
+                                                  ('effective', 10.0))})
+
+    db.create_all()
+    attack = AttackModel(name='Sure Strike', description='Stress', damage_modifier_stat='strength',
+                         damage_modifier_multiplier=0.0, accuracy=1.0, damage=damage, number_of_targets=1)
+    game = GameModel(game_name='Stress test')
+    defender = entity('Target')
+    game.entities.append(defender)
+    db.session.add_all([attack, game])
+
+    user_ids = []
+    for number in range(players):
+        user = UserModel(discord_id=str(10 ** 17 + number), username=f'attacker{number}', discriminator='0001')
+        db.session.add(user)
+        db.session.flush()
+        attacker = entity(f'Attacker {number}', user.id)
+        game.entities.append(attacker)
+        db.session.flush()
+        db.session.execute(entity_attack.insert().values(entity_id=attacker.id, attack_id=attack.id))
+        user_ids.append(user.id)
+    db.session.commit()
+    return game.id, defender.id, attack.id, user_ids
+
+
+def run_worker(job):
+    """Send ``attacks`` attacks from one process over ``threads`` clients; return the success count."""
+    user_id, game_id, defender_id, attack_id, attacks, threads = job
+    from app import app, db
+
+    # Connections inherited from the parent must not be shared with it
+    with app.app_context():
+        db.engine.dispose()
+
+    succeeded = []
+    lock = threading.Lock()
+
+    def fire(count):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+            session['selected_game_id'] = game_id
+        done = 0
+        for _ in range(count):
+            response = client.post('/attack', data={'defender_id': defender_id, 'attack_id': attack_id})
+            if response.status_code == 302:
+                done += 1
+        with lock:
+            succeeded.append(done)
+
+    shares = [attacks // threads + (1 if index < attacks % threads else 0) for index in range(threads)]
+    workers = [threading.Thread(target=fire, args=(share,)) for share in shares]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(succeeded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--attacks', type=int, default=4000, help='attacks in total, across every process')
+    parser.add_argument('--damage', type=float, default=1.0)
+    parser.add_argument('--health', type=float, default=10 ** 9,
+                        help='starting health; set it below attacks * damage to exercise the clamp at zero')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'stress.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+    from app import EntityModel, app, db
+
+    with app.app_context():
+        game_id, defender_id, attack_id, user_ids = prepare(args.health, args.damage, args.processes)
+
+    shares = [args.attacks // args.processes + (1 if index < args.attacks % args.processes else 0)
+              for index in range(args.processes)]
+    jobs = [(user_id, game_id, defender_id, attack_id, share, args.threads)
+            for user_id, share in zip(user_ids, shares)]
+
+    start = time.perf_counter()
+    with multiprocessing.get_context('fork').Pool(args.processes) as pool:
+        succeeded = sum(pool.map(run_worker, jobs))
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        health = db.session.get(EntityModel, defender_id).health
+
+    expected = max(args.health - succeeded * args.damage, 0)
+    print(f'{succeeded}/{args.attacks} attacks succeeded in {elapsed:.2f}s ({succeeded / elapsed:.0f}/s)')
+    print(f'health {args.health:g} -> {health:g}, expected {expected:g}')
+    if health != expected:
+        print(f'FAIL: {health - expected:g} damage lost')
+        return 1
+    if succeeded != args.attacks:
+        print(f'FAIL: {args.attacks - succeeded} attacks did not go through')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Check that admin catalog pages cost the same however large the catalog is.
+
+Seeds catalogs of increasing size into a scratch SQLite database and times
+/admin with cold fragments, the first page of /admin/catalog/entity, and a
+page deep in the listing for each sort. The deep page is reached with the
+cursor the listing hands out, so it is timed exactly as a client sees it.
+For the first size, every sort and order is walked to the end, checking
+that each row comes back exactly once and in order. The statement count of
+every request is printed, so SQL growing with the catalog is easy to spot.
+
+    python benchmarks/catalog_listing.py --sizes 1000 10000 100000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'catalog.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DB_SELF_CHECK'] = '0'
+
+    from app import CATALOG_LISTINGS, EntityModel, app, db, entity_skill
+    from seed import seed
+
+    statements = []
+    with app.app_context():
+        db.create_all()
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *rest: statements.append(statement))
+    client = app.test_client()
+
+    def timed(path, prepare=lambda: None):
+        samples = []
+        for _ in range(args.repeat):
+            prepare()
+            statements.clear()
+            start = time.perf_counter()
+            response = client.get(path)
+            samples.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise SystemExit(f'{path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+        return statistics.median(samples) * 1000, len(statements), response
+
+    def walk(sort, order):
+        ids, after = [], ''
+        while True:
+            data = client.get(f'/admin/catalog/entity?sort={sort}&order={order}&limit=97&after={after}').get_json()
+            ids.extend(item['id'] for item in data['items'])
+            after = data['after']
+            if not after:
+                return ids
+
+    seeded = 0
+    print(f"{'entities':>8} {'request':>22} {'ms':>8} {'queries':>8}")
+    for size in args.sizes:
+        with app.app_context():
+            # Each seeded game needs a player of its own for a unique name
+            seed(players=1, npcs=size - seeded - 1, skills=20)
+            seeded = size
+            # Spread levels and reuse names so the sorts have ties to break
+            db.session.execute(db.text('UPDATE entity_model SET level = id % 37, name = printf("Monster %d", id % 500)'))
+            db.session.commit()
+
+        results = [
+            ('/admin (cold)', timed('/admin', app.jinja_env.fragment_cache.clear)),
+            ('first page', timed('/admin/catalog/entity')),
+        ]
+        for sort in CATALOG_LISTINGS['entity'][2]:
+            # Page through 80% of the listing with large pages, then time the next page
+            after = ''
+            for _ in range(int(size * 0.8) // 500):
+                after = client.get(f'/admin/catalog/entity?sort={sort}&limit=500&after={after}').get_json()['after']
+            results.append((f'deep page by {sort}', timed(f'/admin/catalog/entity?sort={sort}&after={after}')))
+        for label, (elapsed, queries, _) in results:
+            print(f'{size:>8} {label:>22} {elapsed:>8.2f} {queries:>8}')
+
+        if size == args.sizes[0]:
+            with app.app_context():
+                rows = db.session.query(EntityModel.id, EntityModel.name, EntityModel.level).all()
+                skilled = {entity_id for (entity_id,) in db.session.query(entity_skill.c.entity_id)}
+            for sort in CATALOG_LISTINGS['entity'][2]:
+                for order in ('asc', 'desc'):
+                    expected = [row.id for row in sorted(rows, key=lambda row: (getattr(row, sort), row.id),
+                                                         reverse=order == 'desc')]
+                    if walk(sort, order) != expected:
+                        print(f'FAIL: walking the listing by {sort} {order} did not return every entity once, in order')
+                        return 1
+            if not skilled:
+                print('FAIL: seeding gave no entity a skill')
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
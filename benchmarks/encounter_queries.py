@@ -0,0 +1,89 @@
+"""Fail if advancing an encounter issues more SQL as the game grows.
+
+Seeds games of increasing size into a scratch SQLite database, wounds every
+entity, starts an encounter and advances through a full round. It counts
+the statements of the turn that starts the next round, which applies the
+regen tick, and checks that every wounded entity healed. Exits non-zero
+when any size exceeds ``--max-queries``.
+
+    python benchmarks/encounter_queries.py --sizes 10 100 1000 --max-queries 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--max-queries', type=int, default=10)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'encounter.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DB_SELF_CHECK'] = '0'
+
+    from app import EntityModel, app, db, games_entities
+    from seed import seed
+
+    statements = []
+
+    with app.app_context():
+        db.create_all()
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *rest: statements.append(statement))
+
+    failed = False
+    print(f"{'entities':>8} {'queries':>8} {'healed':>7} {'ms':>8}")
+    for size in args.sizes:
+        with app.app_context():
+            (game_id,), user_ids = seed(players=1, npcs=size - 1, skills=2)
+            in_game = EntityModel.id.in_(db.select(games_entities.c.entity_id)
+                                         .where(games_entities.c.game_id == game_id))
+            db.session.query(EntityModel).filter(in_game).update({'health': EntityModel.max_health / 2},
+                                                                   synchronize_session=False)
+            db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_ids[0])
+            session['_fresh'] = True
+            session['selected_game_id'] = game_id
+
+        client.post('/encounter/start')
+        # Every turn but the last of round one
+        for _ in range(size - 1):
+            client.post('/encounter/next-turn')
+
+        statements.clear()
+        start = time.perf_counter()
+        response = client.post('/encounter/next-turn')
+        elapsed = time.perf_counter() - start
+        state = response.get_json()['encounter']
+        if response.status_code != 200 or state['round'] != 2:
+            print(f'/encounter/next-turn returned {response.status_code} at round {state["round"]}')
+            return 1
+
+        with app.app_context():
+            healed = db.session.query(db.func.count()).filter(in_game, EntityModel.health > EntityModel.max_health / 2) \
+                .scalar()
+
+        print(f'{size:>8} {len(statements):>8} {healed:>7} {elapsed * 1000:>8.1f}')
+        if len(statements) > args.max_queries:
+            failed = True
+            for statement in statements:
+                print('   ', ' '.join(statement.split())[:120])
+
+    if failed:
+        print(f'FAIL: more than {args.max_queries} queries')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
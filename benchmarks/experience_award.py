@@ -0,0 +1,130 @@
+"""Check that ending an encounter awards experience with the same SQL at any size, and awards it right.
+
+Seeds games of increasing size into a scratch SQLite database with mixed
+experience and levels, starts an encounter, defeats every third
+participant and ends the encounter through /encounter/end. The statement
+count and time of that request are printed next to a per-entity ORM loop
+doing the same award, and every participant is checked against
+``stats.level_for_experience`` and ``stats.stat_points_through``. Exits
+non-zero when a row is wrong or a size exceeds ``--max-queries``.
+
+    python benchmarks/experience_award.py --sizes 10 100 1000 10000 --max-queries 12
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--max-queries', type=int, default=12)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'experience.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DB_SELF_CHECK'] = '0'
+
+    from app import EncounterModel, EntityModel, app, db
+    from seed import seed
+    from stats import DEFEAT_EXPERIENCE_PER_LEVEL, level_for_experience, stat_points_through
+
+    statements = []
+    with app.app_context():
+        db.create_all()
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *rest: statements.append(statement))
+
+    def naive_award(entity_ids, experience):
+        # What the award costs with one ORM load per entity
+        for entity_id in entity_ids:
+            entity = db.session.get(EntityModel, entity_id)
+            entity.experience += experience
+            level = max(entity.level, level_for_experience(entity.experience))
+            entity.unassigned_stat_points += stat_points_through(level) - stat_points_through(entity.level)
+            entity.level = level
+        db.session.commit()
+
+    status = 0
+    print(f"{'entities':>8} {'survivors':>9} {'each':>6} {'levelled':>8} {'queries':>8} {'ms':>8} "
+          f"{'ORM queries':>12} {'ORM ms':>8}")
+    for size in args.sizes:
+        with app.app_context():
+            (game_id,), user_ids = seed(players=1, npcs=size - 1, skills=2)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_ids[0])
+            session['_fresh'] = True
+            session['selected_game_id'] = game_id
+        client.post('/encounter/start')
+
+        with app.app_context():
+            participants = [entity_id for entity_id, _ in
+                            EncounterModel.query.filter_by(game_id=game_id).one().initiative]
+            in_encounter = EntityModel.id.in_(participants)
+            db.session.query(EntityModel).filter(in_encounter).update({
+                'experience': EntityModel.id * 7919 % 360000,
+                'level': 1 + EntityModel.id % 7,
+                'health': db.case((EntityModel.id % 3 == 0, 0), else_=EntityModel.health)
+            }, synchronize_session=False)
+            db.session.commit()
+            before = {row.id: row for row in db.session.query(
+                EntityModel.id, EntityModel.health, EntityModel.level, EntityModel.experience,
+                EntityModel.unassigned_stat_points).filter(in_encounter)}
+
+        statements.clear()
+        start = time.perf_counter()
+        response = client.post('/encounter/end')
+        elapsed = time.perf_counter() - start
+        queries = len(statements)
+        if response.status_code != 200:
+            print(f'/encounter/end returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+            return 1
+        each = response.get_json()['experience']
+
+        survivors = [row for row in before.values() if row.health > 0]
+        defeated_levels = sum(row.level for row in before.values() if row.health <= 0)
+        expected_each = defeated_levels * DEFEAT_EXPERIENCE_PER_LEVEL // len(survivors) if survivors else 0
+        with app.app_context():
+            after = {row.id: row for row in db.session.query(
+                EntityModel.id, EntityModel.level, EntityModel.experience,
+                EntityModel.unassigned_stat_points).filter(EntityModel.id.in_(participants))}
+        wrong = 0
+        for entity_id, old in before.items():
+            new = after[entity_id]
+            if old.health <= 0:
+                expected = (old.level, old.experience, old.unassigned_stat_points)
+            else:
+                level = max(old.level, level_for_experience(old.experience + expected_each))
+                expected = (level, old.experience + expected_each,
+                            old.unassigned_stat_points + stat_points_through(level) - stat_points_through(old.level))
+            wrong += (new.level, new.experience, new.unassigned_stat_points) != expected
+        levelled = sum(after[row.id].level > row.level for row in survivors)
+
+        with app.app_context():
+            statements.clear()
+            naive_start = time.perf_counter()
+            naive_award([row.id for row in survivors], expected_each)
+            naive_elapsed = time.perf_counter() - naive_start
+            naive_queries = len(statements)
+
+        print(f'{size:>8} {len(survivors):>9} {each:>6} {levelled:>8} {queries:>8} {elapsed * 1000:>8.1f} '
+              f'{naive_queries:>12} {naive_elapsed * 1000:>8.1f}')
+        if each != expected_each or wrong:
+            print(f'FAIL: {wrong} participants got the wrong award (each {each}, expected {expected_each})')
+            status = 1
+        if queries > args.max_queries:
+            print(f'FAIL: {queries} statements ended an encounter of {size}')
+            for statement in statements:
+                print('   ', ' '.join(statement.split())[:120])
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
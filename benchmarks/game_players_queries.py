@@ -0,0 +1,71 @@
+"""Fail if rendering /game-players issues more SQL as the game grows.
+
+Seeds games of increasing size into a scratch SQLite database, renders the
+page for one of their players once to warm the caches, then counts the
+statements executed by a second render. Exits
+non-zero when any size exceeds ``--max-queries``.
+
+    python benchmarks/game_players_queries.py --sizes 1 10 100 --max-queries 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--max-queries', type=int, default=10)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'queries.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+    from app import app, db
+    from seed import seed
+
+    statements = []
+
+    with app.app_context():
+        db.create_all()
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *rest: statements.append(statement))
+
+    failed = False
+    print(f"{'size':>6} {'queries':>8}")
+    for size in args.sizes:
+        with app.app_context():
+            (game_id,), user_ids = seed(players=size, npcs=size, skills=max(2, size // 5))
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_ids[0])
+            session['_fresh'] = True
+            session['selected_game_id'] = game_id
+
+        # Count the steady state, after the user and catalog caches are warm
+        client.get('/game-players')
+        statements.clear()
+        response = client.get('/game-players')
+        if response.status_code != 200:
+            print(f'/game-players returned {response.status_code}')
+            return 1
+
+        print(f'{size:>6} {len(statements):>8}')
+        if len(statements) > args.max_queries:
+            failed = True
+            for statement in statements:
+                print('   ', ' '.join(statement.split())[:120])
+
+    if failed:
+        print(f'FAIL: more than {args.max_queries} queries')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Time the "which games can this user see" query as guild membership grows.
+
+Fills a scratch SQLite database with games spread over many Discord guilds,
+puts one user in an increasing number of those guilds, and times the query
+behind the index page with and without the discord_guild_id index. The
+query plan of the indexed run is printed so a regression to a table scan
+is easy to spot.
+
+    python benchmarks/guild_games.py --games 100000 --guilds 20000 --memberships 10 100 500
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--guilds', type=int, default=20000)
+    parser.add_argument('--memberships', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'guilds.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DB_SELF_CHECK'] = '0'
+
+    from app import GameModel, UserModel, app, db, invalidate_user, user_guilds, visible_games
+
+    rng = random.Random(0)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(db.insert(GameModel), [
+            {'game_name': f'Game {number}', 'discord_guild_id': str(rng.randrange(args.guilds))}
+            for number in range(args.games)
+        ])
+        user = UserModel(discord_id='1', username='member', discriminator='0001')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    print(f"{'guilds':>7} {'games':>6} {'indexed ms':>11} {'scan ms':>8}")
+    for memberships in args.memberships:
+        with app.app_context():
+            db.session.execute(user_guilds.delete())
+            db.session.execute(user_guilds.insert(), [{'user_id': user_id, 'guild_id': str(guild_id)}
+                                                      for guild_id in rng.sample(range(args.guilds), memberships)])
+            db.session.commit()
+            invalidate_user(user_id)
+
+            timings = {}
+            for label in ('indexed', 'scan'):
+                if label == 'scan':
+                    db.session.execute(db.text('DROP INDEX ix_game_model_discord_guild_id'))
+                samples = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    games = visible_games(user_id).order_by(GameModel.id).all()
+                    samples.append(time.perf_counter() - start)
+                timings[label] = statistics.median(samples) * 1000
+                if label == 'indexed' and memberships == args.memberships[0]:
+                    statement = visible_games(user_id).order_by(GameModel.id).statement
+                    compiled = statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+                    for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {compiled}')):
+                        print('   ', row[-1])
+            db.session.execute(db.text('CREATE INDEX ix_game_model_discord_guild_id ON game_model (discord_guild_id)'))
+            db.session.commit()
+
+        print(f"{memberships:>7} {len(games):>6} {timings['indexed']:>11.2f} {timings['scan']:>8.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
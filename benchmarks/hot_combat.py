@@ -0,0 +1,194 @@
+"""Compare /attack with and without write-behind combat state, and check no attack is lost.
+
+Uses the setup of attack_stress.py: one defender that cannot dodge and
+players armed with an attack that always hits for a fixed amount. First
+/attack is timed from several threads with HOT_COMBAT_STATE off and on,
+reporting attacks per second and SQL statements per attack; once the hot
+state is flushed the defender must have lost exactly the damage of every
+attack.
+
+Then a child process runs attacks with a flush interval too long to ever
+fire and stops in one of three ways: exiting normally, being killed, or
+being killed right after storing a batch but with the batch's journal file
+put back, as if it died before deleting it. A fourth child cannot publish
+what it stores (as when Redis is down): it flushes halfway through its
+attacks and exits normally. Two more fail to store the flush halfway
+through: one is killed after the rest of its attacks, the other flushes
+again first. After each, a new app is built, which replays whatever
+journal is left, and the defender's health, the combat log and the journal
+directory are checked.
+
+    python benchmarks/hot_combat.py --attacks 2000 --threads 8
+"""
+import argparse
+import glob
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HEALTH = 10.0 ** 9
+DAMAGE = 1.0
+
+
+def attack_client(app, user_id, game_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+        session['selected_game_id'] = game_id
+    return client
+
+
+def fire(app, user_ids, game_id, defender_id, attack_id, attacks):
+    """POST ``attacks`` attacks spread over one thread per user; return how many went through."""
+    succeeded = []
+
+    def run(user_id, count):
+        client = attack_client(app, user_id, game_id)
+        done = 0
+        for _ in range(count):
+            response = client.post('/attack', data={'defender_id': defender_id, 'attack_id': attack_id})
+            done += response.status_code == 302
+        succeeded.append(done)
+
+    shares = [attacks // len(user_ids) + (1 if index < attacks % len(user_ids) else 0)
+              for index in range(len(user_ids))]
+    threads = [threading.Thread(target=run, args=(user_id, share)) for user_id, share in zip(user_ids, shares)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(succeeded)
+
+
+def child(mode, journal, game_id, defender_id, attack_id, user_id, attacks):
+    import app as site
+    from app import create_app
+
+    app = create_app({'HOT_COMBAT_STATE': True, 'HOT_COMBAT_JOURNAL': journal, 'HOT_COMBAT_FLUSH_SECONDS': 3600})
+    if mode == 'publish-fails':
+        def publish_health_update(update):
+            raise ConnectionError('Redis is down')
+
+        site.publish_health_update = publish_health_update
+        succeeded = fire(app, [user_id], game_id, defender_id, attack_id, attacks // 2)
+        app.extensions['combat_state'].flush()
+        succeeded += fire(app, [user_id], game_id, defender_id, attack_id, attacks - attacks // 2)
+    elif mode in ('store-fails', 'store-retried'):
+        apply_damage = site.apply_damage
+
+        def failing_apply_damage(damage_by_entity):
+            raise RuntimeError('The database is down')
+
+        site.apply_damage = failing_apply_damage
+        succeeded = fire(app, [user_id], game_id, defender_id, attack_id, attacks // 2)
+        try:
+            app.extensions['combat_state'].flush()
+        except RuntimeError:
+            pass
+        else:
+            raise SystemExit('The failing flush did not fail')
+        site.apply_damage = apply_damage
+        succeeded += fire(app, [user_id], game_id, defender_id, attack_id, attacks - attacks // 2)
+        if mode == 'store-retried':
+            app.extensions['combat_state'].flush()
+    else:
+        succeeded = fire(app, [user_id], game_id, defender_id, attack_id, attacks)
+    if succeeded != attacks:
+        raise SystemExit(f'{attacks - succeeded} attacks failed in the child')
+    if mode in ('exit', 'publish-fails'):
+        return
+    if mode == 'crash-after-store':
+        saved = tempfile.mkdtemp()
+        for path in glob.glob(os.path.join(journal, '*.jsonl')):
+            shutil.copy(path, saved)
+        app.extensions['combat_state'].flush()
+        for path in glob.glob(os.path.join(saved, '*.jsonl')):
+            shutil.copy(path, journal)
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attacks', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--recovery-attacks', type=int, default=500)
+    parser.add_argument('--child', nargs=7, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, journal, *ids = args.child
+        child(mode, journal, *map(int, ids))
+        return 0
+
+    directory = tempfile.mkdtemp()
+    journal = os.path.join(directory, 'journal')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'combat.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DB_SELF_CHECK'] = '0'
+    # Keep every log entry so the log can be counted
+    os.environ['COMBAT_LOG_RETENTION'] = str(10 ** 9)
+
+    import migrations
+    from app import CombatJournalModel, CombatLogModel, EntityModel, create_app, db
+    from attack_stress import prepare
+
+    cold = create_app({'HOT_COMBAT_STATE': False})
+    hot = create_app({'HOT_COMBAT_STATE': True, 'HOT_COMBAT_JOURNAL': journal, 'HOT_COMBAT_FLUSH_SECONDS': 0.2})
+    with cold.app_context():
+        migrations.upgrade(db.engine)
+        game_id, defender_id, attack_id, user_ids = prepare(HEALTH, DAMAGE, args.threads)
+
+    def state(app):
+        with app.app_context():
+            health = db.session.get(EntityModel, defender_id).health
+            logged = db.session.query(CombatLogModel).filter_by(game_id=game_id).count()
+            journals = db.session.query(CombatJournalModel).count()
+        return health, logged, journals
+
+    status = 0
+    print(f"{'mode':>5} {'attacks':>8} {'attacks/s':>10} {'SQL/attack':>11}")
+    for label, app in (('cold', cold), ('hot', hot)):
+        statements = []
+        with app.app_context():
+            db.event.listen(db.engine, 'before_cursor_execute', lambda *rest: statements.append(1))
+        health_before, _, _ = state(app)
+        start = time.perf_counter()
+        succeeded = fire(app, user_ids, game_id, defender_id, attack_id, args.attacks)
+        elapsed = time.perf_counter() - start
+        print(f'{label:>5} {succeeded:>8} {succeeded / elapsed:>10.0f} {len(statements) / succeeded:>11.2f}')
+        if label == 'hot':
+            app.extensions['combat_state'].close()
+        health, _, _ = state(app)
+        if health != health_before - succeeded * DAMAGE:
+            print(f'FAIL: {label} lost {health - (health_before - succeeded * DAMAGE):g} damage')
+            status = 1
+
+    print(f"\n{'stop':>18} {'attacks':>8} {'replayed':>9} {'lost':>6} {'logged':>7} {'journal left':>13}")
+    for mode in ('exit', 'crash', 'crash-after-store', 'publish-fails', 'store-fails', 'store-retried'):
+        health_before, logged_before, _ = state(cold)
+        child_journal = os.path.join(directory, f'journal-{mode}')
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, child_journal, str(game_id),
+                        str(defender_id), str(attack_id), str(user_ids[0]), str(args.recovery_attacks)])
+        recovered = create_app({'HOT_COMBAT_STATE': True, 'HOT_COMBAT_JOURNAL': child_journal})
+        replayed = recovered.extensions['combat_state'].recovered
+        health, logged, journals = state(recovered)
+        lost = health - (health_before - args.recovery_attacks * DAMAGE)
+        left = len(os.listdir(child_journal)) + journals
+        print(f'{mode:>18} {args.recovery_attacks:>8} {replayed:>9} {lost:>6g} {logged - logged_before:>7} '
+              f'{left:>13}')
+        if lost or left or logged - logged_before != args.recovery_attacks:
+            print(f'FAIL: stopping by {mode} lost or repeated attacks')
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Measure the CPU the combat hub burns while clients sit idle.
+
+Opens an increasing number of subscribers on one game, lets them idle and
+reports the process CPU time spent over the window. A push hub should stay
+flat as clients are added, where per-client polling grows linearly.
+
+    python benchmarks/hub_idle_cpu.py --clients 10 100 1000 --window 5
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hub import GameHub  # noqa: E402
+
+
+def consume(stream, stop):
+    for _ in stream:
+        if stop.is_set():
+            break
+
+
+def measure(clients, window, keepalive):
+    hub = GameHub()
+    hub.start()
+    stop = threading.Event()
+    streams = [hub.stream(1, keepalive=keepalive) for _ in range(clients)]
+    threads = [threading.Thread(target=consume, args=(stream, stop), daemon=True) for stream in streams]
+    for thread in threads:
+        thread.start()
+    while hub.subscriber_count(1) < clients:
+        time.sleep(0.01)
+
+    cpu_start = time.process_time()
+    time.sleep(window)
+    idle_cpu = time.process_time() - cpu_start
+
+    # One attack fanned out to everyone, to show delivery still works
+    cpu_start = time.process_time()
+    hub.publish(1, {'version': 1, 'entities': []})
+    publish_cpu = time.process_time() - cpu_start
+
+    stop.set()
+    hub.publish(1, {'version': 2, 'entities': []})
+    for thread in threads:
+        thread.join(timeout=1)
+    return idle_cpu, publish_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--window', type=float, default=5.0, help='idle seconds measured per run')
+    parser.add_argument('--keepalive', type=float, default=15.0)
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'idle cpu (ms)':>14} {'cpu/s (ms)':>11} {'publish (ms)':>13}")
+    for clients in args.clients:
+        idle_cpu, publish_cpu = measure(clients, args.window, args.keepalive)
+        print(f"{clients:>8} {idle_cpu * 1000:>14.2f} {idle_cpu * 1000 / args.window:>11.2f} "
+              f"{publish_cpu * 1000:>13.2f}")
+
+
+if __name__ == '__main__':
+    main()
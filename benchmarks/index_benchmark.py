@@ -0,0 +1,140 @@
+"""Time the lookup-heavy routes before and after the index migration.
+
+Builds a scratch SQLite database at schema version 3 (before the lookup
+indexes), bulk-loads a large campaign, times the routes that filter on the
+newly indexed columns, applies the remaining migrations and times them again.
+
+    python benchmarks/index_benchmark.py --entities 100000 --repeat 5
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stats import STATS, derive_stats  # noqa: E402
+
+ROUTES = [
+    ('GET', '/'),
+    ('GET', '/game-players'),
+    ('GET', '/game-updates?since=0'),
+    ('POST', '/edit_skill'),
+]
+
+
+def bulk_seed(db, entities, users, games, skills, rng):
+    metadata = db.MetaData()
+    metadata.reflect(db.engine)
+    tables = metadata.tables
+
+    with db.engine.begin() as conn:
+        conn.execute(tables['skill_model'].insert(), [
+            {'id': skill_id, 'name': f'Skill {skill_id}', 'description': 'Seeded', 'skill_cost': 1,
+             **{f'bonus_{stat}': 1.0 for stat in STATS}, **{f'multiplier_{stat}': 0.1 for stat in STATS}}
+            for skill_id in range(1, skills + 1)
+        ])
+        conn.execute(tables['attack_model'].insert(), [
+            {'name': f'Attack {skill_id}', 'description': 'Seeded', 'damage_modifier_stat': 'strength',
+             'damage_modifier_multiplier': 0.5, 'accuracy': 0.9, 'damage': 5.0, 'number_of_targets': 1,
+             'skill_id': skill_id}
+            for skill_id in range(1, skills + 1)
+        ])
+        conn.execute(tables['user_model'].insert(), [
+            {'id': user_id, 'discord_id': str(10 ** 17 + user_id), 'username': f'player{user_id}',
+             'discriminator': '0001'}
+            for user_id in range(1, users + 1)
+        ])
+        conn.execute(tables['game_model'].insert(), [
+            {'id': game_id, 'game_name': f'Game {game_id}', 'discord_guild_id': str(game_id), 'creator_id': 1}
+            for game_id in range(1, games + 1)
+        ])
+
+        base = {stat: 50.0 for stat in STATS}
+        derived = derive_stats([base], [{stat: 0 for stat in STATS}], [{stat: 1 for stat in STATS}])[0]
+        conn.execute(tables['entity_model'].insert(), [
+            {'id': entity_id, 'name': f'Entity {entity_id}', 'description': 'Seeded', 'level': 1, 'experience': 0,
+             'unassigned_stat_points': 0, 'user_id': entity_id if entity_id <= users else None,
+             **{f'base_{stat}': base[stat] for stat in STATS}, **derived}
+            for entity_id in range(1, entities + 1)
+        ])
+        conn.execute(tables['entity_skill'].insert(), [
+            {'entity_id': entity_id, 'skill_id': skill_id}
+            for entity_id in range(1, entities + 1)
+            for skill_id in rng.sample(range(1, skills + 1), 2)
+        ])
+        conn.execute(tables['players_games'].insert(), [
+            {'user_id': user_id, 'game_id': game_id}
+            for user_id in range(1, users + 1)
+            for game_id in rng.sample(range(1, games + 1), 3)
+        ])
+        conn.execute(tables['games_entities'].insert(), [
+            {'game_id': game_id, 'entity_id': entity_id}
+            for game_id in range(1, games + 1)
+            for entity_id in rng.sample(range(users + 1, entities + 1), 200)
+        ])
+
+
+def time_routes(app, repeat):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+        session['selected_game_id'] = 1
+
+    skill_form = {'skill_id': 1, 'name': 'Skill 1', 'description': 'Seeded', 'skill_cost': 1,
+                  **{f'bonus_{stat}': 1.0 for stat in STATS}, **{f'multiplier_{stat}': 0.1 for stat in STATS}}
+    timings = {}
+    for method, path in ROUTES:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if method == 'GET':
+                client.get(path)
+            else:
+                client.post(path, data=skill_form)
+            samples.append(time.perf_counter() - start)
+        timings[path] = statistics.median(samples)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entities', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--games', type=int, default=50)
+    parser.add_argument('--skills', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'indexes.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+    import migrations
+    from app import app, db
+
+    with app.app_context():
+        migrations.upgrade(db.engine, target=3)
+        start = time.perf_counter()
+        bulk_seed(db, args.entities, args.users, args.games, args.skills, random.Random(0))
+        print(f'seeded {args.entities} entities in {time.perf_counter() - start:.1f}s')
+
+    before = time_routes(app, args.repeat)
+    with app.app_context():
+        start = time.perf_counter()
+        migrations.upgrade(db.engine)
+        print(f'migrated in {time.perf_counter() - start:.1f}s')
+    after = time_routes(app, args.repeat)
+
+    print(f"{'route':<24} {'before (ms)':>12} {'after (ms)':>11} {'speedup':>8}")
+    for path in before:
+        print(f'{path:<24} {before[path] * 1000:>12.2f} {after[path] * 1000:>11.2f} '
+              f'{before[path] / after[path]:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
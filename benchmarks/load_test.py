@@ -0,0 +1,350 @@
+"""Drive realistic HTTP traffic at the app under gunicorn and fail on latency or throughput regressions.
+
+Seeds a scratch SQLite database (players, a game, NPCs, skills and
+attacks), starts a stub of the Discord OAuth and REST API, and serves the
+app with gunicorn the way the Procfile does, pointed at the stub through
+DISCORD_API_URL. Every simulated client logs in through the full OAuth
+redirect flow and selects the game, then, until the deadline:
+
+- pollers GET /game-updates?since=<version> and carry the returned version
+  forward, like an open game page without SSE
+- attackers POST /attack as JSON, like the game page, at random NPCs with their own attacks
+- admins GET /admin
+- listeners open /game-events during the warm-up and hold it open, like
+  game pages left open in a tab; each stream occupies the server for as
+  long as it is open, so enough of them starve the other routes when the
+  workers cannot serve that many at once (``--worker-class gthread``)
+
+Each client starts a request every ``--*-interval`` seconds, or as soon as
+the previous one finishes when the server falls behind, so the offered load
+is fixed and a slower server shows up as higher latency and lower
+throughput rather than as a different traffic mix.
+
+Throughput, error count and p50/p95/p99 latency are reported per route,
+after a warm-up that is not counted. ``--save-baseline`` writes them to a
+JSON file; ``--baseline`` compares against one and exits non-zero when a
+route's throughput falls or a ``--gate`` percentile (p95 by default; p99
+of a short run is mostly noise) grows by more than ``--tolerance`` and by
+more than ``--slack`` milliseconds, or when its error rate exceeds
+``--max-error-rate``. Baselines only compare across runs with the same traffic options and are
+machine specific; benchmarks/baselines/ holds the reference run.
+
+    python benchmarks/load_test.py --baseline benchmarks/baselines/load_test.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+GUILD_ID = '1000'
+# Options that change the traffic; baselines are only comparable when these match
+TRAFFIC_OPTIONS = ('players', 'npcs', 'skills', 'pollers', 'poll_interval', 'attackers', 'attack_interval', 'admins',
+                   'admin_interval', 'listeners', 'worker_class', 'workers', 'threads', 'seconds')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def discord_stub(users):
+    """An HTTP server answering the Discord endpoints the app calls, for the ``users`` discord id -> name map.
+
+    The authorization code and access token both carry the discord id, so
+    no state is kept between the steps of a login.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, body, status=200):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/api/oauth2/authorize':
+                query = parse_qs(url.query)
+                if 'login_hint' not in query:
+                    self.send_json({'message': 'login_hint names the user to log in'}, 400)
+                    return
+                self.send_response(302)
+                self.send_header('Location', query['redirect_uri'][0] + '?' +
+                                 urlencode({'code': query['login_hint'][0], 'state': query['state'][0]}))
+                self.end_headers()
+                return
+            discord_id = self.headers.get('Authorization', '').removeprefix('Bearer token-')
+            if discord_id not in users:
+                self.send_json({'message': '401: Unauthorized'}, 401)
+            elif url.path == '/api/users/@me':
+                self.send_json({'id': discord_id, 'username': users[discord_id], 'discriminator': '0001',
+                                'avatar': None})
+            elif url.path == '/api/users/@me/guilds':
+                self.send_json([{'id': GUILD_ID, 'name': 'Load test'}])
+            else:
+                self.send_json({'message': '404: Not Found'}, 404)
+
+        def do_POST(self):
+            body = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+            if urlparse(self.path).path != '/api/oauth2/token':
+                self.send_json({'message': '404: Not Found'}, 404)
+                return
+            self.send_json({'access_token': f"token-{body['code'][0]}", 'token_type': 'Bearer',
+                            'expires_in': 604800, 'refresh_token': 'refresh', 'scope': 'identify guilds'})
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(('127.0.0.1', free_port()), Handler)
+
+
+def prepare_database(uri, args):
+    """Seed the database at ``uri``; return the game id, the players and the NPC ids."""
+    os.environ['DATABASE_URL'] = uri
+    os.environ['DB_SELF_CHECK'] = '0'
+    import migrations
+    from app import EntityModel, UserModel, app, db, entity_attack, games_entities
+    from seed import seed
+
+    with app.app_context():
+        migrations.upgrade(db.engine)
+        (game_id,), user_ids = seed(players=args.players, npcs=args.npcs, skills=args.skills)
+        players = []
+        for user in UserModel.query.filter(UserModel.id.in_(user_ids)).order_by(UserModel.id):
+            entity_id = db.session.query(EntityModel.id).filter_by(user_id=user.id).scalar()
+            attack_ids = [attack_id for (attack_id,) in db.session.query(entity_attack.c.attack_id)
+                          .filter(entity_attack.c.entity_id == entity_id)]
+            players.append({'discord_id': user.discord_id, 'username': user.username, 'attack_ids': attack_ids})
+        npc_ids = [entity_id for (entity_id,) in db.session.query(EntityModel.id)
+                   .join(games_entities, games_entities.c.entity_id == EntityModel.id)
+                   .filter(games_entities.c.game_id == game_id, EntityModel.user_id.is_(None))]
+        db.engine.dispose()
+    return game_id, players, npc_ids
+
+
+def start_server(port, env, args):
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}']
+    if args.worker_class == 'gevent':
+        # Served the way the Procfile serves it
+        command += ['--config', 'gunicorn_config.py']
+    else:
+        command += ['--preload', '--worker-class', 'gthread', '--threads', str(args.threads)]
+    command.append('app:create_app()')
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f'gunicorn exited with status {server.returncode}')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=1, allow_redirects=False)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('gunicorn did not start within 30 seconds')
+
+
+def log_in(base_url, player, game_id):
+    """A requests session logged in as ``player`` through the OAuth flow, with the game selected."""
+    http = requests.Session()
+    # Flask-Dance redirects to the stub, which redirects back with a code the app exchanges for a token.
+    # login_hint is not a Discord parameter; the stub uses it to pick the user to log in.
+    authorize = http.get(f'{base_url}/login/discord', allow_redirects=False).headers['Location']
+    http.get(authorize + '&' + urlencode({'login_hint': player['discord_id']}))
+    response = http.post(f'{base_url}/select-game', data={'game_id': game_id}, allow_redirects=False)
+    if response.status_code != 302 or '/game-players' not in response.headers.get('Location', ''):
+        raise SystemExit(f"Logging in as {player['username']} failed: /select-game returned {response.status_code}")
+    return http
+
+
+def run_client(role, http, base_url, player, npc_ids, args, start, deadline, samples, seed_value):
+    if role == 'listener':
+        hold_stream(http, base_url, deadline, samples)
+        return
+    rng = random.Random(seed_value)
+    interval = {'poller': args.poll_interval, 'attacker': args.attack_interval, 'admin': args.admin_interval}[role]
+    # Spread the clients' first requests over one interval
+    time.sleep(rng.random() * interval)
+    # The highest entity version a poller has seen; its first poll, in the warm-up, fetches every entity
+    since = 0
+    while time.time() < deadline:
+        if role == 'poller':
+            route, send = 'GET /game-updates', lambda: http.get(f'{base_url}/game-updates', params={'since': since})
+        elif role == 'attacker':
+            payload = {'defender_id': rng.choice(npc_ids), 'attack_id': rng.choice(player['attack_ids'])}
+            route, send = 'POST /attack', lambda: http.post(f'{base_url}/attack', json=payload)
+        else:
+            route, send = 'GET /admin', lambda: http.get(f'{base_url}/admin')
+        began = time.time()
+        try:
+            response = send()
+            ok = response.status_code < 400
+            # 304 means nothing changed since the version sent
+            if role == 'poller' and response.status_code == 200:
+                since = response.json()['version']
+        except requests.RequestException:
+            ok = False
+        finished = time.time()
+        if began >= start and finished <= deadline:
+            samples.append((route, finished - began, ok))
+        time.sleep(max(0.0, began + interval - time.time()))
+
+
+def hold_stream(http, base_url, deadline, samples):
+    """Open /game-events, time its first bytes and keep it open until ``deadline`` without reading it."""
+    began = time.time()
+    try:
+        with http.get(f'{base_url}/game-events', stream=True, timeout=10) as response:
+            ok = response.status_code == 200 and next(response.iter_content(chunk_size=None)).startswith(b':')
+            samples.append(('GET /game-events', time.time() - began, ok))
+            time.sleep(max(0.0, deadline - time.time()))
+    except requests.RequestException:
+        samples.append(('GET /game-events', time.time() - began, False))
+
+
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summarize(samples, seconds):
+    routes = {}
+    for route in sorted({route for route, _, _ in samples}):
+        latencies = sorted(latency for name, latency, _ in samples if name == route)
+        errors = sum(1 for name, _, ok in samples if name == route and not ok)
+        routes[route] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': round(len(latencies) / seconds, 2),
+            'p50': round(percentile(latencies, 50) * 1000, 2),
+            'p95': round(percentile(latencies, 95) * 1000, 2),
+            'p99': round(percentile(latencies, 99) * 1000, 2),
+        }
+    return routes
+
+
+def regressions(routes, baseline, gated, tolerance, slack, max_error_rate):
+    problems = []
+    for route, result in routes.items():
+        if result['errors'] > result['requests'] * max_error_rate:
+            problems.append(f"{route}: {result['errors']} errors in {result['requests']} requests")
+        expected = baseline['routes'].get(route)
+        if expected is None:
+            continue
+        if result['throughput'] < expected['throughput'] * (1 - tolerance):
+            problems.append(f"{route}: {result['throughput']:.1f} req/s, baseline {expected['throughput']:.1f}")
+        for key in gated:
+            if result[key] > expected[key] * (1 + tolerance) and result[key] - expected[key] > slack:
+                problems.append(f'{route}: {key} {result[key]:.1f} ms, baseline {expected[key]:.1f} ms')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--npcs', type=int, default=300)
+    parser.add_argument('--skills', type=int, default=30)
+    parser.add_argument('--pollers', type=int, default=32)
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--attackers', type=int, default=8)
+    parser.add_argument('--attack-interval', type=float, default=0.5)
+    parser.add_argument('--admins', type=int, default=4)
+    parser.add_argument('--admin-interval', type=float, default=0.5)
+    parser.add_argument('--listeners', type=int, default=200)
+    parser.add_argument('--worker-class', choices=['gevent', 'gthread'], default='gevent',
+                        help='gevent serves like the Procfile; gthread like it did before')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=50, help='threads per gthread worker')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--baseline', help='compare against this baseline file')
+    parser.add_argument('--save-baseline', help='write the results to this baseline file')
+    parser.add_argument('--gate', nargs='+', choices=['p50', 'p95', 'p99'], default=['p95'],
+                        help='latency percentiles compared against the baseline; all are reported')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed fractional drop in throughput or growth in gated latency')
+    parser.add_argument('--slack', type=float, default=25,
+                        help='latency growth in milliseconds that is never reported, however large in proportion')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        different = {option: (baseline['options'].get(option), getattr(args, option)) for option in TRAFFIC_OPTIONS
+                     if baseline['options'].get(option) != getattr(args, option)}
+        if different:
+            print(f'The baseline was recorded with different options (baseline, now): {different}')
+            return 2
+
+    directory = tempfile.mkdtemp()
+    uri = f"sqlite:///{os.path.join(directory, 'load.db')}"
+    os.environ.setdefault('SECRET_KEY', 'load-test')
+    game_id, players, npc_ids = prepare_database(uri, args)
+
+    stub = discord_stub({player['discord_id']: player['username'] for player in players})
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=uri, DISCORD_API_URL=f'http://127.0.0.1:{stub.server_port}',
+               DISCORD_CLIENT_ID='load-test', DISCORD_CLIENT_SECRET='load-test', OAUTHLIB_INSECURE_TRANSPORT='1',
+               DB_SELF_CHECK='0')
+    server = start_server(port, env, args)
+    base_url = f'http://127.0.0.1:{port}'
+
+    try:
+        roles = (['poller'] * args.pollers + ['attacker'] * args.attackers + ['admin'] * args.admins
+                 + ['listener'] * args.listeners)
+        clients = [(role, log_in(base_url, players[number % len(players)], game_id), players[number % len(players)])
+                   for number, role in enumerate(roles)]
+        samples = []
+        start = time.time() + args.warmup
+        deadline = start + args.seconds
+        threads = [threading.Thread(target=run_client, args=(role, http, base_url, player, npc_ids, args, start,
+                                                              deadline, samples, number))
+                   for number, (role, http, player) in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+        stub.shutdown()
+
+    routes = summarize(samples, args.seconds)
+    print(f"{'route':>24} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, result in routes.items():
+        print(f"{route:>24} {result['requests']:>9} {result['errors']:>7} {result['throughput']:>8.1f} "
+              f"{result['p50']:>8.1f} {result['p95']:>8.1f} {result['p99']:>8.1f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump({'options': {option: getattr(args, option) for option in TRAFFIC_OPTIONS}, 'routes': routes},
+                      file, indent=2, sort_keys=True)
+            file.write('\n')
+
+    problems = regressions(routes, baseline or {'routes': {}}, args.gate, args.tolerance, args.slack,
+                           args.max_error_rate)
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Time /game-players and /admin with cold fragments, warm fragments and conditional GETs.
+
+Seeds one game into a scratch SQLite database and, for each page, reports
+the median time and statement count of a render with the fragment cache
+cleared, a render with it warm, and a request that sends back the page's
+ETag and should get a 304. It then wounds an entity of the game and checks
+that the next conditional request re-renders the page with the new health.
+
+    python benchmarks/page_cache.py --players 20 --npcs 500 --skills 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--npcs', type=int, default=500)
+    parser.add_argument('--skills', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'pages.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DB_SELF_CHECK'] = '0'
+
+    from app import EntityModel, app, db, games_entities, next_health_version
+    from seed import seed
+
+    statements = []
+    with app.app_context():
+        db.create_all()
+        (game_id,), user_ids = seed(players=args.players, npcs=args.npcs, skills=args.skills)
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *rest: statements.append(statement))
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_ids[0])
+        session['_fresh'] = True
+        session['selected_game_id'] = game_id
+
+    def measure(path, prepare, headers=None):
+        samples, counts, status = [], [], None
+        for _ in range(args.repeat):
+            prepare()
+            statements.clear()
+            start = time.perf_counter()
+            response = client.get(path, headers=headers)
+            samples.append(time.perf_counter() - start)
+            counts.append(len(statements))
+            status = response.status_code
+        return statistics.median(samples) * 1000, max(counts), status
+
+    print(f"{'page':>13} {'request':>12} {'status':>7} {'ms':>8} {'queries':>8}")
+    for path in ('/game-players', '/admin'):
+        etag = client.get(path).headers['ETag']
+        runs = [
+            ('cold', app.jinja_env.fragment_cache.clear, None),
+            ('warm', lambda: None, None),
+            ('conditional', lambda: None, {'If-None-Match': etag}),
+        ]
+        for label, prepare, headers in runs:
+            elapsed, queries, status = measure(path, prepare, headers)
+            print(f'{path:>13} {label:>12} {status:>7} {elapsed:>8.2f} {queries:>8}')
+
+    # A write must change the ETag and reach the cached entity table
+    etag = client.get('/game-players').headers['ETag']
+    with app.app_context():
+        entity_id = db.session.query(games_entities.c.entity_id).filter(games_entities.c.game_id == game_id) \
+            .limit(1).scalar()
+        db.session.query(EntityModel).filter(EntityModel.id == entity_id) \
+            .update({'health': 1.5, 'health_version': next_health_version()}, synchronize_session=False)
+        db.session.commit()
+    response = client.get('/game-players', headers={'If-None-Match': etag})
+    row = response.get_data(as_text=True).split(f'data-entity-id="{entity_id}"')[1].split('</tr>')[0]
+    if response.status_code != 200 or '1.5 /' not in row:
+        print(f'FAIL: /game-players returned {response.status_code} with a stale entity row after a health change')
+        return 1
+    print(app.jinja_env.fragment_cache.stats())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
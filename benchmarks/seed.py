@@ -0,0 +1,63 @@
+"""Populate a database with a synthetic campaign for benchmarks.
+
+Import this module only after ``DATABASE_URL`` points at a scratch database;
+``app`` reads it at import time.
+"""
+import random
+
+from app import (AttackModel, EntityModel, GameModel, SkillModel, UserModel, db, derive_stats,
+                 refresh_entity_attacks, skill_holders, skill_totals)
+from stats import STATS
+
+
+def make_entity(rng, name, skills, user_id=None):
+    base = {stat: float(rng.randint(5, 120)) for stat in STATS}
+    bonus, multiplier = skill_totals(skills)
+    derived = derive_stats([base], [bonus], [multiplier])[0]
+    return EntityModel(name=name, description='Seeded', level=1, experience=0, unassigned_stat_points=0,
+                       skills=skills, user_id=user_id, **{f'base_{stat}': base[stat] for stat in STATS},
+                       **derived)
+
+
+def seed(players=5, npcs=50, skills=10, attacks_per_skill=3, games=1, seed_value=0):
+    """Create ``games`` games, each with ``players`` players and ``npcs`` NPCs, and commit.
+
+    Returns the ids of the created games and users.
+    """
+    rng = random.Random(seed_value)
+
+    skill_rows = []
+    for skill_index in range(skills):
+        actions = [AttackModel(name=f'Attack {skill_index}.{attack_index}', description='Seeded',
+                               damage_modifier_stat=rng.choice(STATS), damage_modifier_multiplier=0.5,
+                               accuracy=0.9, damage=5.0, number_of_targets=rng.randint(1, 3))
+                   for attack_index in range(attacks_per_skill)]
+        skill_rows.append(SkillModel(name=f'Skill {skill_index}', description='Seeded', skill_cost=1, actions=actions,
+                                     **{f'bonus_{stat}': float(rng.randint(0, 5)) for stat in STATS},
+                                     **{f'multiplier_{stat}': rng.random() / 10 for stat in STATS}))
+    db.session.add_all(skill_rows)
+
+    user_ids = []
+    game_ids = []
+    offset = db.session.query(db.func.count(UserModel.id)).scalar()
+    for game_index in range(games):
+        game = GameModel(game_name=f'Seeded game {offset}-{game_index}', discord_guild_id=str(1000 + game_index))
+        db.session.add(game)
+        for player_index in range(players):
+            number = offset + game_index * players + player_index
+            user = UserModel(discord_id=str(10 ** 17 + number), username=f'player{number}', discriminator='0001')
+            db.session.add(user)
+            db.session.flush()
+            game.players.append(user)
+            game.entities.append(make_entity(rng, f'Hero {number}', rng.sample(skill_rows, min(2, skills)), user.id))
+            user_ids.append(user.id)
+        for npc_index in range(npcs):
+            game.entities.append(make_entity(rng, f'Monster {game_index}.{npc_index}',
+                                             rng.sample(skill_rows, min(2, skills))))
+        db.session.flush()
+        game.creator_id = user_ids[-1] if user_ids else None
+        game_ids.append(game.id)
+
+    refresh_entity_attacks(skill_holders([skill.id for skill in skill_rows]))
+    db.session.commit()
+    return game_ids, user_ids
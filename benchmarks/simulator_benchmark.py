@@ -0,0 +1,58 @@
+"""Measure the throughput of the encounter simulator and check it is reproducible.
+
+Builds a synthetic party and a pack of monsters, then simulates the same
+encounter with each process count and reports trials and combat rounds per
+second. Exits non-zero if any process count gives a different result for the
+same seed.
+
+    python benchmarks/simulator_benchmark.py --trials 200000 --processes 1 2 4
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import Combatant, Move, simulate  # noqa: E402
+
+
+def encounter(party, monsters):
+    heroes = [Combatant(f'Hero {number}', 60.0, 0.7, (Move('Strike', 9.0, 0.9, 1), Move('Cleave', 5.0, 0.7, 3)))
+              for number in range(party)]
+    pack = [Combatant(f'Monster {number}', 25.0, 0.9, (Move('Bite', 6.0, 0.8, 1),))
+            for number in range(monsters)]
+    return heroes, pack
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=200000)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--party', type=int, default=4)
+    parser.add_argument('--monsters', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    heroes, pack = encounter(args.party, args.monsters)
+
+    reference = None
+    print(f"{'processes':>9} {'seconds':>8} {'trials/s':>10} {'rounds/s':>10} {'party wins':>10} {'mean ttk':>8}")
+    for processes in args.processes:
+        start = time.perf_counter()
+        result = simulate(heroes, pack, args.trials, seed=args.seed, processes=processes)
+        elapsed = time.perf_counter() - start
+        print(f"{processes:>9} {elapsed:>8.2f} {result.trials / elapsed:>10.0f} {result.rounds / elapsed:>10.0f} "
+              f"{result.win_rate('a'):>10.1%} {result.mean_time_to_kill('a') or 0:>8.2f}")
+
+        outcome = (result.wins, result.time_to_kill)
+        if reference is None:
+            reference = outcome
+        elif outcome != reference:
+            print(f'FAIL: {processes} processes gave a different result for seed {args.seed}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""Compare SQLite throughput and lock errors with and without the tuned engine settings.
+
+Runs writer processes that apply damage the way /attack does (read the
+defender, update its health and append to the combat log in one
+transaction) next to reader processes that poll the way open game pages do.
+Each profile uses a fresh database file: ``default`` is a bare
+``create_engine``, as before the settings existed; ``tuned`` applies
+``database.engine_options`` and the WAL, busy-timeout and synchronous
+PRAGMAs.
+
+    python benchmarks/sqlite_contention.py --writers 4 --readers 8 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+ENTITIES = 100
+
+
+def make_engine(profile, uri):
+    if profile == 'default':
+        return sa.create_engine(uri)
+    engine = sa.create_engine(uri, **database.engine_options(uri))
+    database.install(engine)
+    return engine
+
+
+def prepare(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE entity (id INTEGER PRIMARY KEY, health FLOAT, health_version INTEGER)')
+        conn.exec_driver_sql('CREATE INDEX ix_entity_health_version ON entity (health_version)')
+        conn.exec_driver_sql('CREATE TABLE health_version (id INTEGER PRIMARY KEY, version INTEGER)')
+        conn.exec_driver_sql('INSERT INTO health_version (id, version) VALUES (1, 0)')
+        conn.exec_driver_sql('CREATE TABLE combat_log (id INTEGER PRIMARY KEY AUTOINCREMENT, game_id INTEGER, '
+                             'message TEXT)')
+        conn.exec_driver_sql('CREATE INDEX ix_combat_log_game_id_id ON combat_log (game_id, id)')
+        conn.execute(sa.text('INSERT INTO entity (id, health, health_version) VALUES (:id, 1000000, 0)'),
+                     [{'id': number} for number in range(1, ENTITIES + 1)])
+
+
+def write(conn, number):
+    entity_id = number % ENTITIES + 1
+    conn.execute(sa.text('SELECT health FROM entity WHERE id = :id'), {'id': entity_id}).scalar()
+    version = conn.execute(sa.text('UPDATE health_version SET version = version + 1 RETURNING version')).scalar()
+    conn.execute(sa.text('UPDATE entity SET health = health - 1, health_version = :version WHERE id = :id'),
+                 {'id': entity_id, 'version': version})
+    conn.execute(sa.text("INSERT INTO combat_log (game_id, message) VALUES (1, 'hit')"))
+
+
+def read(conn, number):
+    conn.execute(sa.text('SELECT id, health FROM entity WHERE health_version > :since'),
+                 {'since': number}).fetchall()
+    conn.execute(sa.text('SELECT message FROM combat_log WHERE game_id = 1 ORDER BY id DESC LIMIT 20')).fetchall()
+
+
+def run_worker(job):
+    """Run reads or writes until ``deadline``; return the latencies of successes and the error count."""
+    profile, role, uri, deadline = job
+    engine = make_engine(profile, uri)
+    operation = write if role == 'writer' else read
+    latencies = []
+    errors = 0
+    number = os.getpid()
+    while time.time() < deadline:
+        number += 1
+        start = time.perf_counter()
+        try:
+            with engine.begin() as conn:
+                operation(conn, number)
+        except sa.exc.OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    engine.dispose()
+    return role, latencies, errors
+
+
+def percentile(values, percent):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--profiles', nargs='+', choices=['default', 'tuned'], default=['default', 'tuned'])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    print(f"{'profile':>8} {'role':>7} {'ops/s':>8} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for profile in args.profiles:
+        uri = f"sqlite:///{os.path.join(directory, f'{profile}.db')}"
+        engine = make_engine(profile, uri)
+        prepare(engine)
+        engine.dispose()
+
+        deadline = time.time() + args.seconds
+        jobs = [(profile, 'writer', uri, deadline)] * args.writers + [(profile, 'reader', uri, deadline)] * args.readers
+        with multiprocessing.get_context('fork').Pool(len(jobs)) as pool:
+            results = pool.map(run_worker, jobs)
+
+        for role in ('writer', 'reader'):
+            latencies = [latency for result_role, values, _ in results if result_role == role for latency in values]
+            errors = sum(count for result_role, _, count in results if result_role == role)
+            print(f'{profile:>8} {role:>7} {len(latencies) / args.seconds:>8.0f} {errors:>7} '
+                  f'{percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""Track how long the site takes to start and how much memory each gunicorn worker holds.
+
+Cold start is timed in fresh interpreters: importing ``app``, building the
+application with ``create_app()`` and serving the first request. Each
+interpreter then forks, as a preloaded gunicorn master does, and checks
+that the child starts with an empty connection pool rather than the
+parent's connections.
+
+gunicorn is then started with and without ``--preload`` against a scratch
+SQLite database. For each mode the time until the first response is
+reported, along with the memory of every worker after it has served some
+requests, read from /proc (Linux only): RSS, PSS (shared pages divided
+between the processes sharing them) and USS (pages only that worker holds).
+Preloaded workers should show a much lower USS and PSS.
+
+    python benchmarks/startup.py --runs 5 --workers 4
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+COLD_START = '''
+import json, os, time
+start = time.perf_counter()
+import app as site
+imported = time.perf_counter()
+application = site.create_app()
+created = time.perf_counter()
+response = application.test_client().get('/login')
+served = time.perf_counter()
+assert response.status_code == 302, response.status_code
+with application.app_context():
+    engine = site.db.engine
+    with engine.connect():
+        pass
+pooled = engine.pool.checkedin()
+read, write = os.pipe()
+child = os.fork()
+if child == 0:
+    os.write(write, str(engine.pool.checkedin()).encode())
+    os._exit(0)
+os.waitpid(child, 0)
+print(json.dumps({'import': imported - start, 'create_app': created - imported, 'first_request': served - created,
+                  'parent_pool': pooled, 'child_pool': int(os.read(read, 16))}))
+'''
+
+
+def free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def memory(pid):
+    """RSS, PSS and USS of ``pid`` in MiB, from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as stream:
+        for line in stream:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return fields['Rss'], fields['Pss'], fields['Private_Clean'] + fields['Private_Dirty']
+
+
+def workers(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as stream:
+        return [int(child) for child in stream.read().split()]
+
+
+def serve(env, args, preload):
+    """Start gunicorn, wait for its workers to answer and return the seconds that took and their memory."""
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}']
+    if preload:
+        # Served the way the Procfile serves it
+        command += ['--config', 'gunicorn_config.py', 'app:create_app()']
+    else:
+        command += ['--worker-class', 'gevent', 'app:app']
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stderr=subprocess.DEVNULL)
+    try:
+        http = requests.Session()
+        deadline = time.time() + 60
+        while True:
+            if server.poll() is not None:
+                raise SystemExit(f'gunicorn exited with status {server.returncode}')
+            try:
+                http.get(f'http://127.0.0.1:{port}/login', timeout=10, allow_redirects=False)
+                break
+            except requests.ConnectionError:
+                if time.time() > deadline:
+                    raise SystemExit('gunicorn did not start within 60 seconds')
+                time.sleep(0.05)
+        ready = time.perf_counter() - start
+        http.close()
+        # New connections are spread over the workers, so each of them has served a few requests
+        for _ in range(args.requests):
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=5, allow_redirects=False)
+        while len(workers(server.pid)) < args.workers:
+            time.sleep(0.05)
+        return ready, [memory(pid) for pid in workers(server.pid)], memory(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to time the cold start in')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--requests', type=int, default=200, help='requests served before memory is read')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(directory, 'startup.db')}",
+               SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'), DB_SELF_CHECK='0')
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'upgrade-db'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    samples = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START], cwd=ROOT, env=env, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    print(f"{'cold start':>14} {'median ms':>10} {'max ms':>8}")
+    for step in ('import', 'create_app', 'first_request'):
+        values = [sample[step] * 1000 for sample in samples]
+        print(f'{step:>14} {statistics.median(values):>10.1f} {max(values):>8.1f}')
+    status = 0
+    if any(sample['parent_pool'] == 0 or sample['child_pool'] != 0 for sample in samples):
+        print('FAIL: a forked child kept the connections its parent had pooled')
+        status = 1
+
+    print(f"\n{'gunicorn':>10} {'ready ms':>9} {'process':>8} {'RSS MiB':>8} {'PSS MiB':>8} {'USS MiB':>8}")
+    for label, preload in (('no preload', False), ('preload', True)):
+        ready, worker_memory, master_memory = serve(env, args, preload)
+        print(f'{label:>10} {ready * 1000:>9.0f} {"master":>8} '
+              + ' '.join(f'{value:>8.1f}' for value in master_memory))
+        averages = [statistics.mean(values[column] for values in worker_memory) for column in range(3)]
+        totals = sum(values[1] for values in worker_memory) + master_memory[1]
+        print(f'{label:>10} {"":>9} {"worker":>8} ' + ' '.join(f'{value:>8.1f}' for value in averages))
+        print(f'{label:>10} {"":>9} {"total":>8} {"":>8} {totals:>8.1f}')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
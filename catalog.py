@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from stats import STATS
+
+Attack = namedtuple('Attack', ['id', 'name', 'description', 'damage_modifier_stat', 'damage_modifier_multiplier',
+                               'accuracy', 'damage', 'number_of_targets', 'skill_id'])
+
+Skill = namedtuple('Skill', ['id', 'name', 'description',
+                             *[f'bonus_{stat}' for stat in STATS],
+                             *[f'multiplier_{stat}' for stat in STATS],
+                             'skill_cost'])
+
+
+class Catalog:
+    """A read-only snapshot of the skill and attack tables at one catalog version."""
+
+    def __init__(self, version, attack_rows, skill_rows):
+        self.version = version
+        attacks = [Attack(**{field: row[field] for field in Attack._fields}) for row in attack_rows]
+        skills = [Skill(**{field: row[field] for field in Skill._fields}) for row in skill_rows]
+
+        self.attacks = MappingProxyType({attack.id: attack for attack in sorted(attacks, key=lambda a: a.id)})
+        self.skills = MappingProxyType({skill.id: skill for skill in sorted(skills, key=lambda s: s.id)})
+
+        skill_actions = {}
+        for attack in self.attacks.values():
+            if attack.skill_id is not None:
+                skill_actions.setdefault(attack.skill_id, []).append(attack)
+        self.skill_actions = MappingProxyType({skill_id: tuple(actions)
+                                               for skill_id, actions in skill_actions.items()})
+
+    def actions_for(self, skill_ids):
+        """Return the attacks granted by ``skill_ids``, in skill order."""
+        return [attack for skill_id in skill_ids for attack in self.skill_actions.get(skill_id, ())]
+
+
+class CatalogCache:
+    """Keeps one ``Catalog`` per process and rebuilds it when the catalog version moves.
+
+    The stored version is checked at most once every ``check_interval``
+    seconds, so hot paths normally read the snapshot without any SQL.
+    """
+
+    def __init__(self, load_version, load_catalog, check_interval=5):
+        self._load_version = load_version
+        self._load_catalog = load_catalog
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.checks = 0
+        self.reloads = 0
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < self._next_check:
+            # Counted without the lock; a lost increment only skews the stats
+            self.hits += 1
+            return snapshot
+        with self._lock:
+            version = self._load_version()
+            self.checks += 1
+            if self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = self._load_catalog(version)
+                self.reloads += 1
+            self._next_check = time.monotonic() + self.check_interval
+            return self._snapshot
+
+    def reset(self):
+        """Force the next ``get`` to check the stored version."""
+        self._next_check = 0
+
+    def stats(self):
+        lookups = self.hits + self.checks
+        return {
+            'hits': self.hits,
+            'checks': self.checks,
+            'reloads': self.reloads,
+            'version': self._snapshot.version if self._snapshot is not None else None,
+            'hit_ratio': self.hits / lookups if lookups else None
+        }
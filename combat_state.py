@@ -0,0 +1,306 @@
+"""Write-behind combat state for games under heavy attack.
+
+With ``HOT_COMBAT_STATE`` on, /attack rolls against in-memory ``Combatant``
+copies of the entities of the game instead of loading ``EntityModel`` rows,
+and commits nothing. Damage and log messages pile up in memory and are
+written in one transaction every ``HOT_COMBAT_FLUSH_SECONDS``, when the
+process exits, or, after a crash, by the next process to start.
+
+Every attack is appended to a journal file before it is acknowledged, so it
+survives the process dying (and, with ``fsync``, the machine). Each flush
+stores one numbered batch of the journal, and the database records the
+last batch it holds for each journal in the same transaction as the
+damage, so a batch is applied exactly once even when the process dies
+between the commit and deleting the batch's file. A process keeps its
+journal locked for as long as it runs, so recovery only ever replays the
+journals of processes that are gone.
+
+Page renders and /game-updates read the database, which lags the memory by
+at most one flush interval; each flush publishes the stored health like any
+other write. Damage is stored as a relative UPDATE, so writes made
+elsewhere (regen, /attack-round, admin edits) are never lost, and the
+in-memory copies are reloaded after every flush to pick them up.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+from contextlib import nullcontext
+
+from stats import STATS
+
+logger = logging.getLogger(__name__)
+
+COMBATANT_FIELDS = ('id', 'name', 'health', 'max_health', 'evasion', *[f'effective_{stat}' for stat in STATS])
+
+
+class Combatant:
+    """The columns of an ``EntityModel`` that rolling an attack reads or writes, and the attacks it knows."""
+
+    __slots__ = (*COMBATANT_FIELDS, 'attack_ids')
+
+    def __init__(self, attack_ids=(), **fields):
+        for field in COMBATANT_FIELDS:
+            setattr(self, field, fields[field])
+        self.attack_ids = frozenset(attack_ids)
+
+
+class Journal:
+    """The attacks one process has acknowledged but not yet stored, one file per batch."""
+
+    def __init__(self, directory, fsync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.name = f'{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}'
+        self.batch = 1
+        self._lock_file = open(os.path.join(directory, f'{self.name}.lock'), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._file = open(self._path(self.batch), 'ab', buffering=0)
+
+    def _path(self, batch):
+        return os.path.join(self.directory, f'{self.name}.{batch}.jsonl')
+
+    def append(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Close the current batch, start the next one and return the number of the closed batch."""
+        self._file.close()
+        self.batch += 1
+        self._file = open(self._path(self.batch), 'ab', buffering=0)
+        return self.batch - 1
+
+    def discard(self, batch):
+        """Delete the file of a closed batch that has been stored."""
+        os.unlink(self._path(batch))
+
+    def close(self):
+        """Delete the journal; everything in it must have been stored."""
+        self._file.close()
+        os.unlink(self._path(self.batch))
+        os.unlink(self._lock_file.name)
+        self._lock_file.close()
+
+
+def read_batch(path):
+    """Sum the damage and collect the messages of one journal file."""
+    damage_by_entity, messages_by_game = {}, {}
+    with open(path, 'rb') as stream:
+        for line in stream:
+            try:
+                game_id, damage, messages = json.loads(line)
+            except ValueError:
+                # A torn last line was never acknowledged
+                continue
+            for entity_id, value in damage.items():
+                damage_by_entity[int(entity_id)] = damage_by_entity.get(int(entity_id), 0) + value
+            messages_by_game.setdefault(game_id, []).extend(messages)
+    return damage_by_entity, messages_by_game
+
+
+class CombatState:
+    """Holds the combatants of active games in memory and writes their damage behind.
+
+    ``load(game_id, entity_ids)`` returns ``COMBATANT_FIELDS`` mappings, plus
+    the ``attack_ids`` each entity knows, for every entity of ``game_id``
+    (when not None) and for ``entity_ids``.
+    ``store(journal, batch, damage_by_entity, messages_by_game)`` writes one
+    batch and commits, doing nothing when that journal's batch is already
+    stored; ``forget(journal)`` drops what the database recorded about a
+    journal once all of it is stored. All three run inside ``context()``.
+    """
+
+    def __init__(self, load, store, forget, directory, interval=1.0, fsync=False, context=nullcontext):
+        self._load = load
+        self._store = store
+        self._forget = forget
+        self.directory = directory
+        self.interval = interval
+        self.fsync = fsync
+        self._context = context
+        self.flushes = 0
+        self.recovered = 0
+        self._reset()
+        # Nothing recorded by the parent belongs to a forked worker
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        # Held by a flush for as long as it stores, so batches are stored in order
+        self._flush_lock = threading.Lock()
+        self._combatants = {}
+        self._games = set()
+        self._damage = {}
+        self._messages = {}
+        # What a running flush is storing, and the closed journal batches not stored yet
+        self._storing = {}
+        self._unstored = []
+        # Moves on every flush, so a load that raced a flush is not cached
+        self._generation = 0
+        self._journal = None
+        self._stopped = threading.Event()
+        self.attacks = 0
+
+    def combatants(self, game_id, *entity_ids):
+        """Return the in-memory copies of ``entity_ids``, loading every entity of ``game_id`` on first use."""
+        while True:
+            with self._lock:
+                missing = [entity_id for entity_id in entity_ids if entity_id not in self._combatants]
+                if game_id in self._games and not missing:
+                    return {entity_id: self._combatants[entity_id] for entity_id in entity_ids}
+                generation = self._generation
+                load_game = game_id not in self._games
+            with self._context():
+                rows = self._load(game_id if load_game else None, missing)
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                for row in rows:
+                    if row['id'] not in self._combatants:
+                        combatant = Combatant(**row)
+                        # The database does not hold what is waiting for the next flush yet
+                        pending = self._damage.get(combatant.id, 0) + self._storing.get(combatant.id, 0)
+                        combatant.health = max(combatant.health - pending, 0)
+                        self._combatants[combatant.id] = combatant
+                self._games.add(game_id)
+                return {entity_id: self._combatants.get(entity_id) for entity_id in entity_ids}
+
+    def record(self, game_id, damage_by_entity, messages):
+        """Journal an attack, apply its damage in memory and queue it for the next flush.
+
+        Returns the id, name, health and max health of every combatant whose
+        health changed.
+        """
+        damage_by_entity = {entity_id: damage for entity_id, damage in damage_by_entity.items() if damage > 0}
+        changed = []
+        with self._lock:
+            if self._journal is None:
+                self._open()
+            self._journal.append([game_id, damage_by_entity, messages])
+            self.attacks += 1
+            for entity_id, damage in damage_by_entity.items():
+                self._damage[entity_id] = self._damage.get(entity_id, 0) + damage
+                combatant = self._combatants.get(entity_id)
+                if combatant is not None and combatant.health > 0:
+                    combatant.health = max(combatant.health - damage, 0)
+                    changed.append({'id': combatant.id, 'name': combatant.name, 'health': combatant.health,
+                                    'max_health': combatant.max_health})
+            self._messages.setdefault(game_id, []).extend(messages)
+        return changed
+
+    def _open(self):
+        self._journal = Journal(self.directory, self.fsync)
+        threading.Thread(target=self._run, name='combat-state-flusher', daemon=True).start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Storing combat state failed; retrying in %s seconds', self.interval)
+
+    def flush(self):
+        """Store everything recorded since the last flush in one transaction.
+
+        Attacks keep being recorded while the batch is stored: the lock they
+        take is only held to swap the pending damage out and rotate the
+        journal. If storing fails, the damage goes back to be stored by the
+        next flush, and the batch's journal file stays until it is.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._journal is None or not (self._damage or self._messages):
+                    return
+                damage, messages = self._damage, self._messages
+                self._damage, self._messages = {}, {}
+                self._storing = damage
+                self._unstored.append(self._journal.rotate())
+                name, batch = self._journal.name, self._unstored[-1]
+            try:
+                with self._context():
+                    self._store(name, batch, damage, messages)
+            except Exception:
+                with self._lock:
+                    for entity_id, value in self._damage.items():
+                        damage[entity_id] = damage.get(entity_id, 0) + value
+                    for game_id, game_messages in self._messages.items():
+                        messages.setdefault(game_id, []).extend(game_messages)
+                    self._damage, self._messages = damage, messages
+                    self._storing = {}
+                raise
+            with self._lock:
+                # The stored batch carried the damage of every batch before it that failed
+                for stored in self._unstored:
+                    self._journal.discard(stored)
+                self._unstored = []
+                self._storing = {}
+                # Reload on next use, picking up whatever other writers changed
+                self._combatants.clear()
+                self._games.clear()
+                self._generation += 1
+                self.flushes += 1
+
+    def close(self):
+        """Store what is left and delete this process's journal. Runs at exit."""
+        self._stopped.set()
+        try:
+            self.flush()
+        except Exception:
+            # The journal stays behind for the next process to replay
+            logger.exception('Storing combat state at exit failed')
+            return
+        with self._lock:
+            if self._journal is None:
+                return
+            name = self._journal.name
+            self._journal.close()
+            self._journal = None
+        with self._context():
+            self._forget(name)
+
+    def recover(self):
+        """Store the journals of processes that stopped before flushing them; returns the batches replayed."""
+        replayed = 0
+        for lock_path in sorted(glob.glob(os.path.join(glob.escape(self.directory), '*.lock'))):
+            name = os.path.basename(lock_path)[:-len('.lock')]
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its process is still running
+                    continue
+                paths = glob.glob(os.path.join(glob.escape(self.directory), f'{glob.escape(name)}.*.jsonl'))
+                for batch, path in sorted((int(path.rsplit('.', 2)[1]), path) for path in paths):
+                    damage_by_entity, messages_by_game = read_batch(path)
+                    if damage_by_entity or messages_by_game:
+                        with self._context():
+                            self._store(name, batch, damage_by_entity, messages_by_game)
+                        replayed += 1
+                    os.unlink(path)
+                try:
+                    os.unlink(lock_path)
+                except FileNotFoundError:
+                    # Another process recovered it first
+                    continue
+            with self._context():
+                self._forget(name)
+        self.recovered += replayed
+        return replayed
+
+    def stats(self):
+        return {
+            'combatants': len(self._combatants),
+            'pending_entities': len(self._damage),
+            'attacks': self.attacks,
+            'flushes': self.flushes,
+            'recovered_batches': self.recovered
+        }
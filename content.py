@@ -0,0 +1,155 @@
+"""Reading, validating and writing bulk content files.
+
+Content is exchanged as JSON Lines, one object per line with a ``type`` of
+``attack``, ``skill`` or ``entity``, or as CSV holding a single kind per
+file. Skills name their attacks in ``actions`` and entities name their
+skills in ``skills``; in CSV those lists are separated by ``;``.
+"""
+import csv
+import io
+import json
+
+from stats import STATS
+
+KINDS = ('attack', 'skill', 'entity')
+
+FIELDS = {
+    'attack': {
+        'name': str,
+        'description': str,
+        'damage_modifier_stat': str,
+        'damage_modifier_multiplier': float,
+        'accuracy': float,
+        'damage': float,
+        'number_of_targets': int,
+    },
+    'skill': {
+        'name': str,
+        'description': str,
+        **{f'bonus_{stat}': float for stat in STATS},
+        **{f'multiplier_{stat}': float for stat in STATS},
+        'skill_cost': int,
+    },
+    'entity': {
+        'name': str,
+        'description': str,
+        'level': int,
+        'experience': int,
+        'unassigned_stat_points': int,
+        **{f'base_{stat}': float for stat in STATS},
+    },
+}
+
+# The by-name references each kind may carry
+REFERENCES = {'attack': None, 'skill': 'actions', 'entity': 'skills'}
+
+OPTIONAL = {'description': ''}
+
+
+class ContentError(ValueError):
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+
+
+def _decoded(stream):
+    """Yield ``(line, text)`` for every line of a binary ``stream`` of UTF-8."""
+    for line, data in enumerate(stream, start=1):
+        try:
+            yield line, data.decode('utf-8')
+        except UnicodeDecodeError as error:
+            raise ContentError(line, f'not UTF-8 text: {error.reason} at byte {error.start}')
+
+
+def read_rows(stream, fmt, kind=None):
+    """Yield ``(line, kind, raw)`` for every row of a binary ``stream``.
+
+    ``fmt`` is ``jsonl`` or ``csv``; CSV files hold one ``kind`` of content.
+    Lines are decoded one at a time so a file that is not UTF-8 is reported
+    at the line that is not.
+    """
+    if fmt == 'jsonl':
+        for line, text in _decoded(stream):
+            if not text.strip():
+                continue
+            try:
+                raw = json.loads(text)
+            except json.JSONDecodeError as error:
+                raise ContentError(line, f'invalid JSON: {error.msg}')
+            if not isinstance(raw, dict):
+                raise ContentError(line, 'expected an object')
+            yield line, raw.get('type'), raw
+    elif fmt == 'csv':
+        if kind not in KINDS:
+            raise ContentError(0, f'CSV imports need a kind, one of {", ".join(KINDS)}')
+        reader = csv.DictReader(text for _, text in _decoded(stream))
+        rows = iter(reader)
+        while True:
+            try:
+                raw = next(rows)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                # line_num still counts only the lines before the one that failed
+                raise ContentError(reader.line_num + 1, f'invalid CSV: {error}')
+            reference = REFERENCES[kind]
+            if reference and raw.get(reference) is not None:
+                raw[reference] = [name.strip() for name in raw[reference].split(';') if name.strip()]
+            # The line a row ends on, which a quoted field may carry past the one it starts on
+            yield reader.line_num, kind, raw
+    else:
+        raise ContentError(0, f'unknown format {fmt!r}')
+
+
+def validate_row(line, kind, raw):
+    """Convert a raw row to column values and its list of referenced names."""
+    if kind not in KINDS:
+        raise ContentError(line, f'unknown type {kind!r}')
+
+    row = {}
+    for field, convert in FIELDS[kind].items():
+        value = raw.get(field)
+        if value is None or value == '':
+            if field in OPTIONAL:
+                row[field] = OPTIONAL[field]
+                continue
+            raise ContentError(line, f'missing {field}')
+        try:
+            row[field] = convert(value)
+        except (TypeError, ValueError):
+            raise ContentError(line, f'{field} must be {convert.__name__}, got {value!r}')
+
+    if kind == 'attack' and row['damage_modifier_stat'] not in STATS:
+        raise ContentError(line, f"damage_modifier_stat must be one of {', '.join(STATS)}")
+
+    references = []
+    if REFERENCES[kind]:
+        references = raw.get(REFERENCES[kind]) or []
+        if not isinstance(references, list) or not all(isinstance(name, str) for name in references):
+            raise ContentError(line, f'{REFERENCES[kind]} must be a list of names')
+    return row, references
+
+
+def write_rows(rows, fmt, kind=None):
+    """Yield text chunks encoding ``(kind, row, references)`` tuples in ``fmt``."""
+    if fmt == 'jsonl':
+        for row_kind, row, references in rows:
+            document = {'type': row_kind, **row}
+            if REFERENCES[row_kind]:
+                document[REFERENCES[row_kind]] = references
+            yield json.dumps(document) + '\n'
+    elif fmt == 'csv':
+        columns = list(FIELDS[kind]) + ([REFERENCES[kind]] if REFERENCES[kind] else [])
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns)
+        writer.writeheader()
+        for _, row, references in rows:
+            if REFERENCES[kind]:
+                row = {**row, REFERENCES[kind]: ';'.join(references)}
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        raise ValueError(f'unknown format {fmt!r}')
@@ -0,0 +1,96 @@
+"""Engine settings for SQLite and server database deployments.
+
+SQLite runs in WAL mode so polling readers never block the writer, with a
+busy timeout so writers queue for the lock instead of failing with
+"database is locked", and ``synchronous=NORMAL``, which is durable across
+application crashes in WAL mode. Server databases such as Postgres get a
+bounded pool, with pre-ping and recycling so connections dropped by the
+server are replaced. Every setting can be overridden from the environment.
+"""
+import os
+
+import sqlalchemy as sa
+
+SYNCHRONOUS_LEVELS = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+
+
+def is_sqlite(uri):
+    return sa.engine.make_url(uri).get_backend_name() == 'sqlite'
+
+
+def sqlite_pragmas():
+    """The PRAGMAs set on every new SQLite connection."""
+    return {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        # Milliseconds a connection waits for a lock before giving up
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    }
+
+
+def engine_options(uri):
+    """Keyword arguments for ``create_engine`` (``SQLALCHEMY_ENGINE_OPTIONS``) for ``uri``."""
+    if is_sqlite(uri):
+        # pysqlite's timeout is the same busy wait, in seconds
+        return {'connect_args': {'timeout': sqlite_pragmas()['busy_timeout'] / 1000}}
+    return {
+        # Requests beyond pool_size + max_overflow wait up to pool_timeout for a connection
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 40)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+
+def install(engine, pragmas=None):
+    """Set the SQLite PRAGMAs on every connection ``engine`` opens; no-op for other databases."""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas() if pragmas is None else pragmas
+
+    @sa.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def dispose_after_fork(engine):
+    """Give each process forked from this one (a preloaded gunicorn worker) a fresh connection pool.
+
+    Connections inherited from the parent are dropped without being closed,
+    since the parent may still be using them.
+    """
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+
+def settings(engine):
+    """Report the settings actually in effect on a connection from ``engine``."""
+    report = {
+        'dialect': engine.dialect.name,
+        'database': engine.url.render_as_string(hide_password=True),
+        'pool': type(engine.pool).__name__,
+    }
+    with engine.connect() as conn:
+        if engine.dialect.name == 'sqlite':
+            report['journal_mode'] = conn.exec_driver_sql('PRAGMA journal_mode').scalar()
+            synchronous = conn.exec_driver_sql('PRAGMA synchronous').scalar()
+            report['synchronous'] = SYNCHRONOUS_LEVELS.get(synchronous, synchronous)
+            report['busy_timeout'] = conn.exec_driver_sql('PRAGMA busy_timeout').scalar()
+        else:
+            conn.execute(sa.text('SELECT 1'))
+            report['pool_size'] = engine.pool.size()
+    return report
+
+
+def problems(report):
+    """Return warnings about a ``settings`` report that will hurt under concurrent load."""
+    warnings = []
+    if report['dialect'] == 'sqlite' and report['journal_mode'] != 'memory':
+        if report['journal_mode'] != 'wal':
+            warnings.append(f"SQLite journal_mode is {report['journal_mode']}, so readers block writers")
+        if not report['busy_timeout']:
+            warnings.append('SQLite busy_timeout is 0, so any lock contention fails immediately')
+    return warnings
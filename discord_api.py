@@ -0,0 +1,51 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class DiscordError(Exception):
+    def __init__(self, path, status=None):
+        super().__init__(f'Discord request for {path} failed' + (f' with status {status}' if status else ''))
+        self.path = path
+        self.status = status
+
+
+class DiscordClient:
+    """Calls the Discord REST API with a user's OAuth token over one pooled HTTP session.
+
+    Connections are kept alive between logins, and ``get_many`` issues
+    several requests at once so a login waits for the slowest call rather
+    than the sum of them. ``base_url`` can point at a local stub.
+    """
+
+    def __init__(self, base_url='https://discord.com', timeout=5, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._connect()
+        # A forked worker must not share the parent's sockets or inherit its dead threads
+        os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self):
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='discord')
+
+    def get(self, path, token):
+        try:
+            response = self.http.get(self.base_url + path, timeout=self.timeout,
+                                     headers={'Authorization': f"Bearer {token['access_token']}"})
+        except requests.RequestException:
+            raise DiscordError(path)
+        if not response.ok:
+            raise DiscordError(path, response.status_code)
+        return response.json()
+
+    def get_many(self, token, *paths):
+        """Fetch ``paths`` concurrently and return their JSON bodies in the same order."""
+        futures = [self._executor.submit(self.get, path, token) for path in paths]
+        return [future.result() for future in futures]
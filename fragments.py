@@ -0,0 +1,40 @@
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCacheExtension(Extension):
+    """Adds a ``{% cache key, ... %}...{% endcache %}`` tag that stores rendered template fragments.
+
+    The key parts are joined into one cache key, so they should include a
+    version of every row the fragment shows: a write moves the version and
+    the next render misses, with no explicit invalidation needed. Stale
+    entries simply age out of ``environment.fragment_cache``, a ``TTLCache``.
+    Only the body of a missed fragment is evaluated, so relationships it
+    touches are not loaded on a hit. Never cache anything holding a CSRF
+    token or other per-session data.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(parts)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        key = ':'.join(str(part) for part in parts)
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+        return fragment
@@ -0,0 +1,31 @@
+"""gunicorn settings the Procfile serves the site with.
+
+Workers are gevent workers, so every request runs in a greenlet rather than
+a thread. An open game page keeps its /game-events stream open for as long
+as the tab is, which under gthread held one of a worker's few threads each
+and stalled every other request once they were all taken; a greenlet costs
+a few kilobytes, so a worker holds ``WORKER_CONNECTIONS`` streams and
+requests at once.
+
+The standard library is patched here, before ``preload_app`` imports the
+app, so the locks, queues, threads and sockets the app creates at import
+cooperate with gevent. SQLite calls are not cooperative and block their
+worker while they run, which the short statements the site issues afford.
+"""
+import os
+
+from gevent import monkey
+
+monkey.patch_all()
+
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+preload_app = True
+
+
+def on_starting(server):
+    # Combat events and user cache invalidations only cross workers through Redis
+    if server.cfg.workers > 1 and not os.environ.get('REDIS_URL'):
+        server.log.warning('Running %d workers without REDIS_URL: a worker only pushes the health changes it '
+                           'makes itself and only drops its own stale cached users, which others keep for up to '
+                           'USER_CACHE_TTL seconds', server.cfg.workers)
@@ -0,0 +1,122 @@
+import json
+import os
+import queue
+import threading
+
+
+class InProcessBackend:
+    """Delivers published events straight to the listener of this process."""
+
+    def __init__(self):
+        self._listener = None
+
+    def start(self, listener):
+        self._listener = listener
+
+    def publish(self, key, event):
+        self._listener(key, event)
+
+
+class RedisBackend:
+    """Relays events between gunicorn workers through a Redis pub/sub channel.
+
+    Every worker publishes to the channel and runs one listener thread, so an
+    event published by any worker reaches the listeners of all of them.
+    Threads do not survive a fork, so a worker forked from a preloaded
+    master subscribes again on a connection of its own. Nothing connects
+    until ``start``, so building one costs no import of redis.
+    """
+
+    def __init__(self, url, channel):
+        self._url = url
+        self._channel = channel
+        self._redis = None
+
+    def start(self, listener):
+        # Every app a process builds starts the same backend; only the first subscribes
+        if self._redis is not None:
+            return
+        import redis
+
+        self._redis = redis.Redis.from_url(self._url)
+        self._listen(listener)
+        os.register_at_fork(after_in_child=lambda: self._listen(listener))
+
+    def _listen(self, listener):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._channel)
+
+        def listen():
+            for message in pubsub.listen():
+                payload = json.loads(message['data'])
+                listener(payload['key'], payload['event'])
+
+        threading.Thread(target=listen, name=f'{self._channel}-listener', daemon=True).start()
+
+    def publish(self, key, event):
+        self._redis.publish(self._channel, json.dumps({'key': key, 'event': event}))
+
+
+class GameHub:
+    """Fans combat events out to every client subscribed to a game.
+
+    Each subscriber owns a small queue and blocks on it, so idle connections
+    cost no CPU no matter how many of them are open. Events only arrive once
+    ``start`` has subscribed to the backend.
+    """
+
+    def __init__(self, backend=None, max_pending=100):
+        self.backend = backend or InProcessBackend()
+        self.max_pending = max_pending
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.backend.start(self._deliver)
+
+    def subscribe(self, game_id):
+        subscriber = queue.Queue(maxsize=self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(game_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, game_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(game_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[game_id]
+
+    def subscriber_count(self, game_id):
+        with self._lock:
+            return len(self._subscribers.get(game_id, ()))
+
+    def publish(self, game_id, event):
+        self.backend.publish(game_id, event)
+
+    def _deliver(self, game_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(game_id, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # A client that stopped reading should not hold up everyone else;
+                # it catches up through the delta feed when it reconnects.
+                pass
+
+    def stream(self, game_id, keepalive=15):
+        """Yield Server-Sent Events for ``game_id`` until the client disconnects."""
+        subscriber = self.subscribe(game_id)
+        try:
+            yield ': connected\n\n'
+            while True:
+                try:
+                    event = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'data: {json.dumps(event)}\n\n'
+        finally:
+            self.unsubscribe(game_id, subscriber)
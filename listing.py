@@ -0,0 +1,89 @@
+"""Keyset (cursor) pagination for SQLAlchemy queries.
+
+A page is read by seeking past the last row of the previous page on the
+sort column and the primary key, rather than by OFFSET, so with an index on
+the sort column every page costs the same however deep into the listing it
+is, and rows written between requests never shift or repeat a page. The
+cursor handed to clients is opaque: it records the sort it belongs to and
+the sort value and id of the last row returned.
+"""
+import base64
+import binascii
+import json
+
+import sqlalchemy as sa
+
+
+class ListingError(ValueError):
+    """A listing request with an unknown sort, a bad filter or a cursor that does not fit."""
+
+
+def encode_cursor(sort, descending, value, row_id):
+    data = json.dumps([sort, descending, value, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort, descending):
+    """Return the sort value and id recorded in ``cursor``, checking it was made for this sort."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, cursor_descending, value, row_id = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise ListingError('Malformed cursor')
+    if (cursor_sort, cursor_descending) != (sort, descending) or not isinstance(row_id, int):
+        raise ListingError('The cursor belongs to a different sort order')
+    # Lists and objects would reach the database driver as bind parameters
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise ListingError('Malformed cursor')
+    return value, row_id
+
+
+def seek(column, id_column, descending, value, row_id):
+    """The criteria selecting, in turn, the rows after ``(value, row_id)`` in the order given by ``order_by``.
+
+    NULL sort values come first when ascending and last when descending.
+    Rows on either side of the NULLs are read with separate criteria, since
+    an OR of the two would stop the database seeking on the sort index.
+    """
+    if column is id_column:
+        return [id_column < row_id if descending else id_column > row_id]
+    if descending:
+        if value is None:
+            return [sa.and_(column.is_(None), id_column < row_id)]
+        return [sa.tuple_(column, id_column) < (value, row_id), column.is_(None)]
+    if value is None:
+        return [sa.and_(column.is_(None), id_column > row_id), column.is_not(None)]
+    return [sa.tuple_(column, id_column) > (value, row_id)]
+
+
+def order_by(column, id_column, descending):
+    if column is id_column:
+        return [id_column.desc() if descending else id_column.asc()]
+    if descending:
+        return [column.desc().nulls_last(), id_column.desc()]
+    return [column.asc().nulls_first(), id_column.asc()]
+
+
+def page(query, sort, column, id_column, descending=False, cursor=None, limit=50):
+    """Return up to ``limit`` rows of ``query`` in sort order after ``cursor``, and the next page's cursor.
+
+    Rows must expose the sort column and the id under their column keys.
+    The next cursor is None on the last page.
+    """
+    ordered = query.order_by(*order_by(column, id_column, descending))
+    if cursor:
+        value, row_id = decode_cursor(cursor, sort, descending)
+        criteria = seek(column, id_column, descending, value, row_id)
+    else:
+        criteria = [sa.true()]
+    # One extra row tells whether another page follows without a COUNT
+    rows = []
+    for criterion in criteria:
+        rows.extend(ordered.filter(criterion).limit(limit + 1 - len(rows)).all())
+        if len(rows) > limit:
+            break
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(sort, descending, getattr(last, column.key), getattr(last, id_column.key))
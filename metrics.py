@@ -0,0 +1,113 @@
+import logging
+import random
+import threading
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Counts observations into fixed buckets and estimates percentiles from them."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, percent):
+        """The upper bound of the bucket holding the ``percent``-th observation."""
+        if not self.count:
+            return None
+        needed = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= needed:
+                return bound
+        return float('inf')
+
+    def as_dict(self):
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': buckets
+        }
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.max_sql_statements = 0
+
+
+class Metrics:
+    """Per-endpoint request latency and SQL usage of this process.
+
+    Every gunicorn worker keeps its own counters, so each one reports only
+    the requests it served.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, status, seconds, sql_statements, sql_seconds):
+        with self._lock:
+            route = self._routes.get(endpoint)
+            if route is None:
+                route = self._routes[endpoint] = RouteMetrics()
+            route.latency.observe(seconds)
+            route.statuses[status] = route.statuses.get(status, 0) + 1
+            route.sql_statements += sql_statements
+            route.sql_seconds += sql_seconds
+            route.max_sql_statements = max(route.max_sql_statements, sql_statements)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'latency': route.latency.as_dict(),
+                    'statuses': {str(status): count for status, count in sorted(route.statuses.items())},
+                    'sql': {
+                        'statements': route.sql_statements,
+                        'seconds': route.sql_seconds,
+                        'statements_per_request': route.sql_statements / route.latency.count,
+                        'max_statements_per_request': route.max_sql_statements
+                    }
+                }
+                for endpoint, route in sorted(self._routes.items())
+            }
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only a ``rate`` fraction of records at or below ``level``.
+
+    Higher levels always pass, so warnings and errors are never dropped.
+    """
+
+    def __init__(self, rate, level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno > self.level or random.random() < self.rate
@@ -0,0 +1,283 @@
+"""Versioned schema migrations.
+
+Each migration runs once, in order, in its own transaction, and the applied
+version is recorded in ``schema_migration``. The table definitions here are
+frozen copies of the schema at that version, not the live models, so an
+empty database can be brought up to any version. Apply pending migrations
+with ``flask --app app upgrade-db``.
+"""
+import sqlalchemy as sa
+
+
+def _baseline(conn):
+    """The schema as originally shipped in instance/project.db."""
+    metadata = sa.MetaData()
+    sa.Table('user_model', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('discord_id', sa.String, unique=True, nullable=False),
+             sa.Column('username', sa.String, nullable=False),
+             sa.Column('discriminator', sa.String, nullable=False),
+             sa.Column('avatar_url', sa.String))
+    sa.Table('skill_model', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('name', sa.Text),
+             sa.Column('description', sa.Text),
+             *[sa.Column(f'{kind}_{stat}', sa.Float)
+               for kind in ('bonus', 'multiplier')
+               for stat in ('strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma')],
+             sa.Column('skill_cost', sa.Integer))
+    sa.Table('attack_model', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('name', sa.Text),
+             sa.Column('description', sa.Text),
+             sa.Column('damage_modifier_stat', sa.String),
+             sa.Column('damage_modifier_multiplier', sa.Float),
+             sa.Column('accuracy', sa.Float),
+             sa.Column('damage', sa.Float),
+             sa.Column('number_of_targets', sa.Integer),
+             sa.Column('skill_id', sa.Integer, sa.ForeignKey('skill_model.id')))
+    sa.Table('entity_model', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('name', sa.Text),
+             sa.Column('description', sa.Text),
+             sa.Column('level', sa.Integer),
+             sa.Column('experience', sa.Integer),
+             sa.Column('unassigned_stat_points', sa.Integer),
+             *[sa.Column(f'{kind}_{stat}', sa.Float)
+               for kind in ('base', 'bonus', 'multiplier')
+               for stat in ('strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma')],
+             *[sa.Column(f'{prefix}{field}', sa.Float)
+               for field in ('health', 'health_regen', 'evasion', 'psi', 'psi_regen')
+               for prefix in ('', 'max_')],
+             sa.Column('user_id', sa.Integer, sa.ForeignKey('user_model.id'), nullable=True))
+    sa.Table('game_model', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('game_name', sa.String, unique=True, nullable=False),
+             sa.Column('discord_guild_id', sa.String, nullable=True),
+             sa.Column('creator_id', sa.Integer))
+    sa.Table('entity_skill', metadata,
+             sa.Column('entity_id', sa.Integer, sa.ForeignKey('entity_model.id')),
+             sa.Column('skill_id', sa.Integer, sa.ForeignKey('skill_model.id')))
+    sa.Table('players_games', metadata,
+             sa.Column('user_id', sa.Integer, sa.ForeignKey('user_model.id')),
+             sa.Column('game_id', sa.Integer, sa.ForeignKey('game_model.id')))
+    sa.Table('games_entities', metadata,
+             sa.Column('game_id', sa.Integer, sa.ForeignKey('game_model.id'), primary_key=True),
+             sa.Column('entity_id', sa.Integer, sa.ForeignKey('entity_model.id'), primary_key=True))
+    metadata.create_all(conn, checkfirst=True)
+
+
+def _metadata(conn, *referenced):
+    """A fresh MetaData holding the reflected tables that new foreign keys point at."""
+    metadata = sa.MetaData()
+    metadata.reflect(conn, only=referenced)
+    return metadata
+
+
+def _add_column(conn, table, column):
+    columns = {existing['name'] for existing in sa.inspect(conn).get_columns(table)}
+    if column.name not in columns:
+        column_type = column.type.compile(conn.dialect)
+        default = f' DEFAULT {column.server_default.arg}' if column.server_default is not None else ''
+        not_null = '' if column.nullable else ' NOT NULL'
+        conn.execute(sa.text(f'ALTER TABLE {table} ADD COLUMN {column.name} {column_type}{not_null}{default}'))
+
+
+def _create_index(conn, name, table, *columns):
+    if name not in {index['name'] for index in sa.inspect(conn).get_indexes(table)}:
+        conn.execute(sa.text(f'CREATE INDEX {name} ON {table} ({", ".join(columns)})'))
+
+
+def _rebuild_with_primary_key(conn, table, columns):
+    """Recreate an association table with a composite primary key, dropping duplicate rows."""
+    if sa.inspect(conn).get_pk_constraint(table)['constrained_columns']:
+        return
+    metadata = _metadata(conn, *{foreign_key.target_fullname.split('.')[0]
+                                 for column in columns for foreign_key in column.foreign_keys})
+    rebuilt = sa.Table(f'{table}_new', metadata, *columns)
+    rebuilt.create(conn)
+    names = ', '.join(column.name for column in columns)
+    not_null = ' AND '.join(f'{column.name} IS NOT NULL' for column in columns)
+    conn.execute(sa.text(f'INSERT INTO {table}_new ({names}) SELECT DISTINCT {names} FROM {table} WHERE {not_null}'))
+    conn.execute(sa.text(f'DROP TABLE {table}'))
+    conn.execute(sa.text(f'ALTER TABLE {table}_new RENAME TO {table}'))
+
+
+def _health_version(conn):
+    _add_column(conn, 'entity_model',
+                sa.Column('health_version', sa.Integer, nullable=False, server_default='0'))
+
+
+def _combat_log(conn):
+    metadata = _metadata(conn, 'game_model')
+    sa.Table('combat_log_model', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('game_id', sa.Integer, sa.ForeignKey('game_model.id'), nullable=False),
+             sa.Column('message', sa.Text, nullable=False),
+             sa.Column('created_at', sa.DateTime, nullable=False),
+             sa.Index('ix_combat_log_model_game_id_id', 'game_id', 'id'),
+             sqlite_autoincrement=True)
+    metadata.tables['combat_log_model'].create(conn, checkfirst=True)
+
+
+def _lookup_indexes(conn):
+    _create_index(conn, 'ix_entity_model_user_id', 'entity_model', 'user_id')
+    _create_index(conn, 'ix_attack_model_skill_id', 'attack_model', 'skill_id')
+    _create_index(conn, 'ix_games_entities_entity_id', 'games_entities', 'entity_id')
+
+    _rebuild_with_primary_key(conn, 'entity_skill', [
+        sa.Column('entity_id', sa.Integer, sa.ForeignKey('entity_model.id'), primary_key=True),
+        sa.Column('skill_id', sa.Integer, sa.ForeignKey('skill_model.id'), primary_key=True),
+    ])
+    _create_index(conn, 'ix_entity_skill_skill_id', 'entity_skill', 'skill_id')
+
+    _rebuild_with_primary_key(conn, 'players_games', [
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user_model.id'), primary_key=True),
+        sa.Column('game_id', sa.Integer, sa.ForeignKey('game_model.id'), primary_key=True),
+    ])
+    _create_index(conn, 'ix_players_games_game_id', 'players_games', 'game_id')
+
+
+def _catalog_version(conn):
+    metadata = sa.MetaData()
+    catalog_version = sa.Table('catalog_version_model', metadata,
+                               sa.Column('id', sa.Integer, primary_key=True),
+                               sa.Column('version', sa.Integer, nullable=False))
+    catalog_version.create(conn, checkfirst=True)
+    if conn.execute(sa.select(sa.func.count()).select_from(catalog_version)).scalar() == 0:
+        conn.execute(catalog_version.insert().values(id=1, version=0))
+
+
+def _user_guilds(conn):
+    _add_column(conn, 'user_model', sa.Column('guilds_refreshed_at', sa.DateTime, nullable=True))
+    metadata = _metadata(conn, 'user_model')
+    sa.Table('user_guilds', metadata,
+             sa.Column('user_id', sa.Integer, sa.ForeignKey('user_model.id'), primary_key=True),
+             sa.Column('guild_id', sa.String, primary_key=True),
+             sa.Index('ix_user_guilds_guild_id', 'guild_id'))
+    metadata.tables['user_guilds'].create(conn, checkfirst=True)
+
+
+def _guild_games_index(conn):
+    _create_index(conn, 'ix_game_model_discord_guild_id', 'game_model', 'discord_guild_id')
+
+
+def _encounters(conn):
+    metadata = _metadata(conn, 'game_model')
+    sa.Table('encounter_model', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('game_id', sa.Integer, sa.ForeignKey('game_model.id'), unique=True, nullable=False),
+             sa.Column('round', sa.Integer, nullable=False),
+             sa.Column('turn', sa.Integer, nullable=False),
+             sa.Column('initiative', sa.JSON, nullable=False))
+    metadata.tables['encounter_model'].create(conn, checkfirst=True)
+
+
+def _effective_stats(conn):
+    stats = ('strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma')
+    for stat in stats:
+        _add_column(conn, 'entity_model', sa.Column(f'effective_{stat}', sa.Float))
+    conn.execute(sa.text('UPDATE entity_model SET ' + ', '.join(
+        f'effective_{stat} = base_{stat} * multiplier_{stat} + bonus_{stat}' for stat in stats)))
+
+    metadata = _metadata(conn, 'entity_model', 'attack_model')
+    entity_attack = sa.Table('entity_attack', metadata,
+                             sa.Column('entity_id', sa.Integer, sa.ForeignKey('entity_model.id'), primary_key=True),
+                             sa.Column('attack_id', sa.Integer, sa.ForeignKey('attack_model.id'), primary_key=True),
+                             sa.Index('ix_entity_attack_attack_id', 'attack_id'))
+    if not sa.inspect(conn).has_table('entity_attack'):
+        entity_attack.create(conn)
+        conn.execute(sa.text('INSERT INTO entity_attack (entity_id, attack_id) '
+                             'SELECT DISTINCT entity_skill.entity_id, attack_model.id FROM entity_skill '
+                             'JOIN attack_model ON attack_model.skill_id = entity_skill.skill_id'))
+
+
+def _game_versions(conn):
+    _add_column(conn, 'game_model', sa.Column('version', sa.Integer, nullable=False, server_default='0'))
+
+
+def _listing_indexes(conn):
+    _create_index(conn, 'ix_attack_model_name', 'attack_model', 'name')
+    _create_index(conn, 'ix_skill_model_name', 'skill_model', 'name')
+    _create_index(conn, 'ix_entity_model_name', 'entity_model', 'name')
+    _create_index(conn, 'ix_entity_model_level', 'entity_model', 'level')
+
+
+def _combat_journals(conn):
+    metadata = sa.MetaData()
+    sa.Table('combat_journal_model', metadata,
+             sa.Column('name', sa.String, primary_key=True),
+             sa.Column('batch', sa.Integer, nullable=False))
+    metadata.tables['combat_journal_model'].create(conn, checkfirst=True)
+
+
+def _health_version_counter(conn):
+    _create_index(conn, 'ix_entity_model_health_version', 'entity_model', 'health_version')
+    metadata = sa.MetaData()
+    health_version = sa.Table('health_version_model', metadata,
+                              sa.Column('id', sa.Integer, primary_key=True),
+                              sa.Column('version', sa.Integer, nullable=False))
+    health_version.create(conn, checkfirst=True)
+    if conn.execute(sa.select(sa.func.count()).select_from(health_version)).scalar() == 0:
+        conn.execute(sa.text('INSERT INTO health_version_model (id, version) '
+                             'SELECT 1, coalesce(max(health_version), 0) FROM entity_model'))
+
+
+def _entity_version(conn):
+    metadata = sa.MetaData()
+    entity_version = sa.Table('entity_version_model', metadata,
+                              sa.Column('id', sa.Integer, primary_key=True),
+                              sa.Column('version', sa.Integer, nullable=False))
+    entity_version.create(conn, checkfirst=True)
+    if conn.execute(sa.select(sa.func.count()).select_from(entity_version)).scalar() == 0:
+        conn.execute(entity_version.insert().values(id=1, version=0))
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline),
+    (2, 'entity health versions', _health_version),
+    (3, 'per-game combat log', _combat_log),
+    (4, 'lookup indexes and association primary keys', _lookup_indexes),
+    (5, 'catalog version counter', _catalog_version),
+    (6, 'cached discord guild membership', _user_guilds),
+    (7, 'games by discord guild index', _guild_games_index),
+    (8, 'encounter turn order', _encounters),
+    (9, 'effective stat columns and entity attacks', _effective_stats),
+    (10, 'game page versions', _game_versions),
+    (11, 'catalog listing sort indexes', _listing_indexes),
+    (12, 'write-behind combat journals', _combat_journals),
+    (13, 'health version counter and index', _health_version_counter),
+    (14, 'entity version counter', _entity_version),
+]
+
+_schema_migration = sa.Table('schema_migration', sa.MetaData(),
+                             sa.Column('version', sa.Integer, primary_key=True),
+                             sa.Column('description', sa.String, nullable=False))
+
+
+def current_version(conn):
+    if not sa.inspect(conn).has_table('schema_migration'):
+        return 0
+    return conn.execute(sa.select(sa.func.max(_schema_migration.c.version))).scalar() or 0
+
+
+def upgrade(engine, target=None):
+    """Apply every migration up to ``target`` (default: all) and return the resulting version."""
+    with engine.begin() as conn:
+        existing = sa.inspect(conn).has_table('user_model')
+        _schema_migration.create(conn, checkfirst=True)
+        # Databases created before migrations existed already have the baseline
+        if existing and current_version(conn) == 0:
+            conn.execute(_schema_migration.insert().values(version=1, description='baseline schema'))
+
+    for version, description, migrate in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with engine.begin() as conn:
+            if version <= current_version(conn):
+                continue
+            migrate(conn)
+            conn.execute(_schema_migration.insert().values(version=version, description=description))
+
+    with engine.connect() as conn:
+        return current_version(conn)
@@ -0,0 +1,160 @@
+"""Offline Monte Carlo simulation of encounters between two sides.
+
+Entities and their attacks are copied into plain tuples first, so trials run
+without the database and can be spread over a process pool. Hits and damage
+use the same formulas as ``attack()``. Every round, each living combatant in
+a shuffled order picks one of its attacks at random and aims it at up to
+``number_of_targets`` random living enemies. A trial ends when one side has
+no health left, or as a draw after ``max_rounds``.
+
+Trials are split into fixed-size chunks seeded from ``seed`` and the chunk
+number, so a run gives the same result however many processes share it.
+"""
+import math
+import random
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from stats import attack_damage, hit_chance
+
+SIDES = ('a', 'b')
+
+Move = namedtuple('Move', ['name', 'damage', 'accuracy', 'targets'])
+Combatant = namedtuple('Combatant', ['name', 'health', 'evasion', 'moves'])
+
+
+def combatant(entity, attacks, damage_scale=1.0, accuracy_scale=1.0):
+    """Freeze ``entity`` at full health with its ``attacks``, optionally scaling their damage and accuracy."""
+    moves = tuple(Move(attack.name, attack_damage(entity, attack) * damage_scale,
+                       attack.accuracy * accuracy_scale, attack.number_of_targets or 1)
+                  for attack in attacks)
+    return Combatant(entity.name, entity.max_health, entity.evasion, moves)
+
+
+class SimulationResult:
+    """Win counts and time-to-kill histograms, in rounds, of a batch of trials."""
+
+    def __init__(self):
+        self.trials = 0
+        self.rounds = 0
+        self.wins = Counter()
+        self.time_to_kill = {side: Counter() for side in SIDES}
+
+    def merge(self, other):
+        self.trials += other.trials
+        self.rounds += other.rounds
+        self.wins.update(other.wins)
+        for side in SIDES:
+            self.time_to_kill[side].update(other.time_to_kill[side])
+        return self
+
+    def win_rate(self, side):
+        return self.wins[side] / self.trials if self.trials else 0.0
+
+    @property
+    def draw_rate(self):
+        return self.wins['draw'] / self.trials if self.trials else 0.0
+
+    def mean_time_to_kill(self, side):
+        histogram = self.time_to_kill[side]
+        total = sum(histogram.values())
+        return sum(rounds * count for rounds, count in histogram.items()) / total if total else None
+
+    def time_to_kill_percentile(self, side, percent):
+        """The number of rounds within which ``percent`` of ``side``'s wins were decided."""
+        histogram = self.time_to_kill[side]
+        total = sum(histogram.values())
+        if not total:
+            return None
+        needed = math.ceil(total * percent / 100)
+        seen = 0
+        for rounds in sorted(histogram):
+            seen += histogram[rounds]
+            if seen >= needed:
+                return rounds
+
+
+def run_trials(side_a, side_b, trials, max_rounds, seed):
+    """Run ``trials`` encounters in this process and return their ``SimulationResult``."""
+    rng = random.Random(seed)
+    roll = rng.random
+    shuffle = rng.shuffle
+    sample = rng.sample
+
+    fighters = list(side_a) + list(side_b)
+    side_of = [0] * len(side_a) + [1] * len(side_b)
+    # plans[i]: fighter i's moves as (damage, targets, chance of hitting each fighter)
+    plans = [tuple((move.damage, move.targets, [hit_chance(move, defender) for defender in fighters])
+                   for move in fighter.moves)
+             for fighter in fighters]
+    starting_health = [max(fighter.health or 0, 0) for fighter in fighters]
+    starting_living = [[i for i in range(len(fighters)) if side_of[i] == side and starting_health[i] > 0]
+                       for side in (0, 1)]
+    order = [i for i in range(len(fighters)) if fighters[i].moves]
+
+    result = SimulationResult()
+    wins = result.wins
+    time_to_kill = result.time_to_kill
+    for _ in range(trials):
+        health = starting_health[:]
+        living = [starting_living[0][:], starting_living[1][:]]
+        winner = None
+        rounds = 0
+        while winner is None and rounds < max_rounds and living[0] and living[1]:
+            rounds += 1
+            shuffle(order)
+            for i in order:
+                if health[i] <= 0:
+                    continue
+                moves = plans[i]
+                damage, targets, chances = moves[int(roll() * len(moves))]
+                enemies = living[1 - side_of[i]]
+                if targets == 1:
+                    targets = (enemies[int(roll() * len(enemies))],)
+                else:
+                    targets = sample(enemies, targets) if targets < len(enemies) else enemies[:]
+                for j in targets:
+                    if roll() < chances[j]:
+                        health[j] -= damage
+                        if health[j] <= 0:
+                            health[j] = 0
+                            enemies.remove(j)
+                if not enemies:
+                    winner = SIDES[side_of[i]]
+                    break
+
+        result.trials += 1
+        result.rounds += rounds
+        if winner is None and not (living[0] and living[1]):
+            # A side that started with no health loses without a fight
+            winner = SIDES[0] if living[0] else SIDES[1] if living[1] else None
+        if winner is None:
+            wins['draw'] += 1
+        else:
+            wins[winner] += 1
+            time_to_kill[winner][rounds] += 1
+    return result
+
+
+def _run_chunk(job):
+    return run_trials(*job)
+
+
+def simulate(side_a, side_b, trials, max_rounds=100, seed=0, processes=1, chunk_size=10000):
+    """Run ``trials`` encounters of ``side_a`` against ``side_b`` and return the merged result.
+
+    With ``processes`` above one the chunks are spread over a process pool.
+    """
+    side_a, side_b = tuple(side_a), tuple(side_b)
+    jobs = [(side_a, side_b, min(chunk_size, trials - start), max_rounds, seed * 1000003 + number)
+            for number, start in enumerate(range(0, trials, chunk_size))]
+
+    result = SimulationResult()
+    if processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, len(jobs))) as pool:
+            for chunk in pool.map(_run_chunk, jobs):
+                result.merge(chunk)
+    else:
+        for job in jobs:
+            result.merge(_run_chunk(job))
+    return result